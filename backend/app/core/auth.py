@@ -1,62 +1,164 @@
-from datetime import datetime, timedelta
+import os
+import time
+from datetime import timedelta
+from functools import lru_cache
 from typing import Optional
-from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import event, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from cache import TTLCache
+from coordination import coordinator
 from database import get_db, User
+from hashing import hashing_pool, HashingPoolBusy
+from history import ChangeActor, change_actor
+from tokens import (
+    TokenClaims, TokenError, issue_token, verify_token, revocations,
+    ACCESS_TOKEN_EXPIRE_MINUTES
+)
 
-# to get a string like this run:
-# openssl rand -hex 32
-SECRET_KEY = "09d25e094faa6ca2556c818166b7a9563b93f7099f6f0f4caa6cf63b88e8d3e7"
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Usernames allowed to use operational endpoints (e.g. the profiler)
+ADMIN_USERS = frozenset(name for name in os.environ.get("ADMIN_USERS", "").split(",") if name)
+
+# Users resolved from tokens (keyed by subject and expiry). Entries never
+# outlive the token itself.
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300
+
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Built on first use: passlib and its bcrypt backend are only needed once
+# someone signs up or logs in, not to import the app or verify tokens
+@lru_cache(maxsize=None)
+def get_pwd_context():
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_pwd_context().verify(plain_password, hashed_password)
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
+
+async def _run_hashing(fn, *args):
+    try:
+        return await hashing_pool.run(fn, *args)
+    except HashingPoolBusy:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many authentication requests, please retry shortly",
+            headers={"Retry-After": "1"},
+        )
+
+# Async variants run bcrypt on the hashing pool instead of the event loop
+async def verify_password_async(plain_password, hashed_password):
+    return await _run_hashing(verify_password, plain_password, hashed_password)
 
-def get_user(db: Session, username: str):
-    return db.query(User).filter(User.username == username).first()
+async def get_password_hash_async(password):
+    return await _run_hashing(get_password_hash, password)
 
-def authenticate_user(db: Session, username: str, password: str):
-    user = get_user(db, username)
+async def get_user(db: AsyncSession, username: str):
+    return await db.scalar(select(User).where(User.username == username))
+
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = await get_user(db, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password_async(password, user.hashed_password):
         return False
     return user
 
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
-
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
+def create_access_token(user: User, expires_delta: Optional[timedelta] = None):
+    return issue_token(user.username, user.id, expires_delta=expires_delta)
+
+def invalidate_user(username: str):
+    user_cache.discard_where(lambda key: key[0] == username)
+
+def revoke_token(claims: TokenClaims):
+    revocations.revoke(claims.jti, claims.expires_at)
+    coordinator.publish("auth.revoke_token", [claims.jti, claims.expires_at])
+
+# Other workers' cached users and revocations
+coordinator.subscribe("auth.invalidate_user", invalidate_user)
+coordinator.subscribe("auth.revoke_token", lambda payload: revocations.revoke(*payload))
+coordinator.subscribe("auth.revoke_user", revocations.revoke_user)
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_cached_user(mapper, connection, target):
+    # A renamed user must also drop the entries cached under the old name
+    for username in [target.username, *inspect(target).attrs.username.history.deleted]:
+        invalidate_user(username)
+        coordinator.publish("auth.invalidate_user", username)
+
+@event.listens_for(User, "after_delete")
+def _revoke_deleted_user_tokens(mapper, connection, target):
+    # Routes authorized from claims alone never load the user, so they rely on this
+    revocations.revoke_user(target.id)
+    coordinator.publish("auth.revoke_user", target.id)
+
+def claims_from_token(token: str) -> Optional[TokenClaims]:
+    try:
+        return verify_token(token)
+    except TokenError:
+        return None
+
+async def get_user_from_token(token: str, db: AsyncSession):
+    """Resolve a bearer token to its (cached) user, or None if invalid."""
+    claims = claims_from_token(token)
+    if claims is None:
+        return None
+
+    key = (claims.username, claims.expires_at)
+    user = user_cache.get(key)
+    if user is None:
+        user = await get_user(db, username=claims.username)
+        if user is None:
+            return None
+        # Detach so commits in this or later requests don't expire the cached copy
+        db.expunge(user)
+        user_cache.set(key, user, ttl=claims.expires_at - time.time())
+    return user
+
+def _credentials_exception():
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    user = get_user(db, username=username)
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    user = await get_user_from_token(token, db)
     if user is None:
-        raise credentials_exception
+        raise _credentials_exception()
+    # Device changes made by this request are logged as the user's
+    change_actor.set(ChangeActor("api", user.id))
     return user
+
+def get_token_claims(token: str = Depends(oauth2_scheme)) -> TokenClaims:
+    """The caller's verified claims, without loading the user."""
+    claims = claims_from_token(token)
+    if claims is None:
+        raise _credentials_exception()
+    return claims
+
+def require_scope(scope: str):
+    """Dependency authorizing a route from the token alone."""
+    def check(claims: TokenClaims = Depends(get_token_claims)) -> TokenClaims:
+        if scope not in claims.scopes:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail=f"Token lacks the {scope} scope",
+            )
+        return claims
+    return check
+
+async def get_admin_user(current_user: User = Depends(get_current_user)):
+    if current_user.username not in ADMIN_USERS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin privileges required",
+        )
+    return current_user
@@ -0,0 +1,182 @@
+import csv
+import io
+from typing import AsyncIterator, Iterable, Mapping, Optional, Tuple, Union
+
+import orjson
+
+from database import merge_properties, PROPERTY_COLUMNS
+
+# Bulk import/export formats. CSV has a column per typed property and a
+# JSON "properties" column for everything else (schedule, settings, ...).
+BULK_FORMATS = ("ndjson", "csv")
+CSV_COLUMNS = ("device_id", "name", "type", "status") + PROPERTY_COLUMNS + ("properties",)
+BULK_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+# Longest accepted import line; longer lines are reported, not buffered
+MAX_LINE_BYTES = 64 * 1024
+
+
+class RecordError(ValueError):
+    """A single import line could not be parsed."""
+
+
+async def iter_lines(chunks: AsyncIterator[bytes],
+                     max_line_bytes: int = MAX_LINE_BYTES) -> AsyncIterator[Tuple[int, Union[str, RecordError]]]:
+    """Split a byte stream into ``(line_number, text)`` pairs as it arrives.
+
+    Blank lines are skipped. A line longer than ``max_line_bytes`` yields a
+    RecordError in place of its text and is discarded up to its end.
+    """
+    buffer = b""
+    number = 0
+    oversized = False
+    async for chunk in chunks:
+        buffer += chunk
+        while True:
+            end = buffer.find(b"\n")
+            if end < 0:
+                if len(buffer) > max_line_bytes:
+                    oversized, buffer = True, b""
+                break
+            line, buffer = buffer[:end], buffer[end + 1:]
+            number += 1
+            if oversized or len(line) > max_line_bytes:
+                oversized = False
+                yield number, RecordError(f"Line is longer than {max_line_bytes} bytes")
+                continue
+            try:
+                text = line.decode("utf-8").strip()
+            except UnicodeDecodeError:
+                yield number, RecordError("Line is not valid UTF-8")
+                continue
+            if text:
+                yield number, text
+    if buffer.strip() or oversized:
+        number += 1
+        if oversized or len(buffer) > max_line_bytes:
+            yield number, RecordError(f"Line is longer than {max_line_bytes} bytes")
+        else:
+            try:
+                yield number, buffer.decode("utf-8").strip()
+            except UnicodeDecodeError:
+                yield number, RecordError("Line is not valid UTF-8")
+
+
+def parse_ndjson(line: str) -> dict:
+    try:
+        record = orjson.loads(line)
+    except orjson.JSONDecodeError as e:
+        raise RecordError(f"Invalid JSON: {str(e)}")
+    if not isinstance(record, dict):
+        raise RecordError("Expected a JSON object")
+    return record
+
+
+def parse_csv_header(line: str) -> Tuple[str, ...]:
+    header = tuple(column.strip() for column in next(csv.reader([line])))
+    unknown = [column for column in header if column not in CSV_COLUMNS]
+    if unknown:
+        raise RecordError(f"Unknown columns: {', '.join(unknown)}")
+    if "device_id" not in header:
+        raise RecordError("Missing device_id column")
+    return header
+
+
+def parse_csv(line: str, header: Tuple[str, ...]) -> dict:
+    """Map a CSV line to the NDJSON record shape; empty cells are unset.
+
+    Values stay strings; validation coerces the typed properties.
+    """
+    values = next(csv.reader([line]))
+    if len(values) != len(header):
+        raise RecordError(f"Expected {len(header)} columns, got {len(values)}")
+    record, properties = {}, {}
+    for column, value in zip(header, values):
+        if value == "":
+            continue
+        if column == "properties":
+            try:
+                extra = orjson.loads(value)
+            except orjson.JSONDecodeError as e:
+                raise RecordError(f"Invalid properties JSON: {str(e)}")
+            if not isinstance(extra, dict):
+                raise RecordError("properties must be a JSON object")
+            properties = {**extra, **properties}
+        elif column in PROPERTY_COLUMNS:
+            properties[column] = value
+        else:
+            record[column] = value
+    record["properties"] = properties
+    return record
+
+
+async def iter_records(chunks: AsyncIterator[bytes],
+                       format: str) -> AsyncIterator[Tuple[int, Union[dict, RecordError]]]:
+    """Parse an NDJSON or CSV import stream into ``(line_number, record)``
+    pairs, yielding a RecordError for each line that can't be parsed."""
+    header: Optional[Tuple[str, ...]] = None
+    async for number, line in iter_lines(chunks):
+        if isinstance(line, RecordError):
+            yield number, line
+            continue
+        try:
+            if format == "ndjson":
+                yield number, parse_ndjson(line)
+            elif header is None:
+                try:
+                    header = parse_csv_header(line)
+                except (RecordError, csv.Error) as e:
+                    # Without a header no row can be read
+                    yield number, RecordError(f"Invalid CSV header: {str(e)}")
+                    return
+            else:
+                yield number, parse_csv(line, header)
+        except RecordError as e:
+            yield number, e
+        except csv.Error as e:
+            yield number, RecordError(f"Invalid CSV: {str(e)}")
+    if format == "csv" and header is None:
+        yield 1, RecordError("Missing CSV header")
+
+
+def export_document(row: Mapping, overlay: Optional[dict] = None) -> dict:
+    """A device as an import record, with every stored property."""
+    properties = merge_properties(row, row["extra"])
+    if overlay:
+        properties.update(overlay)
+    return {
+        "device_id": row["device_id"],
+        "name": row["name"],
+        "type": row["type"],
+        "status": row["status"],
+        "properties": properties,
+    }
+
+
+def _csv_value(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        # Lower case, as the CSV import (and pydantic) reads booleans
+        return "true" if value else "false"
+    return str(value)
+
+
+def encode_ndjson(documents: Iterable[dict]) -> bytes:
+    return b"".join(orjson.dumps(document) + b"\n" for document in documents)
+
+
+def encode_csv(documents: Iterable[dict], header: bool = False) -> bytes:
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    if header:
+        writer.writerow(CSV_COLUMNS)
+    for document in documents:
+        properties = dict(document["properties"])
+        typed = [properties.pop(key, None) for key in PROPERTY_COLUMNS]
+        writer.writerow(
+            [document["device_id"], document["name"], document["type"], document["status"]]
+            + [_csv_value(value) for value in typed]
+            + [orjson.dumps(properties).decode() if properties else ""]
+        )
+    return out.getvalue().encode()
@@ -0,0 +1,273 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# "local" for a single process; "sqlite" shares state between the workers
+# of one machine through a small database file next to the app's
+COORDINATION_BACKEND = os.environ.get("COORDINATION_BACKEND", "local")
+COORDINATION_PATH = os.environ.get("COORDINATION_PATH", "coordination.db")
+
+# How often the SQLite backend delivers and collects messages, and how long
+# delivered messages are kept for workers that fall behind (seconds)
+POLL_INTERVAL = float(os.environ.get("COORDINATION_POLL_INTERVAL", "0.1"))
+MESSAGE_RETENTION = 60
+
+Handler = Callable[[object], None]
+
+
+class LocalBackend:
+    """Coordination for a single process: there are no other workers to
+    tell, and this process is always the leader."""
+
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex[:12]
+        self._handlers: Dict[str, List[Handler]] = {}
+
+    def subscribe(self, channel: str, handler: Handler):
+        """Call ``handler(payload)`` for messages other workers publish."""
+        handlers = self._handlers.setdefault(channel, [])
+        if handler not in handlers:
+            handlers.append(handler)
+
+    def publish(self, channel: str, payload):
+        """Tell the other workers; the caller has already applied it locally."""
+
+    async def acquire(self, name: str, ttl: float) -> bool:
+        """Take or renew the lease ``name`` for ``ttl`` seconds."""
+        return True
+
+    async def release(self, name: str):
+        pass
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def _dispatch(self, channel: str, payload):
+        for handler in self._handlers.get(channel, ()):
+            try:
+                handler(payload)
+            except Exception as e:
+                logger.error(f"Coordination handler for {channel} failed: {str(e)}")
+
+
+class SQLiteBackend(LocalBackend):
+    """Workers on one machine share a SQLite file.
+
+    Published messages are buffered and appended to a log table in one
+    transaction per poll; each worker reads the rows other workers added
+    since its last poll. Leases are rows that their holder renews before
+    they expire, so a crashed leader is replaced within one ``ttl``.
+    """
+
+    def __init__(self, path: str = COORDINATION_PATH, poll_interval: float = POLL_INTERVAL):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._outbox: List[tuple] = []
+        self._outbox_lock = threading.Lock()
+        self._last_id = 0
+        self._last_prune = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS coordination_messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, "
+            "origin TEXT NOT NULL, payload TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS coordination_leases ("
+            "name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM coordination_messages").fetchone()[0]
+        return conn
+
+    def publish(self, channel: str, payload):
+        with self._outbox_lock:
+            self._outbox.append((channel, self.worker_id, json.dumps(payload), time.time()))
+
+    def _exchange(self) -> List[tuple]:
+        with self._outbox_lock:
+            outbox, self._outbox = self._outbox, []
+        now = time.time()
+        with self._db_lock:
+            conn = self._conn
+            try:
+                if outbox:
+                    with conn:
+                        conn.executemany(
+                            "INSERT INTO coordination_messages (channel, origin, payload, created_at) "
+                            "VALUES (?, ?, ?, ?)",
+                            outbox,
+                        )
+                rows = conn.execute(
+                    "SELECT id, channel, origin, payload FROM coordination_messages "
+                    "WHERE id > ? ORDER BY id",
+                    (self._last_id,),
+                ).fetchall()
+                if now - self._last_prune >= MESSAGE_RETENTION:
+                    with conn:
+                        conn.execute("DELETE FROM coordination_messages WHERE created_at < ?", (now - MESSAGE_RETENTION,))
+                    self._last_prune = now
+            except sqlite3.Error:
+                # Keep the messages for the next poll
+                with self._outbox_lock:
+                    self._outbox[:0] = outbox
+                raise
+        if rows:
+            self._last_id = rows[-1][0]
+        return [(channel, json.loads(payload)) for _, channel, origin, payload in rows if origin != self.worker_id]
+
+    async def _run(self):
+        while True:
+            try:
+                for channel, payload in await asyncio.to_thread(self._exchange):
+                    self._dispatch(channel, payload)
+            except Exception as e:
+                logger.error(f"Error exchanging coordination messages: {str(e)}")
+            await asyncio.sleep(self.poll_interval)
+
+    def _acquire(self, name: str, ttl: float) -> bool:
+        now = time.time()
+        with self._db_lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT INTO coordination_leases (name, holder, expires_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+                    "WHERE coordination_leases.holder = excluded.holder OR coordination_leases.expires_at < ?",
+                    (name, self.worker_id, now + ttl, now),
+                )
+            holder = self._conn.execute(
+                "SELECT holder FROM coordination_leases WHERE name = ?", (name,)
+            ).fetchone()
+        return holder is not None and holder[0] == self.worker_id
+
+    async def acquire(self, name: str, ttl: float) -> bool:
+        return await asyncio.to_thread(self._acquire, name, ttl)
+
+    def _release(self, name: str):
+        with self._db_lock:
+            with self._conn:
+                self._conn.execute(
+                    "DELETE FROM coordination_leases WHERE name = ? AND holder = ?", (name, self.worker_id)
+                )
+
+    async def release(self, name: str):
+        await asyncio.to_thread(self._release, name)
+
+    async def start(self):
+        if self._task is not None:
+            return
+        self._conn = await asyncio.to_thread(self._connect)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # Deliver what this worker published during shutdown
+        try:
+            await asyncio.to_thread(self._exchange)
+        except Exception as e:
+            logger.error(f"Error exchanging coordination messages: {str(e)}")
+        self._conn.close()
+        self._conn = None
+
+
+# Backends by COORDINATION_BACKEND name; each is built with no arguments
+BACKENDS = {
+    "local": LocalBackend,
+    "sqlite": SQLiteBackend,
+}
+
+
+def create_backend(name: str = COORDINATION_BACKEND) -> LocalBackend:
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown coordination backend {name!r}, expected one of: {', '.join(BACKENDS)}")
+    return BACKENDS[name]()
+
+
+coordinator = create_backend()
+
+
+class Leadership:
+    """Runs a job in exactly one worker, chosen through a lease.
+
+    The lease is renewed every third of ``ttl``. The worker holding it runs
+    ``on_elected``; if it fails to renew (or shuts down) it runs
+    ``on_revoked`` and another worker takes over once the lease lapses.
+    """
+
+    def __init__(self, name: str, on_elected: Callable[[], Awaitable[None]],
+                 on_revoked: Callable[[], Awaitable[None]], ttl: float = 15.0,
+                 backend: LocalBackend = coordinator):
+        self.name = name
+        self.ttl = ttl
+        self.is_leader = False
+        self._on_elected = on_elected
+        self._on_revoked = on_revoked
+        self._backend = backend
+        self._task: Optional[asyncio.Task] = None
+
+    async def _campaign(self):
+        try:
+            leader = await self._backend.acquire(self.name, self.ttl)
+        except Exception as e:
+            logger.error(f"Error renewing the {self.name} lease: {str(e)}")
+            leader = False
+        if leader and not self.is_leader:
+            logger.info(f"Worker {self._backend.worker_id} is now the {self.name} leader")
+            self.is_leader = True
+            await self._on_elected()
+        elif not leader and self.is_leader:
+            logger.warning(f"Worker {self._backend.worker_id} lost the {self.name} lease")
+            self.is_leader = False
+            await self._on_revoked()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            await self._campaign()
+
+    async def start(self):
+        if self._task is not None:
+            return
+        # The first round runs inline, so a single worker is leader on startup
+        await self._campaign()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self.is_leader:
+            self.is_leader = False
+            await self._on_revoked()
+            await self._backend.release(self.name)
@@ -0,0 +1,230 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Set
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from coordination import coordinator
+from database import Device, PROPERTY_COLUMNS
+from history import change_actor, device_history
+
+logger = logging.getLogger(__name__)
+
+# Devices a subscriber may have pending before it is told to resync instead,
+# and how long the sender waits after the first change to coalesce more
+MAX_PENDING_DEVICES = 1000
+COALESCE_INTERVAL = 0.05
+
+
+class Subscription:
+    """Per-client buffer of device deltas, coalesced per device.
+
+    Repeated changes to one device merge into a single pending delta, so the
+    buffer is bounded by the number of distinct devices. If a slow client
+    lets more than ``max_pending`` devices pile up, the buffer is dropped and
+    the client receives a single ``resync`` message instead.
+    """
+
+    def __init__(self, user_id: int, max_pending: int = MAX_PENDING_DEVICES):
+        self.user_id = user_id
+        self.max_pending = max_pending
+        self._pending: "OrderedDict[str, dict]" = OrderedDict()
+        self._overflowed = False
+        self._ready = asyncio.Event()
+
+    def push(self, device_id: str, changes: dict):
+        if self._overflowed:
+            return
+        delta = self._pending.get(device_id)
+        if delta is None:
+            if len(self._pending) >= self.max_pending:
+                self._pending.clear()
+                self._overflowed = True
+                self._ready.set()
+                return
+            delta = self._pending[device_id] = {"device_id": device_id}
+        for key, value in changes.items():
+            if key == "properties" and isinstance(delta.get("properties"), dict):
+                delta["properties"].update(value)
+            else:
+                delta[key] = dict(value) if isinstance(value, dict) else value
+        self._ready.set()
+
+    async def get(self, coalesce: float = COALESCE_INTERVAL) -> dict:
+        """Wait for changes and return the next message to send."""
+        await self._ready.wait()
+        if coalesce:
+            await asyncio.sleep(coalesce)
+        self._ready.clear()
+        if self._overflowed:
+            self._overflowed = False
+            return {"type": "resync"}
+        deltas = list(self._pending.values())
+        self._pending.clear()
+        return {"type": "devices", "deltas": deltas}
+
+
+class DeviceEventHub:
+    """Fans device deltas out to every subscription of the owning user.
+
+    In-process listeners (e.g. the scheduler) registered with
+    ``add_listener`` receive every change regardless of user.
+    """
+
+    def __init__(self):
+        self._subscriptions: Dict[int, Set[Subscription]] = {}
+        self._listeners: List[Callable[[int, str, dict], None]] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def add_listener(self, listener: Callable[[int, str, dict], None]):
+        self._loop = asyncio.get_running_loop()
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[int, str, dict], None]):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def subscribe(self, user_id: int) -> Subscription:
+        self._loop = asyncio.get_running_loop()
+        subscription = Subscription(user_id)
+        self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscriptions.get(subscription.user_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.user_id]
+
+    def subscriber_count(self) -> int:
+        return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    def publish(self, user_id: int, device_id: str, changes: dict):
+        if user_id not in self._subscriptions and not self._listeners:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if self._loop is not None and running is not self._loop:
+            # Changes committed from worker threads are handed to the loop
+            self._loop.call_soon_threadsafe(self._publish, user_id, device_id, changes)
+        else:
+            self._publish(user_id, device_id, changes)
+
+    def _publish(self, user_id: int, device_id: str, changes: dict):
+        for listener in list(self._listeners):
+            try:
+                listener(user_id, device_id, changes)
+            except Exception as e:
+                logger.error(f"Device event listener failed: {str(e)}")
+        for subscription in list(self._subscriptions.get(user_id, ())):
+            subscription.push(device_id, changes)
+
+    def publish_many(self, events: List[tuple]):
+        for user_id, device_id, changes in events:
+            self.publish(user_id, device_id, changes)
+
+
+device_events = DeviceEventHub()
+
+# Changes committed by other workers reach this worker's subscribers and
+# listeners the same way local ones do
+coordinator.subscribe("device_events", device_events.publish_many)
+
+# Device fields included in deltas, and the mapped columns backing each
+TRACKED_FIELDS = ("name", "type", "status", "properties")
+FIELD_COLUMNS = {"properties": PROPERTY_COLUMNS + ("extra",)}
+
+def _snapshot(device: Device, fields) -> dict:
+    changes = {field: getattr(device, field) for field in fields}
+    if "properties" in changes:
+        changes["properties"] = dict(changes["properties"] or {})
+    # Lets clients resume with GET /devices?since=<version>
+    changes["version"] = device.version
+    return changes
+
+def _history_changes(device: Device, state, fields) -> dict:
+    """Only the values that changed, for the history log."""
+    changes = {field: getattr(device, field) for field in fields if field != "properties"}
+    if "properties" in fields:
+        properties = {
+            key: getattr(device, key) for key in PROPERTY_COLUMNS
+            if state.attrs[key].history.has_changes()
+        }
+        if state.attrs["extra"].history.has_changes():
+            properties.update(device.extra or {})
+        changes["properties"] = properties
+    return changes
+
+# Deltas are collected per session as devices are flushed and only published
+# (and logged to the device history) once the outermost transaction
+# commits, so rolled-back changes are never pushed. SQLAlchemy also fires
+# the commit and rollback events for savepoints: a released savepoint's
+# changes wait for the outer commit, and one that rolls back (a failed
+# write in a write-queue batch) drops only what was collected within it.
+@event.listens_for(Session, "after_flush")
+def _collect_device_changes(session, flush_context):
+    pending = session.info.setdefault("device_events", [])
+    history = session.info.setdefault("device_history", [])
+    now = time.time()
+    actor = change_actor.get()
+    for obj in session.new:
+        if isinstance(obj, Device):
+            snapshot = _snapshot(obj, TRACKED_FIELDS)
+            pending.append((obj.owner_id, obj.device_id, snapshot))
+            changes = {field: value for field, value in snapshot.items() if field != "version"}
+            history.append((now, obj.device_id, obj.owner_id, actor.source, actor.user_id, changes))
+    for obj in session.dirty:
+        if not isinstance(obj, Device):
+            continue
+        state = inspect(obj)
+        changed = [
+            field for field in TRACKED_FIELDS
+            if any(state.attrs[column].history.has_changes() for column in FIELD_COLUMNS.get(field, (field,)))
+        ]
+        if changed:
+            pending.append((obj.owner_id, obj.device_id, _snapshot(obj, changed)))
+            history.append((now, obj.device_id, obj.owner_id, actor.source, actor.user_id,
+                            _history_changes(obj, state, changed)))
+
+@event.listens_for(Session, "after_transaction_create")
+def _mark_savepoint(session, transaction):
+    if transaction.nested:
+        session.info.setdefault("device_savepoints", {})[transaction] = (
+            len(session.info.get("device_events", ())),
+            len(session.info.get("device_history", ())),
+        )
+
+@event.listens_for(Session, "after_commit")
+def _publish_device_changes(session):
+    if session.get_nested_transaction() is not None:
+        return
+    session.info.pop("device_savepoints", None)
+    history = session.info.pop("device_history", None)
+    if history:
+        device_history.record(history)
+    events = session.info.pop("device_events", None)
+    if events:
+        device_events.publish_many(events)
+        coordinator.publish("device_events", events)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_device_changes(session):
+    savepoint = session.get_nested_transaction()
+    if savepoint is None:
+        session.info.pop("device_savepoints", None)
+        session.info.pop("device_events", None)
+        session.info.pop("device_history", None)
+        return
+    mark = session.info.get("device_savepoints", {}).pop(savepoint, None)
+    if mark is None:
+        return
+    for key, length in zip(("device_events", "device_history"), mark):
+        collected = session.info.get(key)
+        if collected is not None:
+            del collected[length:]
@@ -0,0 +1,81 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+# bcrypt releases the GIL, so a thread pool gives real parallelism here
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 4))
+PASSWORD_HASH_MAX_QUEUE = int(os.environ.get("PASSWORD_HASH_MAX_QUEUE", 64))
+
+
+class HashingPoolBusy(Exception):
+    """Raised when the hashing queue is full and the call was not accepted."""
+
+
+class HashingPool:
+    """Bounded executor for CPU-heavy password hashing.
+
+    At most ``workers`` hashes run at once and at most ``max_queue`` more may
+    wait; anything beyond that is rejected immediately with HashingPoolBusy
+    instead of piling up behind the event loop.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS,
+                 max_queue: int = PASSWORD_HASH_MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+        self._busy_seconds = 0.0
+
+    def _timed(self, fn: Callable, args: tuple) -> Any:
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._busy_seconds += elapsed
+
+    async def run(self, fn: Callable, *args) -> Any:
+        with self._lock:
+            if self._in_flight >= self.workers + self.max_queue:
+                self._rejected += 1
+                raise HashingPoolBusy()
+            self._in_flight += 1
+        try:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="password-hash"
+                )
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, self._timed, fn, args)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._completed += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "in_flight": self._in_flight,
+                "queued": max(0, self._in_flight - self.workers),
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "busy_seconds": self._busy_seconds,
+            }
+
+    def shutdown(self):
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+hashing_pool = HashingPool()
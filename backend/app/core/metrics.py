@@ -0,0 +1,255 @@
+import asyncio
+import bisect
+import contextvars
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets (seconds) and query-count buckets for per-request histograms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Requests issuing more queries than this are logged as likely N+1s
+QUERY_WARN_THRESHOLD = int(os.environ.get("QUERY_WARN_THRESHOLD", "20"))
+
+# How often the event loop is checked for lag (seconds)
+LOOP_LAG_INTERVAL = 0.5
+
+# Starlette appends "; charset=utf-8" to text/ types
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, labels: Labels = ()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in values]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, labels: Labels = ()):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: a count per bucket (plus +Inf), then sum and count
+        self._series: Dict[Labels, list] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        with self._lock:
+            snapshot = [(labels, list(series)) for labels, series in self._series.items()]
+        lines = self.header()
+        for labels, series in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {series[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {series[-1]}")
+        return lines
+
+
+# A collector returns (name, kind, help, value) samples read at scrape time
+Collector = Callable[[], Iterable[Tuple[str, str, str, float]]]
+
+
+class MetricsRegistry:
+    """Metrics rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Collector] = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()) -> Counter:
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()) -> Gauge:
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collector: Collector):
+        if collector not in self._collectors:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                for name, kind, help, value in collector():
+                    lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name} {value}"]
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {str(e)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+http_requests = metrics.counter(
+    "http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+http_latency = metrics.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ("method", "route"))
+http_in_flight = metrics.gauge("http_requests_in_flight", "HTTP requests being served")
+db_queries = metrics.counter("db_queries_total", "SQL statements executed")
+db_latency = metrics.histogram("db_query_duration_seconds", "SQL statement latency")
+request_queries = metrics.histogram(
+    "http_request_db_queries", "SQL statements issued per request", ("route",), QUERY_COUNT_BUCKETS)
+request_db_time = metrics.histogram(
+    "http_request_db_seconds", "Time spent in SQL per request", ("route",))
+loop_lag = metrics.histogram("event_loop_lag_seconds", "Event loop scheduling delay")
+startup_seconds = metrics.gauge("app_startup_seconds", "Time from import to serving for this worker")
+startup_phase_seconds = metrics.gauge(
+    "app_startup_phase_seconds", "Time this worker spent in each startup phase", ("phase",))
+
+# [queries, seconds] for the request being served, if any. Statements run
+# by background tasks (e.g. the write queue) only count towards the totals.
+_request_db_stats: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar(
+    "request_db_stats", default=None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._metrics_started
+    db_queries.inc()
+    db_latency.observe(elapsed)
+    stats = _request_db_stats.get()
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += elapsed
+
+
+def route_template(scope) -> str:
+    """Path template of the route that served ``scope`` (after routing).
+
+    Labelling by template (``/devices/{device_id}``) keeps label cardinality
+    bounded; unmatched paths share one label.
+    """
+    app = scope["app"]
+    routes = getattr(app.state, "route_templates", None)
+    if routes is None:
+        routes = app.state.route_templates = {
+            route.endpoint: route.path for route in app.routes if hasattr(route, "endpoint")
+        }
+    return routes.get(scope.get("endpoint"), "unmatched")
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, status and SQL use per route."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = [0, 0.0]
+        token = _request_db_stats.set(stats)
+        http_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_in_flight.inc(-1)
+            _request_db_stats.reset(token)
+            route = route_template(scope)
+            method = scope["method"]
+            http_requests.inc(labels=(method, route, str(status)))
+            http_latency.observe(elapsed, (method, route))
+            request_queries.observe(stats[0], (route,))
+            request_db_time.observe(stats[1], (route,))
+            if stats[0] > QUERY_WARN_THRESHOLD:
+                logger.warning(f"{method} {route} issued {stats[0]} SQL statements")
+
+
+async def monitor_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    """Record how late the loop wakes from a fixed sleep."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        loop_lag.observe(max(0.0, loop.time() - started - interval))
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+from metrics import route_template
+
+logger = logging.getLogger(__name__)
+
+# Off unless enabled; when on, admins start and stop sessions over the API
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "").lower() in ("1", "true", "yes")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.005"))  # seconds between samples
+MAX_STACK_DEPTH = 128
+
+# Tasks the event loop thread is currently running (CPython keeps this map
+# for asyncio.current_task); without it every sample is tagged "loop"
+_current_tasks = getattr(asyncio.tasks, "_current_tasks", {})
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Samples the event loop thread's stack while a session is running.
+
+    A session profiles ``sample_rate`` of the requests that start during it,
+    for ``duration`` seconds. Every ``interval`` a sampler thread captures the
+    loop thread's stack and attributes it to the request whose task is
+    running; with ``sample_rate`` 1 the remaining samples are kept as
+    ``loop`` (callbacks and background tasks). When the session ends, each
+    route's samples are written to ``<output_dir>/<session>-<route>.collapsed``
+    in collapsed-stack format, which flamegraph.pl and speedscope read
+    directly. While no session runs the only cost is one attribute check
+    per request.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL, output_dir: str = PROFILE_DIR):
+        self.interval = interval
+        self.output_dir = output_dir
+        self.active = False
+        self.sample_rate = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._session: Optional[str] = None
+        self._deadline = 0.0
+        self._tasks: Dict[asyncio.Task, Counter] = {}
+        self._routes: Dict[str, Counter] = {}
+        self._samples = 0
+        self.last_files: List[str] = []
+
+    def status(self) -> dict:
+        return {
+            "active": self.active,
+            "session": self._session,
+            "sample_rate": self.sample_rate,
+            "remaining": max(0.0, self._deadline - time.time()) if self.active else 0.0,
+            "samples": self._samples,
+            "last_files": self.last_files,
+        }
+
+    def start(self, sample_rate: float, duration: float):
+        """Start a session; must be called from the event loop thread."""
+        with self._lock:
+            if self.active:
+                raise RuntimeError("A profiling session is already running")
+            self._loop = asyncio.get_running_loop()
+            self._loop_thread_id = threading.get_ident()
+            self._session = time.strftime("%Y%m%d-%H%M%S")
+            self._deadline = time.time() + duration
+            self._tasks, self._routes, self._samples = {}, {}, 0
+            self.sample_rate = sample_rate
+            self._stop.clear()
+            self.active = True
+            self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> List[str]:
+        """End the session (if any) and return the profile files written."""
+        thread = self._thread
+        self._stop.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        return self.last_files
+
+    def should_profile(self) -> bool:
+        return self.active and (self.sample_rate >= 1 or random.random() < self.sample_rate)
+
+    def track(self, task: asyncio.Task):
+        with self._lock:
+            self._tasks[task] = Counter()
+
+    def untrack(self, task: asyncio.Task, route: str):
+        with self._lock:
+            stacks = self._tasks.pop(task, None)
+            if stacks:
+                self._routes.setdefault(route, Counter()).update(stacks)
+
+    def _sample(self):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        stack = []
+        while frame is not None and len(stack) < MAX_STACK_DEPTH:
+            stack.append(_frame_name(frame))
+            frame = frame.f_back
+        collapsed = ";".join(reversed(stack))
+        task = _current_tasks.get(self._loop)
+        with self._lock:
+            stacks = self._tasks.get(task)
+            if stacks is None:
+                if self.sample_rate < 1:
+                    return
+                stacks = self._routes.setdefault("loop", Counter())
+            stacks[collapsed] += 1
+            self._samples += 1
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval):
+                if time.time() >= self._deadline:
+                    break
+                self._sample()
+        except Exception as e:
+            logger.error(f"Profiler sampling failed: {str(e)}")
+        finally:
+            self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self.active = False
+            # Requests still in flight keep their partial samples
+            for stacks in self._tasks.values():
+                if stacks:
+                    self._routes.setdefault("in-flight", Counter()).update(stacks)
+            routes, self._routes, self._tasks = self._routes, {}, {}
+            self._thread = None
+        files = []
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            for route, stacks in routes.items():
+                slug = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+                path = os.path.join(self.output_dir, f"{self._session}-{slug}.collapsed")
+                with open(path, "w") as f:
+                    for stack, count in stacks.most_common():
+                        f.write(f"{stack} {count}\n")
+                files.append(path)
+        except OSError as e:
+            logger.error(f"Error writing profiles: {str(e)}")
+        self.last_files = files
+        logger.info(f"Profiling session {self._session} wrote {len(files)} profiles")
+
+
+profiler = SamplingProfiler()
+
+
+class ProfilerMiddleware:
+    """Marks sampled requests so the profiler attributes stacks to them."""
+
+    def __init__(self, app, profiler: SamplingProfiler = profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.profiler.should_profile():
+            await self.app(scope, receive, send)
+            return
+        task = asyncio.current_task()
+        self.profiler.track(task)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.profiler.untrack(task, route_template(scope))
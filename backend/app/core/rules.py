@@ -0,0 +1,460 @@
+import asyncio
+import heapq
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Hashable, List, NamedTuple, Optional, Set, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import AsyncSessionLocal, AutomationRule, Device, PROPERTY_COLUMNS, merge_properties
+from events import device_events, TRACKED_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# Trigger operators fire when a value changes into the matching state
+# ("above" fires as the value crosses the threshold, not on every sample
+# above it); condition operators test the current state
+TRIGGER_OPS = ("changes", "equals", "above", "below")
+CONDITION_OPS = ("equals", "not_equals", "above", "below")
+
+# autoOffDelay is in minutes; devices with autoOff but no delay use this
+DEFAULT_AUTO_OFF_DELAY = 30
+MAX_SLEEP = 60
+
+# (device_id, command, value), as for the scheduler
+Action = Tuple[str, str, object]
+
+
+class RuleError(ValueError):
+    """A rule definition that can't be compiled."""
+
+
+def _predicate(op: str, operand) -> Callable[[object], bool]:
+    if op == "equals":
+        return lambda value: value == operand
+    if op == "not_equals":
+        return lambda value: value != operand
+    if op in ("above", "below"):
+        if not isinstance(operand, (int, float)) or isinstance(operand, bool):
+            raise RuleError(f"'{op}' needs a numeric value")
+        if op == "above":
+            return lambda value: isinstance(value, (int, float)) and value > operand
+        return lambda value: isinstance(value, (int, float)) and value < operand
+    raise RuleError(f"Unknown operator {op!r}")
+
+
+class CompiledRule(NamedTuple):
+    id: int
+    owner_id: int
+    device_id: str
+    property: str
+    # Whether a change from the first value to the second fires the rule
+    fires: Callable[[object, object], bool]
+    conditions: Tuple[Tuple[str, str, Callable[[object], bool]], ...]
+    actions: Tuple[Tuple[Action, float], ...]
+
+
+def compile_rule(rule_id: int, owner_id: int, definition: dict) -> CompiledRule:
+    """Turn a stored definition into predicates, once, when rules are loaded.
+
+    ``{"trigger": {"device_id", "property", "op", "value"},
+    "conditions": [{"device_id", "property", "op", "value"}],
+    "actions": [{"device_id", "command", "value", "delay"}]}``; ``delay``
+    (seconds) is debounced: a rule firing again restarts it.
+    """
+    try:
+        trigger = definition["trigger"]
+        op = trigger.get("op", "changes")
+        if op not in TRIGGER_OPS:
+            raise RuleError(f"Unknown trigger operator {op!r}")
+        if op == "changes":
+            fires = lambda old, new: True  # noqa: E731
+        else:
+            matches = _predicate(op, trigger.get("value"))
+            fires = lambda old, new: matches(new) and not matches(old)  # noqa: E731
+        conditions = []
+        for condition in definition.get("conditions") or ():
+            if condition.get("op") not in CONDITION_OPS:
+                raise RuleError(f"Unknown condition operator {condition.get('op')!r}")
+            conditions.append((
+                condition["device_id"], condition["property"],
+                _predicate(condition["op"], condition.get("value")),
+            ))
+        actions = tuple(
+            ((action["device_id"], action["command"], action.get("value")), float(action.get("delay") or 0))
+            for action in definition["actions"]
+        )
+        if not actions:
+            raise RuleError("A rule needs at least one action")
+        return CompiledRule(
+            rule_id, owner_id, trigger["device_id"], trigger["property"],
+            fires, tuple(conditions), actions,
+        )
+    except (KeyError, TypeError, AttributeError) as e:
+        raise RuleError(f"Invalid rule definition: {str(e)}") from e
+
+
+def rule_devices(rule: CompiledRule) -> Set[str]:
+    """Devices whose state a rule reads: its trigger's and its conditions'."""
+    return {rule.device_id, *(device_id for device_id, _, _ in rule.conditions)}
+
+
+class TimerQueue:
+    """Debounced timers in a min-heap keyed by due time.
+
+    Arming a key that is already armed replaces its timer; the old heap
+    entry is skipped when popped (lazy deletion, as in the scheduler).
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._timers: Dict[Hashable, Tuple[int, Action]] = {}
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._timers)
+
+    def arm(self, key: Hashable, delay: float, action: Action, now: Optional[float] = None) -> bool:
+        """(Re)start ``key``'s timer; True if it is now the earliest."""
+        self._generation += 1
+        self._timers[key] = (self._generation, action)
+        due = (time.time() if now is None else now) + delay
+        heapq.heappush(self._heap, (due, self._generation, key))
+        if len(self._heap) > 2 * len(self._timers) + 1024:
+            self._heap = [item for item in self._heap if self._timers.get(item[2], (None,))[0] == item[1]]
+            heapq.heapify(self._heap)
+        return self._heap[0][2] == key
+
+    def cancel(self, key: Hashable):
+        self._timers.pop(key, None)
+
+    def pop_due(self, now: float) -> List[Action]:
+        actions = []
+        while self._heap and self._heap[0][0] <= now:
+            _, generation, key = heapq.heappop(self._heap)
+            timer = self._timers.get(key)
+            if timer is not None and timer[0] == generation:
+                del self._timers[key]
+                actions.append(timer[1])
+        return actions
+
+    def next_due(self) -> Optional[float]:
+        while self._heap:
+            due, generation, key = self._heap[0]
+            timer = self._timers.get(key)
+            if timer is not None and timer[0] == generation:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+
+# What the engine keeps of a device: its tracked fields and properties
+STATE_COLUMNS = (
+    Device.device_id, *(getattr(Device, f) for f in TRACKED_FIELDS if f != "properties"),
+    *(getattr(Device, c) for c in PROPERTY_COLUMNS), Device.extra,
+)
+
+
+def auto_off_delay(properties: dict) -> Optional[float]:
+    """Seconds until an idle device is switched off, or None if it isn't."""
+    if not properties.get("autoOff"):
+        return None
+    try:
+        minutes = float(properties.get("autoOffDelay") or DEFAULT_AUTO_OFF_DELAY)
+    except (TypeError, ValueError):
+        minutes = DEFAULT_AUTO_OFF_DELAY
+    return max(0.0, minutes * 60)
+
+
+class RulesEngine:
+    """Evaluates automation rules as device changes are committed.
+
+    Rules are indexed by their trigger's (device_id, property), so a change
+    only evaluates the rules watching a property that actually changed.
+    The engine keeps the last known state of every device a rule refers
+    to, for edge detection and conditions. Actions fired together, and due
+    timers, are handed to ``execute`` as one batch (one transaction).
+
+    Devices whose settings enable ``autoOff`` are switched off after
+    ``autoOffDelay`` minutes without a change; every change while the
+    device is on (including motion reports) restarts the timer.
+    """
+
+    def __init__(self, session_factory=AsyncSessionLocal):
+        self._session_factory = session_factory
+        self._rules: Dict[int, CompiledRule] = {}
+        self._index: Dict[Tuple[str, str], List[CompiledRule]] = {}
+        self._trigger_properties: Dict[str, Set[str]] = {}
+        # device_id -> number of rules referring to it
+        self._watched: Dict[str, int] = {}
+        # device_id -> (tracked fields, properties) for devices rules refer to
+        self._state: Dict[str, Tuple[dict, dict]] = {}
+        # device_id -> [delay, status] for devices with autoOff enabled
+        self._auto_off: Dict[str, list] = {}
+        self._timers = TimerQueue()
+        self._pending: List[Action] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._reload_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._execute: Optional[Callable[[List[Action]], Awaitable[None]]] = None
+        self.rules = 0
+        self.fired = 0
+
+    @staticmethod
+    def _value(state: Tuple[dict, dict], prop: str):
+        fields, properties = state
+        return fields.get(prop) if prop in TRACKED_FIELDS else properties.get(prop)
+
+    async def rebuild(self):
+        """Load and compile every enabled rule and the state they refer to."""
+        started = time.perf_counter()
+        rules = []
+        async with self._session_factory() as db:
+            rows = await db.execute(
+                select(AutomationRule.id, AutomationRule.owner_id, AutomationRule.definition)
+                .where(AutomationRule.enabled == True)  # noqa: E712
+            )
+            for rule_id, owner_id, definition in rows:
+                try:
+                    rules.append(compile_rule(rule_id, owner_id, definition))
+                except RuleError as e:
+                    logger.warning(f"Skipping automation rule {rule_id}: {str(e)}")
+            state = await self._load_state(db, set().union(*map(rule_devices, rules)))
+            auto_off = {}
+            rows = await db.execute(
+                select(*STATE_COLUMNS).where(Device.extra["autoOff"].as_boolean() == True)  # noqa: E712
+            )
+            for row in rows.mappings():
+                delay = auto_off_delay(row["extra"] or {})
+                if delay is not None:
+                    auto_off[row["device_id"]] = [delay, row["status"]]
+
+        self._rules, self._index, self._trigger_properties, self._watched = {}, {}, {}, {}
+        for rule in rules:
+            self._add(rule)
+        self._state = state
+        self._auto_off = auto_off
+        for device_id, (delay, status) in auto_off.items():
+            if status == "on":
+                self._timers.arm(("auto_off", device_id), delay, (device_id, "status", "off"))
+        self.rules = len(self._rules)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        logger.info(
+            f"Compiled {self.rules} automation rules and {len(auto_off)} auto-off devices "
+            f"in {time.perf_counter() - started:.3f}s"
+        )
+
+    async def _load_state(self, db: AsyncSession, device_ids: Set[str]) -> Dict[str, Tuple[dict, dict]]:
+        state = {}
+        if device_ids:
+            rows = await db.execute(select(*STATE_COLUMNS).where(Device.device_id.in_(device_ids)))
+            for row in rows.mappings():
+                state[row["device_id"]] = self._row_state(row)
+        return state
+
+    @staticmethod
+    def _row_state(row) -> Tuple[dict, dict]:
+        fields = {field: row[field] for field in TRACKED_FIELDS if field != "properties"}
+        return fields, merge_properties(row, row["extra"])
+
+    def _add(self, rule: CompiledRule):
+        self._rules[rule.id] = rule
+        self._index.setdefault((rule.device_id, rule.property), []).append(rule)
+        self._trigger_properties.setdefault(rule.device_id, set()).add(rule.property)
+        for device_id in rule_devices(rule):
+            self._watched[device_id] = self._watched.get(device_id, 0) + 1
+
+    def _remove(self, rule_id: int):
+        rule = self._rules.pop(rule_id, None)
+        if rule is None:
+            return
+        key = (rule.device_id, rule.property)
+        # Replaced, not mutated: a change being evaluated may be iterating it
+        remaining = [other for other in self._index[key] if other.id != rule_id]
+        if remaining:
+            self._index[key] = remaining
+        else:
+            del self._index[key]
+            properties = self._trigger_properties[rule.device_id]
+            properties.discard(rule.property)
+            if not properties:
+                del self._trigger_properties[rule.device_id]
+        for device_id in rule_devices(rule):
+            self._watched[device_id] -= 1
+            if not self._watched[device_id]:
+                del self._watched[device_id]
+                self._state.pop(device_id, None)
+        for index in range(len(rule.actions)):
+            self._timers.cancel(("rule", rule_id, index))
+
+    def reload(self, rule_id: int):
+        """Recompile one rule after it changed; a no-op unless the engine runs here.
+
+        Only that rule's index entries and pending delayed actions are
+        replaced; other rules, their timers and auto-off countdowns keep
+        running.
+        """
+        if self._task is not None:
+            asyncio.create_task(self._reload(rule_id))
+
+    async def _reload(self, rule_id: int):
+        # One at a time, so a rule changed twice in quick succession ends
+        # up at its latest definition
+        async with self._reload_lock:
+            try:
+                async with self._session_factory() as db:
+                    row = (await db.execute(
+                        select(AutomationRule.owner_id, AutomationRule.definition)
+                        .where(AutomationRule.id == rule_id, AutomationRule.enabled == True)  # noqa: E712
+                    )).first()
+                    rule, devices = None, set()
+                    if row is not None:
+                        try:
+                            rule = compile_rule(rule_id, row.owner_id, row.definition)
+                            devices = rule_devices(rule)
+                        except RuleError as e:
+                            logger.warning(f"Skipping automation rule {rule_id}: {str(e)}")
+                    state = await self._load_state(db, devices - self._state.keys())
+            except Exception as e:
+                logger.error(f"Error reloading automation rule {rule_id}: {str(e)}")
+                return
+            # State kept up to date by events is newer than what was loaded
+            state.update((device_id, self._state[device_id]) for device_id in devices if device_id in self._state)
+            self._remove(rule_id)
+            if rule is not None:
+                self._add(rule)
+                for device_id, device_state in state.items():
+                    self._state.setdefault(device_id, device_state)
+            self.rules = len(self._rules)
+
+    def _on_device_change(self, user_id: int, device_id: str, changes: dict):
+        state = self._state.get(device_id)
+        if state is None and device_id in self._watched:
+            # Created since the rules were loaded
+            state = self._state[device_id] = ({}, {})
+        if state is not None:
+            watched = self._trigger_properties.get(device_id, ())
+            previous = {prop: self._value(state, prop) for prop in watched}
+            fields, properties = state
+            fields.update((key, value) for key, value in changes.items() if key in TRACKED_FIELDS and key != "properties")
+            if "properties" in changes:
+                state = self._state[device_id] = (fields, dict(changes["properties"]))
+            for prop in watched:
+                old, new = previous[prop], self._value(state, prop)
+                if old == new:
+                    continue
+                for rule in self._index.get((device_id, prop), ()):
+                    if rule.owner_id == user_id and rule.fires(old, new) and self._conditions_hold(rule):
+                        self._fire(rule)
+        self._update_auto_off(device_id, changes)
+
+    def _conditions_hold(self, rule: CompiledRule) -> bool:
+        for device_id, prop, test in rule.conditions:
+            state = self._state.get(device_id)
+            if state is None or not test(self._value(state, prop)):
+                return False
+        return True
+
+    def _fire(self, rule: CompiledRule):
+        self.fired += 1
+        for index, (action, delay) in enumerate(rule.actions):
+            if delay > 0:
+                self._arm(("rule", rule.id, index), delay, action)
+            else:
+                self._queue([action])
+
+    def _update_auto_off(self, device_id: str, changes: dict):
+        entry = self._auto_off.get(device_id)
+        properties = changes.get("properties")
+        if properties is not None:
+            delay = auto_off_delay(properties)
+            if delay is None:
+                if entry is not None:
+                    del self._auto_off[device_id]
+                    self._timers.cancel(("auto_off", device_id))
+                return
+            if entry is None:
+                entry = self._auto_off[device_id] = [delay, changes.get("status")]
+                if entry[1] is None:
+                    # Just enabled on a device whose status this change doesn't carry
+                    asyncio.create_task(self._load_status(device_id))
+                    return
+            entry[0] = delay
+        if entry is None:
+            return
+        if "status" in changes:
+            entry[1] = changes["status"]
+        if entry[1] == "on":
+            self._arm(("auto_off", device_id), entry[0], (device_id, "status", "off"))
+        else:
+            self._timers.cancel(("auto_off", device_id))
+
+    async def _load_status(self, device_id: str):
+        try:
+            async with self._session_factory() as db:
+                status = await db.scalar(select(Device.status).where(Device.device_id == device_id))
+        except Exception as e:
+            logger.error(f"Error loading status of device {device_id}: {str(e)}")
+            return
+        entry = self._auto_off.get(device_id)
+        if entry is not None and entry[1] is None:
+            self._update_auto_off(device_id, {"status": status})
+
+    def _arm(self, key: Hashable, delay: float, action: Action):
+        if self._timers.arm(key, delay, action) and self._wakeup is not None:
+            self._wakeup.set()
+
+    def _queue(self, actions: List[Action]):
+        # Everything fired while handling one batch of events runs together
+        if not self._pending:
+            asyncio.get_running_loop().call_soon(self._flush)
+        self._pending.extend(actions)
+
+    def _flush(self):
+        actions, self._pending = self._pending, []
+        if actions:
+            asyncio.create_task(self._run_actions(actions))
+
+    async def _run_actions(self, actions: List[Action]):
+        try:
+            await self._execute(actions)
+        except Exception as e:
+            logger.error(f"Error running automation actions: {str(e)}")
+
+    async def start(self, execute: Callable[[List[Action]], Awaitable[None]]):
+        if self._task is not None:
+            return
+        self._execute = execute
+        self._wakeup = asyncio.Event()
+        await self.rebuild()
+        device_events.add_listener(self._on_device_change)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        device_events.remove_listener(self._on_device_change)
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            due = self._timers.pop_due(time.time())
+            if due:
+                self._queue(due)
+            next_due = self._timers.next_due()
+            delay = MAX_SLEEP if next_due is None else min(MAX_SLEEP, max(0.0, next_due - time.time()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+
+rules_engine = RulesEngine()
@@ -0,0 +1,210 @@
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime, timedelta, time as dtime
+from typing import Awaitable, Callable, Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import select
+
+from database import AsyncSessionLocal, Device
+from events import device_events
+
+logger = logging.getLogger(__name__)
+
+# Schedule actions as (command, value) for the device command helpers
+SCHEDULE_ACTIONS = {
+    "on": ("status", "on"),
+    "off": ("status", "off"),
+    "lock": ("lock", True),
+    "unlock": ("lock", False),
+}
+DAY_INDEX = {"mon": 0, "tue": 1, "wed": 2, "thu": 3, "fri": 4, "sat": 5, "sun": 6}
+
+# Longest the tick loop sleeps without re-checking, and the most due actions
+# handed to the executor in one call (one write transaction each)
+MAX_SLEEP = 60
+FIRE_BATCH_SIZE = 500
+
+# (device_id, command, value)
+Action = Tuple[str, str, object]
+
+
+class ParsedSchedule(NamedTuple):
+    minute_of_day: int
+    days: FrozenSet[int]
+    action: str
+
+
+def parse_schedule(schedule: Optional[dict]) -> Optional[ParsedSchedule]:
+    """Return the fireable form of a stored schedule, or None if it never fires."""
+    if not schedule or not schedule.get("enabled"):
+        return None
+    try:
+        hours, minutes = (int(part) for part in str(schedule["time"]).split(":")[:2])
+        days = frozenset(DAY_INDEX[str(day).strip().lower()[:3]] for day in schedule.get("days") or ())
+    except (KeyError, ValueError):
+        return None
+    action = str(schedule.get("action", "")).lower()
+    if not days or action not in SCHEDULE_ACTIONS or not (0 <= hours < 24 and 0 <= minutes < 60):
+        return None
+    return ParsedSchedule(hours * 60 + minutes, days, action)
+
+
+def next_fire_time(schedule: ParsedSchedule, after: float) -> Optional[float]:
+    """First local time strictly after ``after`` that matches the schedule."""
+    start = datetime.fromtimestamp(after)
+    at = dtime(schedule.minute_of_day // 60, schedule.minute_of_day % 60)
+    for offset in range(8):
+        day = start.date() + timedelta(days=offset)
+        if day.weekday() not in schedule.days:
+            continue
+        fire = datetime.combine(day, at).timestamp()
+        if fire > after:
+            return fire
+    return None
+
+
+class DeviceScheduler:
+    """Fires device schedules from a min-heap keyed by next fire time.
+
+    Each indexed device has one live heap entry; changing or removing a
+    schedule bumps the device's generation so its old entry is skipped when
+    popped (lazy deletion). Popping a due entry and pushing its next
+    occurrence are both O(log n). Due actions are handed to ``execute`` in
+    batches so they are applied as grouped device updates.
+    """
+
+    def __init__(self, session_factory=AsyncSessionLocal):
+        self._session_factory = session_factory
+        self._heap: List[Tuple[float, int, str]] = []
+        self._entries: Dict[str, Tuple[int, ParsedSchedule]] = {}
+        self._generation = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._execute: Optional[Callable[[List[Action]], Awaitable[None]]] = None
+        self.fired = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _push(self, device_id: str, generation: int, schedule: ParsedSchedule, after: float):
+        fire_at = next_fire_time(schedule, after)
+        if fire_at is not None:
+            heapq.heappush(self._heap, (fire_at, generation, device_id))
+
+    def set(self, device_id: str, schedule: Optional[dict], now: Optional[float] = None):
+        """Index (or re-index) a device's stored schedule."""
+        parsed = parse_schedule(schedule)
+        current = self._entries.get(device_id)
+        if current is not None and current[1] == parsed:
+            return
+        if parsed is None:
+            self.remove(device_id)
+            return
+        self._generation += 1
+        self._entries[device_id] = (self._generation, parsed)
+        self._push(device_id, self._generation, parsed, time.time() if now is None else now)
+        if len(self._heap) > 2 * len(self._entries) + 1024:
+            self._compact()
+        if self._wakeup is not None and self._heap and self._heap[0][2] == device_id:
+            self._wakeup.set()
+
+    def remove(self, device_id: str):
+        self._entries.pop(device_id, None)
+
+    def _compact(self):
+        self._heap = [
+            item for item in self._heap
+            if self._entries.get(item[2], (None,))[0] == item[1]
+        ]
+        heapq.heapify(self._heap)
+
+    def pop_due(self, now: float) -> List[Action]:
+        actions = []
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, generation, device_id = heapq.heappop(self._heap)
+            entry = self._entries.get(device_id)
+            if entry is None or entry[0] != generation:
+                continue
+            actions.append((device_id, *SCHEDULE_ACTIONS[entry[1].action]))
+            self._push(device_id, generation, entry[1], fire_at)
+        return actions
+
+    def next_fire(self) -> Optional[float]:
+        while self._heap:
+            fire_at, generation, device_id = self._heap[0]
+            entry = self._entries.get(device_id)
+            if entry is not None and entry[0] == generation:
+                return fire_at
+            heapq.heappop(self._heap)
+        return None
+
+    async def rebuild(self):
+        """Re-index every enabled schedule from the database."""
+        started = time.perf_counter()
+        now = time.time()
+        entries, heap = {}, []
+        async with self._session_factory() as db:
+            rows = await db.stream(
+                select(Device.device_id, Device.extra["schedule"])
+                .where(Device.extra["schedule"]["enabled"].as_boolean() == True)  # noqa: E712
+            )
+            async for device_id, schedule in rows:
+                parsed = parse_schedule(schedule)
+                if parsed is None:
+                    continue
+                self._generation += 1
+                entries[device_id] = (self._generation, parsed)
+                fire_at = next_fire_time(parsed, now)
+                if fire_at is not None:
+                    heap.append((fire_at, self._generation, device_id))
+        heapq.heapify(heap)
+        self._entries, self._heap = entries, heap
+        logger.info(f"Indexed {len(entries)} device schedules in {time.perf_counter() - started:.3f}s")
+
+    def _on_device_change(self, user_id: int, device_id: str, changes: dict):
+        properties = changes.get("properties")
+        if properties is not None:
+            self.set(device_id, properties.get("schedule"))
+
+    async def start(self, execute: Callable[[List[Action]], Awaitable[None]]):
+        if self._task is not None:
+            return
+        self._execute = execute
+        self._wakeup = asyncio.Event()
+        await self.rebuild()
+        device_events.add_listener(self._on_device_change)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        device_events.remove_listener(self._on_device_change)
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            due = self.pop_due(time.time())
+            for i in range(0, len(due), FIRE_BATCH_SIZE):
+                batch = due[i:i + FIRE_BATCH_SIZE]
+                try:
+                    await self._execute(batch)
+                    self.fired += len(batch)
+                except Exception as e:
+                    logger.error(f"Error running scheduled actions: {str(e)}")
+            next_fire = self.next_fire()
+            delay = MAX_SLEEP if next_fire is None else min(MAX_SLEEP, max(0.0, next_fire - time.time()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+
+device_scheduler = DeviceScheduler()
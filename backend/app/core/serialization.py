@@ -0,0 +1,62 @@
+import os
+from typing import Callable, Iterable, Mapping, Optional, Sequence
+
+import orjson
+
+from cache import TTLCache
+from database import merge_properties
+
+# Encoded device documents kept for reuse, keyed by (device_id, version)
+DEVICE_FRAGMENT_CACHE_SIZE = int(os.environ.get("DEVICE_FRAGMENT_CACHE_SIZE", "10000"))
+DEVICE_FRAGMENT_CACHE_TTL = 3600
+
+DEVICE_FIELDS = ("device_id", "name", "type", "status", "properties")
+
+
+class DeviceEncoder:
+    """Encodes device rows straight to JSON bytes in the ``Device`` shape.
+
+    Produces the same document as validating the row through the pydantic
+    response model, without building model instances: ``property_keys`` is
+    the response model's property order, so unset properties still appear
+    as null. Full documents are cached per (device_id, version); every
+    committed change bumps the version, so a mutated device never hits a
+    stale fragment.
+    """
+
+    def __init__(self, property_keys: Iterable[str],
+                 cache_size: int = DEVICE_FRAGMENT_CACHE_SIZE):
+        self.property_keys = tuple(property_keys)
+        self._fragments = TTLCache(maxsize=cache_size, ttl=DEVICE_FRAGMENT_CACHE_TTL)
+        self.hits = 0
+        self.misses = 0
+
+    def document(self, row: Mapping, fields: Sequence[str] = DEVICE_FIELDS,
+                 overlay: Optional[dict] = None) -> dict:
+        data = {field: row[field] for field in fields if field != "properties"}
+        if "properties" in fields:
+            properties = merge_properties(row, row["extra"])
+            if overlay:
+                properties.update(overlay)
+            data["properties"] = {key: properties.get(key) for key in self.property_keys}
+        return data
+
+    def encode(self, row: Mapping, fields: Sequence[str] = DEVICE_FIELDS,
+               overlay: Optional[dict] = None) -> bytes:
+        if overlay or fields != DEVICE_FIELDS:
+            return orjson.dumps(self.document(row, fields, overlay))
+        key = (row["device_id"], row["version"])
+        fragment = self._fragments.get(key)
+        if fragment is None:
+            self.misses += 1
+            fragment = orjson.dumps(self.document(row))
+            self._fragments.set(key, fragment)
+        else:
+            self.hits += 1
+        return fragment
+
+    def encode_list(self, rows: Iterable[Mapping], fields: Sequence[str] = DEVICE_FIELDS,
+                    overlay: Callable[[str], Optional[dict]] = lambda device_id: None) -> bytes:
+        return b"[" + b",".join(
+            self.encode(row, fields, overlay(row["device_id"])) for row in rows
+        ) + b"]"
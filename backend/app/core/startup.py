@@ -0,0 +1,66 @@
+import functools
+import logging
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+# Phases slower than this are called out when the report is logged (seconds)
+SLOW_PHASE = 2.0
+
+
+class StartupReport:
+    """Where a process spent its time between starting to import the app
+    and serving its first request.
+
+    The clock starts when this module is imported, so the app imports it
+    first. ``mark`` records the time since the previous mark (e.g. the
+    imports); ``timed`` wraps a startup handler and records its duration.
+    """
+
+    def __init__(self):
+        self.started = self._last_mark = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.ready: float = 0.0
+
+    def record(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def mark(self, name: str):
+        now = time.perf_counter()
+        self.record(name, now - self._last_mark)
+        self._last_mark = now
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def timed(self, name: str):
+        """Decorate an async startup handler to record it as phase ``name``."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return await fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def finish(self) -> float:
+        """Mark the process ready; returns the seconds since the clock started."""
+        self.ready = time.perf_counter() - self.started
+        return self.ready
+
+    def log(self):
+        phases = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in self.phases.items())
+        logger.info(f"Started in {self.ready:.3f}s ({phases})")
+        for name, seconds in self.phases.items():
+            if seconds > SLOW_PHASE:
+                logger.warning(f"Startup phase {name} took {seconds:.3f}s")
+
+
+startup_report = StartupReport()
@@ -0,0 +1,175 @@
+"""Access tokens shared by every service.
+
+Tokens are HS256 JWTs whose header names the signing key (``kid``), so keys
+can be rotated without invalidating tokens that are still live: add the new
+key to ``TOKEN_KEYS``, point ``TOKEN_ACTIVE_KID`` at it, and drop the old
+key once its tokens have expired. The payload carries everything a
+read-only route needs to authorize (user id, username, scopes), so those
+routes don't load the user. This module only depends on python-jose, so any
+service can import it.
+"""
+import logging
+import os
+import secrets
+import threading
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, Optional
+
+from jose import JWTError, jwt
+
+logger = logging.getLogger(__name__)
+
+ALGORITHM = "HS256"
+ACCESS_TOKEN_EXPIRE_MINUTES = 30
+DEFAULT_EXPIRE_MINUTES = 15
+# Longest lifetime a token can have; revocations are dropped after this
+MAX_TOKEN_LIFETIME = ACCESS_TOKEN_EXPIRE_MINUTES * 60
+
+# Decoded tokens kept so repeat requests skip the signature check
+TOKEN_CACHE_SIZE = 10000
+
+SCOPES = ("devices:read", "devices:write", "settings")
+
+# Development key, used only when TOKEN_KEYS is not set
+# (to get a string like this run: openssl rand -hex 32)
+DEV_KEYS = {"dev": "09d25e094faa6ca2556c818166b7a9563b93f7099f6f0f4caa6cf63b88e8d3e7"}
+
+
+class TokenError(Exception):
+    """The token is malformed, expired, signed with an unknown key or revoked."""
+
+
+@dataclass(frozen=True)
+class TokenClaims:
+    user_id: int
+    username: str
+    scopes: FrozenSet[str]
+    jti: str
+    issued_at: float
+    expires_at: float
+
+
+def parse_keys(spec: str) -> Dict[str, str]:
+    """Parse ``kid:secret,kid:secret`` into a key ring."""
+    keys = {}
+    for entry in spec.split(","):
+        kid, sep, secret = entry.strip().partition(":")
+        if not sep or not kid or not secret:
+            raise ValueError(f"Invalid TOKEN_KEYS entry {entry!r}, expected kid:secret")
+        keys[kid] = secret
+    return keys
+
+
+class KeyRing:
+    """Signing keys by ``kid``; new tokens are signed with ``active_kid``."""
+
+    def __init__(self, keys: Dict[str, str], active_kid: Optional[str] = None):
+        if not keys:
+            raise ValueError("A key ring needs at least one key")
+        self.keys = dict(keys)
+        self.active_kid = active_kid or next(iter(self.keys))
+        if self.active_kid not in self.keys:
+            raise ValueError(f"Unknown active key id {self.active_kid!r}")
+        self._decode_cached = lru_cache(maxsize=TOKEN_CACHE_SIZE)(self._decode)
+
+    @classmethod
+    def from_env(cls) -> "KeyRing":
+        spec = os.environ.get("TOKEN_KEYS")
+        if not spec:
+            logger.warning("TOKEN_KEYS is not set; signing tokens with the development key")
+            return cls(DEV_KEYS)
+        return cls(parse_keys(spec), os.environ.get("TOKEN_ACTIVE_KID"))
+
+    def sign(self, payload: dict) -> str:
+        return jwt.encode(payload, self.keys[self.active_kid], algorithm=ALGORITHM,
+                          headers={"kid": self.active_kid})
+
+    def _decode(self, token: str) -> TokenClaims:
+        try:
+            kid = jwt.get_unverified_header(token).get("kid")
+            key = self.keys.get(kid)
+            if key is None:
+                raise TokenError(f"Unknown signing key {kid!r}")
+            payload = jwt.decode(token, key, algorithms=[ALGORITHM])
+            return TokenClaims(
+                user_id=int(payload["uid"]),
+                username=payload["sub"],
+                scopes=frozenset(payload.get("scope", "").split()),
+                jti=payload["jti"],
+                issued_at=float(payload["iat"]),
+                expires_at=float(payload["exp"]),
+            )
+        except (JWTError, KeyError, TypeError, ValueError) as e:
+            raise TokenError(str(e)) from e
+
+    def decode(self, token: str) -> TokenClaims:
+        """Verify ``token``'s signature and claims; expiry is checked by the caller."""
+        return self._decode_cached(token)
+
+
+class RevocationList:
+    """Revoked token ids and per-user cut-offs, each kept only until every
+    token it could match has expired anyway, so the list stays small."""
+
+    def __init__(self):
+        self._tokens: Dict[str, float] = {}  # jti -> token expiry
+        self._users: Dict[int, tuple] = {}  # user id -> (revoked before, drop at)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tokens) + len(self._users)
+
+    def revoke(self, jti: str, expires_at: float):
+        with self._lock:
+            self._prune()
+            self._tokens[jti] = expires_at
+
+    def revoke_user(self, user_id: int):
+        """Revoke every token issued to ``user_id`` so far."""
+        now = time.time()
+        with self._lock:
+            self._prune()
+            self._users[user_id] = (now, now + MAX_TOKEN_LIFETIME)
+
+    def is_revoked(self, claims: TokenClaims) -> bool:
+        if claims.jti in self._tokens:
+            return True
+        cutoff = self._users.get(claims.user_id)
+        return cutoff is not None and claims.issued_at <= cutoff[0]
+
+    def _prune(self):
+        now = time.time()
+        self._tokens = {jti: exp for jti, exp in self._tokens.items() if exp > now}
+        self._users = {uid: cut for uid, cut in self._users.items() if cut[1] > now}
+
+
+key_ring = KeyRing.from_env()
+revocations = RevocationList()
+
+
+def issue_token(username: str, user_id: int, scopes: Iterable[str] = SCOPES,
+                expires_delta: Optional[timedelta] = None) -> str:
+    now = time.time()
+    lifetime = expires_delta or timedelta(minutes=DEFAULT_EXPIRE_MINUTES)
+    return key_ring.sign({
+        "sub": username,
+        "uid": user_id,
+        "scope": " ".join(scopes),
+        "jti": secrets.token_urlsafe(9),
+        # Sub-second issue times keep a token minted just after a revocation valid
+        "iat": round(now, 3),
+        "exp": int(now + lifetime.total_seconds()),
+    })
+
+
+def verify_token(token: str) -> TokenClaims:
+    """Return the token's claims, raising TokenError if it isn't valid now."""
+    claims = key_ring.decode(token)
+    if claims.expires_at <= time.time():
+        raise TokenError("Token has expired")
+    if revocations.is_revoked(claims):
+        raise TokenError("Token has been revoked")
+    return claims
@@ -0,0 +1,109 @@
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from typing import List
+
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+# Worker processes to serve with (the conventional variable for this)
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", "1"))
+# Seconds a stopping worker gets to finish in-flight requests and run its
+# shutdown handlers, and between starting a new worker and stopping an old
+# one during a reload
+GRACEFUL_TIMEOUT = int(os.environ.get("GRACEFUL_TIMEOUT", "30"))
+RELOAD_STAGGER = float(os.environ.get("RELOAD_STAGGER", "2"))
+
+
+# Workers are started fresh rather than forked, so none inherits the
+# supervisor's threads, event loop or database connections
+_spawn_context = multiprocessing.get_context("spawn")
+
+
+def _serve(config: uvicorn.Config, sockets: list):
+    """Worker process entry point: serve the app on the inherited socket."""
+    config.configure_logging()
+    uvicorn.Server(config).run(sockets=sockets)
+
+
+class WorkerSupervisor:
+    """Runs ``workers`` uvicorn processes accepting on one shared socket.
+
+    SIGHUP reloads gracefully: workers are replaced one at a time, each new
+    one started before an old one is stopped, so the socket is never left
+    without a worker. A stopping worker finishes in-flight requests and
+    runs the app's shutdown handlers (which persist buffered writes).
+    Workers that die are replaced; SIGINT or SIGTERM stops them all.
+
+    Shared state goes through the coordination backend (see
+    coordination.py), but some state stays per worker: each worker has its
+    own control buffer, so a value buffered on one worker is served by the
+    others only once it is flushed (CONTROL_FLUSH_INTERVAL), and the ETag
+    sequence of /devices differs between workers until then; metrics
+    (/metrics) describe only the worker that serves the scrape.
+    """
+
+    def __init__(self, app: str, host: str, port: int, workers: int = WORKERS):
+        self.config = uvicorn.Config(
+            app, host=host, port=port, workers=workers,
+            timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+        )
+        self.workers = workers
+        self.processes: List = []
+        self._exit = threading.Event()
+        self._reload = threading.Event()
+
+    def _spawn(self):
+        process = _spawn_context.Process(target=_serve, args=(self.config, [self._socket]))
+        process.start()
+        self.processes.append(process)
+        logger.info(f"Started worker [{process.pid}]")
+
+    def _stop(self, process):
+        process.terminate()
+        process.join(GRACEFUL_TIMEOUT + 5)
+        if process.is_alive():
+            logger.warning(f"Worker [{process.pid}] did not stop in time; killing it")
+            process.kill()
+            process.join()
+        if process in self.processes:
+            self.processes.remove(process)
+
+    def _rolling_restart(self):
+        logger.info("Reloading workers")
+        for old in list(self.processes):
+            self._spawn()
+            # Give the new worker time to run its startup handlers
+            if self._exit.wait(RELOAD_STAGGER):
+                return
+            self._stop(old)
+
+    def run(self):
+        # The coordination backend must be shared once there are several workers
+        os.environ.setdefault("COORDINATION_BACKEND", "sqlite")
+        self._socket = self.config.bind_socket()
+        signal.signal(signal.SIGINT, lambda *_: self._exit.set())
+        signal.signal(signal.SIGTERM, lambda *_: self._exit.set())
+        signal.signal(signal.SIGHUP, lambda *_: self._reload.set())
+        logger.info(f"Started supervisor [{os.getpid()}] with {self.workers} workers")
+        for _ in range(self.workers):
+            self._spawn()
+        while not self._exit.wait(1):
+            if self._reload.is_set():
+                self._reload.clear()
+                self._rolling_restart()
+                continue
+            for process in list(self.processes):
+                if not process.is_alive():
+                    logger.warning(f"Worker [{process.pid}] exited with {process.exitcode}; replacing it")
+                    self.processes.remove(process)
+                    self._spawn()
+        for process in list(self.processes):
+            process.terminate()
+        for process in list(self.processes):
+            self._stop(process)
+        logger.info("Stopped supervisor")
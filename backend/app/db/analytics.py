@@ -0,0 +1,219 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import func
+
+from database import SessionLocal, Device, TelemetryRollup
+from telemetry import telemetry_store, RESOLUTIONS, RETENTION
+
+ENERGY_PRICE_PER_KWH = 0.12
+
+# timeRange -> (rollup resolution, span, number of chart points, alignment, label format)
+TIME_RANGES = {
+    "24h": ("1h", 86400, 24, 3600, "%H:00"),
+    "week": ("1h", 7 * 86400, 7, 86400, "%a %d"),
+    "7d": ("1h", 7 * 86400, 7, 86400, "%a %d"),
+    "month": ("1h", 30 * 86400, 30, 86400, "%b %d"),
+    "30d": ("1h", 30 * 86400, 30, 86400, "%b %d"),
+    "year": ("1d", 365 * 86400, 12, 86400, "%b %Y"),
+}
+
+# Only the resolutions the time ranges above read from are materialized
+VIEW_RESOLUTIONS = ("1h", "1d")
+# Users whose views are kept; the least recently queried are rebuilt on demand
+VIEW_CACHE_SIZE = int(os.environ.get("ANALYTICS_VIEW_CACHE_SIZE", "10000"))
+
+
+class _EnergyView:
+    """Per-user energy (kWh) by device type, bucketed like the telemetry rollups.
+
+    Each bucket maps to a vector indexed by ``types``; vectors grow when a
+    new device type shows up.
+    """
+
+    def __init__(self):
+        self.types: Dict[str, int] = {}
+        self.buckets: Dict[str, Dict[int, np.ndarray]] = {r: {} for r in VIEW_RESOLUTIONS}
+
+    def type_index(self, device_type: str) -> int:
+        return self.types.setdefault(device_type, len(self.types))
+
+    def add(self, resolution: str, buckets: np.ndarray, type_idx: np.ndarray, energy: np.ndarray):
+        """Accumulate ``energy`` (kWh) rows into their (bucket, type) cells."""
+        if not len(buckets):
+            return
+        keys, inverse = np.unique(buckets, return_inverse=True)
+        width = len(self.types)
+        cells = np.zeros((len(keys), width))
+        np.add.at(cells, (inverse, type_idx), energy)
+        table = self.buckets[resolution]
+        for key, row in zip(keys.tolist(), cells):
+            vector = table.get(key)
+            if vector is None:
+                table[key] = row
+                continue
+            if len(vector) < width:
+                vector = table[key] = np.pad(vector, (0, width - len(vector)))
+            vector += row
+        cutoff = time.time() - RETENTION[resolution]
+        for key in [k for k in table if k < cutoff]:
+            del table[key]
+
+    def matrix(self, resolution: str, start: float, end: float) -> Tuple[np.ndarray, np.ndarray]:
+        """Return ``(bucket_starts, energy[bucket, type])`` for ``start <= bucket < end``."""
+        table = self.buckets[resolution]
+        keys = [k for k in table if start <= k < end]
+        cells = np.zeros((len(keys), len(self.types)))
+        for i, key in enumerate(keys):
+            vector = table[key]
+            cells[i, :len(vector)] = vector
+        return np.asarray(keys, dtype=np.float64), cells
+
+
+class EnergySummary:
+    """Materialized per-user energy view in front of the telemetry rollups.
+
+    A user's view is built once, from one aggregate query over the rollups
+    of all their devices plus the samples not yet flushed, and then kept
+    current by ``record`` as telemetry arrives, so analytics queries cost a
+    few vector operations over the user's buckets regardless of history
+    size. Building queries the database: call ``energy`` and ``by_type``
+    from a worker thread. At most ``VIEW_CACHE_SIZE`` views are kept.
+    """
+
+    def __init__(self, session_factory=SessionLocal, store=telemetry_store,
+                 max_views: int = VIEW_CACHE_SIZE):
+        self._session_factory = session_factory
+        self._store = store
+        self.max_views = max_views
+        self._lock = threading.Lock()
+        self._views: "OrderedDict[int, _EnergyView]" = OrderedDict()
+        # Samples recorded while a user's view is being built, as
+        # (telemetry sequence, device type, samples)
+        self._building: Dict[int, list] = {}
+
+    def _build(self, user_id: int) -> Tuple[int, _EnergyView]:
+        """Build a view; returns it with the telemetry sequence it includes."""
+        view = _EnergyView()
+        db = self._session_factory()
+        try:
+            types = dict(db.query(Device.device_id, Device.type).filter(Device.owner_id == user_id).all())
+            with self._store.snapshot(types) as (sequence, unflushed):
+                rows = (
+                    db.query(Device.type, TelemetryRollup.resolution, TelemetryRollup.bucket,
+                             func.sum(TelemetryRollup.energy_sum))
+                    .join(TelemetryRollup, TelemetryRollup.device_id == Device.device_id)
+                    .filter(Device.owner_id == user_id, TelemetryRollup.resolution.in_(VIEW_RESOLUTIONS))
+                    .group_by(Device.type, TelemetryRollup.resolution, TelemetryRollup.bucket)
+                    .all()
+                )
+        finally:
+            db.close()
+        for device_id, deltas in unflushed.items():
+            rows.extend(
+                (types[device_id], resolution, bucket, delta.energy_sum)
+                for (resolution, bucket), delta in deltas.items()
+                if resolution in VIEW_RESOLUTIONS
+            )
+        for resolution in VIEW_RESOLUTIONS:
+            selected = [row for row in rows if row[1] == resolution]
+            view.add(
+                resolution,
+                np.asarray([bucket for _, _, bucket, _ in selected], dtype=np.int64),
+                np.asarray([view.type_index(device_type or "other") for device_type, _, _, _ in selected],
+                           dtype=np.int64),
+                np.asarray([energy for _, _, _, energy in selected], dtype=np.float64) / 1000.0,
+            )
+        return sequence, view
+
+    def _view(self, user_id: int) -> _EnergyView:
+        with self._lock:
+            view = self._views.get(user_id)
+            if view is not None:
+                self._views.move_to_end(user_id)
+                return view
+            self._building.setdefault(user_id, [])
+        # Built outside the lock, so record and other users' queries go on
+        sequence, view = self._build(user_id)
+        with self._lock:
+            if user_id in self._views:
+                # A concurrent build finished first
+                return self._views[user_id]
+            backlog = self._building.pop(user_id, None)
+            if backlog is None:
+                # Invalidated while building; serve this one, don't keep it
+                return view
+            for recorded, device_type, samples in backlog:
+                if recorded > sequence:
+                    self._fold(view, device_type, samples)
+            self._views[user_id] = view
+            while len(self._views) > self.max_views:
+                self._views.popitem(last=False)
+        return view
+
+    @staticmethod
+    def _fold(view: _EnergyView, device_type: str, samples):
+        data = np.asarray(samples, dtype=np.float64).reshape(-1, 3)
+        energy = data[:, 1] * data[:, 2] / 3600.0 / 1000.0
+        idx = view.type_index(device_type or "other")
+        types = np.full(len(data), idx, dtype=np.int64)
+        for resolution in VIEW_RESOLUTIONS:
+            width = RESOLUTIONS[resolution]
+            buckets = (data[:, 0] // width).astype(np.int64) * width
+            view.add(resolution, buckets, types, energy)
+
+    def record(self, user_id: int, device_type: str, samples: Iterable[Tuple[float, float, float]]):
+        """Fold freshly ingested ``(timestamp, power, runtime)`` samples into a
+        built view. Call it right after ingesting them into the store."""
+        sequence = self._store.sequence
+        with self._lock:
+            view = self._views.get(user_id)
+            if view is not None:
+                self._fold(view, device_type, list(samples))
+            elif user_id in self._building:
+                # Kept unless the view being built already includes them
+                self._building[user_id].append((sequence, device_type, list(samples)))
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._views.pop(user_id, None)
+            self._building.pop(user_id, None)
+
+    def energy(self, user_id: int, time_range: str, now: Optional[float] = None) -> List[dict]:
+        """Energy and cost per chart point over ``time_range``."""
+        resolution, span, points, align, label_format = TIME_RANGES[time_range]
+        now = time.time() if now is None else now
+        end = (int(now) // align + 1) * align
+        start = end - span
+        view = self._view(user_id)
+        with self._lock:
+            keys, cells = view.matrix(resolution, start, end)
+        bins = ((keys - start) * points // span).astype(np.int64)
+        series = np.bincount(bins, weights=cells.sum(axis=1), minlength=points)
+        return [
+            {
+                "name": datetime.fromtimestamp(start + i * span / points).strftime(label_format),
+                "energy": round(float(kwh), 2),
+                "cost": round(float(kwh) * ENERGY_PRICE_PER_KWH, 2),
+            }
+            for i, kwh in enumerate(series[:points])
+        ]
+
+    def by_type(self, user_id: int, time_range: str, now: Optional[float] = None) -> Dict[str, float]:
+        """Total energy (kWh) per device type over ``time_range``."""
+        resolution, span, _, align, _ = TIME_RANGES[time_range]
+        now = time.time() if now is None else now
+        end = (int(now) // align + 1) * align
+        view = self._view(user_id)
+        with self._lock:
+            _, cells = view.matrix(resolution, end - span, end)
+            totals = cells.sum(axis=0)
+            return {t: float(totals[i]) for t, i in view.types.items() if i < len(totals)}
+
+
+energy_summary = EnergySummary()
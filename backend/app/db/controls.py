@@ -0,0 +1,169 @@
+import asyncio
+import itertools
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from history import ChangeActor, change_actor
+
+logger = logging.getLogger(__name__)
+
+# How long a control value may stay buffered before it is persisted, and
+# how many buffered devices trigger an early flush
+CONTROL_FLUSH_INTERVAL = float(os.environ.get("CONTROL_FLUSH_INTERVAL", "0.25"))
+CONTROL_FLUSH_THRESHOLD = int(os.environ.get("CONTROL_FLUSH_THRESHOLD", "256"))
+
+# Commands whose latest value wins, so intermediate values can be dropped
+BUFFERED_COMMANDS = ("brightness", "color", "temperature")
+
+# (device_id, command, value)
+Command = Tuple[str, str, Any]
+
+
+class ControlBuffer:
+    """Write-behind buffer for high-frequency control values.
+
+    ``write`` records the latest value per device and command and returns
+    at once; the buffered values are the authoritative state until they are
+    persisted. A flusher hands the coalesced commands to ``execute`` every
+    ``flush_interval`` seconds, or as soon as ``flush_threshold`` devices are
+    pending, and ``stop`` flushes whatever is left. Before ``start``, writes
+    are executed inline. Each device's values are executed as the
+    ``change_actor`` that wrote them last.
+    """
+
+    def __init__(self, flush_interval: float = CONTROL_FLUSH_INTERVAL,
+                 flush_threshold: int = CONTROL_FLUSH_THRESHOLD):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        # Values handed to execute but not yet committed; still served by reads
+        self._flushing: Dict[str, Dict[str, Any]] = {}
+        self._actors: Dict[str, ChangeActor] = {}
+        self._sequence = itertools.count(1)
+        self._user_sequence: Dict[int, int] = {}
+        self._execute: Optional[Callable[[List[Command]], Awaitable[None]]] = None
+        self._dirty: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.writes = 0
+        self.flushes = 0
+        self.flushed = 0
+
+    def pending(self, device_id: str) -> Dict[str, Any]:
+        """Buffered values for a device, to overlay on its stored properties."""
+        values = self._flushing.get(device_id)
+        pending = self._pending.get(device_id)
+        if values is None:
+            return dict(pending) if pending else {}
+        return {**values, **pending} if pending else dict(values)
+
+    def sequence(self, user_id: int) -> int:
+        """Increases with every buffered write for the user (for ETags)."""
+        return self._user_sequence.get(user_id, 0)
+
+    async def write(self, user_id: int, device_id: str, command: str, value: Any):
+        if command not in BUFFERED_COMMANDS:
+            raise ValueError(f"Command is not buffered: {command}")
+        if self._task is None:
+            await self._execute_inline([(device_id, command, value)])
+            return
+        self._pending.setdefault(device_id, {})[command] = value
+        self._actors[device_id] = change_actor.get()
+        self._user_sequence[user_id] = next(self._sequence)
+        self.writes += 1
+        self._dirty.set()
+        if len(self._pending) >= self.flush_threshold:
+            self._full.set()
+
+    def discard(self, device_id: str, commands=BUFFERED_COMMANDS):
+        """Drop buffered values a direct write is about to replace."""
+        pending = self._pending.get(device_id)
+        if pending is None:
+            return
+        for command in commands:
+            pending.pop(command, None)
+        if not pending:
+            del self._pending[device_id]
+            self._actors.pop(device_id, None)
+
+    async def _execute_inline(self, commands: List[Command]):
+        if self._execute is None:
+            raise RuntimeError("Control buffer has no executor")
+        await self._execute(commands)
+
+    async def start(self, execute: Callable[[List[Command]], Awaitable[None]]):
+        self._execute = execute
+        if self._task is None:
+            self._dirty = asyncio.Event()
+            self._full = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # Nothing buffered is lost on a clean shutdown
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Error flushing control values on shutdown: {str(e)}")
+
+    async def flush(self):
+        if not self._pending:
+            return
+        self._flushing, self._pending = self._pending, {}
+        self._dirty.clear()
+        self._full.clear()
+        by_actor: Dict[ChangeActor, List[Command]] = {}
+        for device_id, values in self._flushing.items():
+            actor = self._actors.pop(device_id, None) or change_actor.get()
+            by_actor.setdefault(actor, []).extend(
+                (device_id, command, value) for command, value in values.items()
+            )
+        try:
+            # Submitted together, so the write queue still commits them as one batch
+            await asyncio.gather(*(self._execute_as(actor, commands) for actor, commands in by_actor.items()))
+        except BaseException:
+            # Requeue values that haven't been superseded since (also when
+            # cancelled by stop, which flushes them again; reapplying the
+            # same value is harmless)
+            for device_id, values in self._flushing.items():
+                pending = self._pending.setdefault(device_id, {})
+                for command, value in values.items():
+                    pending.setdefault(command, value)
+            for actor, commands in by_actor.items():
+                for device_id, _, _ in commands:
+                    self._actors.setdefault(device_id, actor)
+            self._dirty.set()
+            raise
+        finally:
+            self._flushing = {}
+        self.flushes += 1
+        self.flushed += sum(len(commands) for commands in by_actor.values())
+
+    async def _execute_as(self, actor: ChangeActor, commands: List[Command]):
+        # gather runs this in its own task, so the actor doesn't leak
+        change_actor.set(actor)
+        await self._execute(commands)
+
+    async def _run(self):
+        while True:
+            await self._dirty.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing control values: {str(e)}")
+                await asyncio.sleep(self.flush_interval)
+
+
+control_buffer = ControlBuffer()
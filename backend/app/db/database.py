@@ -1,14 +1,101 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, JSON
+import os
+from collections.abc import MutableMapping
+from sqlalchemy import create_engine, event, Boolean, Column, Integer, String, Float, LargeBinary, ForeignKey, JSON, Index
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.ext.mutable import MutableDict
+from sqlalchemy.orm import Session, sessionmaker, relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./smart_home.db"
+SQLALCHEMY_DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./smart_home.db")
 
+# Async drivers used for the request path, keyed by the sync URL's backend
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+def _async_url(url: str) -> str:
+    parsed = make_url(url)
+    async_url = parsed.set(drivername=ASYNC_DRIVERS.get(parsed.get_backend_name(), parsed.drivername))
+    return async_url.render_as_string(hide_password=False)
+
+ASYNC_DATABASE_URL = os.environ.get("ASYNC_DATABASE_URL", _async_url(SQLALCHEMY_DATABASE_URL))
+
+_is_sqlite = SQLALCHEMY_DATABASE_URL.startswith("sqlite")
+
+# Storage profiles: connection pragmas (SQLite only) and pool sizing.
+# "production" runs SQLite in WAL mode so readers never block the writer;
+# "basic" keeps SQLite's defaults (rollback journal, full sync).
+STORAGE_PROFILES = {
+    "basic": {
+        "pragmas": {},
+        "pool_size": 5,
+        "max_overflow": 10,
+    },
+    "production": {
+        "pragmas": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "busy_timeout": 5000,  # ms
+            "cache_size": -65536,  # KiB, i.e. 64 MiB per connection
+            "mmap_size": 268435456,  # 256 MiB
+            "temp_store": "MEMORY",
+        },
+        "pool_size": 20,
+        "max_overflow": 10,
+    },
+}
+STORAGE_PROFILE = STORAGE_PROFILES[os.environ.get("STORAGE_PROFILE", "production")]
+
+def _apply_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in STORAGE_PROFILE["pragmas"].items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+# pysqlite (and aiosqlite over it) defers BEGIN until the first DML
+# statement and commits on its own before DDL, so a SAVEPOINT opened with no
+# transaction yet starts one and its RELEASE commits it: every nested
+# write would commit (and fsync) alone. SQLAlchemy's documented recipe
+# turns the driver's transaction handling off and emits BEGIN itself.
+def _disable_driver_transactions(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+def _begin(connection):
+    connection.exec_driver_sql("BEGIN")
+
+# The sync engine serves schema migrations (see migrations.py) and
+# background jobs (telemetry flushes, CLI tools); request handlers use the
+# async engine below. Nothing connects until first use.
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False} if _is_sqlite else {},
+    poolclass=QueuePool,
+    pool_size=STORAGE_PROFILE["pool_size"],
+    max_overflow=STORAGE_PROFILE["max_overflow"],
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=STORAGE_PROFILE["pool_size"],
+    max_overflow=STORAGE_PROFILE["max_overflow"],
+)
+# expire_on_commit=False so committed objects can still be serialized
+# without an implicit (and, under asyncio, illegal) lazy refresh
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
+
+if _is_sqlite:
+    for _engine in (engine, async_engine.sync_engine):
+        event.listen(_engine, "connect", _apply_pragmas)
+        event.listen(_engine, "connect", _disable_driver_transactions)
+        event.listen(_engine, "begin", _begin)
+
 Base = declarative_base()
 
 class User(Base):
@@ -18,8 +105,67 @@ class User(Base):
     email = Column(String, unique=True, index=True)
     username = Column(String, unique=True, index=True)
     hashed_password = Column(String)
+    # Bumped whenever any of the user's devices changes (see _stamp_device_versions)
+    device_version = Column(Integer, nullable=False, default=0, server_default="0")
     devices = relationship("Device", back_populates="owner")
 
+# Device properties kept in typed, indexable columns; every other property
+# (schedule, stats, settings) stays in the JSON column
+PROPERTY_COLUMNS = ("brightness", "temperature", "locked", "color", "mode")
+
+class DevicePropertiesView(MutableMapping):
+    """Dict-like view of a device's properties across both storages.
+
+    Typed columns holding None read as absent, as an unset key did before.
+    """
+
+    def __init__(self, device: "Device"):
+        self._device = device
+
+    def __getitem__(self, key):
+        if key in PROPERTY_COLUMNS:
+            value = getattr(self._device, key)
+            if value is None:
+                raise KeyError(key)
+            return value
+        return (self._device.extra or {})[key]
+
+    def __setitem__(self, key, value):
+        if key in PROPERTY_COLUMNS:
+            setattr(self._device, key, value)
+        elif self._device.extra is None:
+            self._device.extra = {key: value}
+        else:
+            self._device.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in PROPERTY_COLUMNS:
+            if getattr(self._device, key) is None:
+                raise KeyError(key)
+            setattr(self._device, key, None)
+        else:
+            del self._device.extra[key]
+
+    def __iter__(self):
+        for key in PROPERTY_COLUMNS:
+            if getattr(self._device, key) is not None:
+                yield key
+        yield from (key for key in (self._device.extra or {}) if key not in PROPERTY_COLUMNS)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+def merge_properties(columns, extra) -> dict:
+    """Combine typed property values and the JSON remainder into one dict."""
+    properties = dict(extra or {})
+    for key in PROPERTY_COLUMNS:
+        if columns[key] is not None:
+            properties[key] = columns[key]
+    return properties
+
 class Device(Base):
     __tablename__ = "devices"
 
@@ -28,17 +174,137 @@ class Device(Base):
     name = Column(String)
     type = Column(String)
     status = Column(String)
-    properties = Column(JSON)
+    brightness = Column(Integer)
+    temperature = Column(Float)
+    locked = Column(Boolean)
+    color = Column(String)
+    mode = Column(String)
+    extra = Column("properties", MutableDict.as_mutable(JSON))
     owner_id = Column(Integer, ForeignKey("users.id"))
+    # Owner's device_version as of this device's last change
+    version = Column(Integer, nullable=False, default=0, server_default="0")
     owner = relationship("User", back_populates="devices")
 
-# Create the database tables
-Base.metadata.create_all(bind=engine)
+    # Device listings are keyset-paginated on id within an owner, optionally
+    # filtered by type or status
+    __table_args__ = (
+        Index("ix_devices_owner_id_id", "owner_id", "id"),
+        Index("ix_devices_owner_type_id", "owner_id", "type", "id"),
+        Index("ix_devices_owner_status_id", "owner_id", "status", "id"),
+        Index("ix_devices_owner_version", "owner_id", "version"),
+        Index("ix_devices_owner_type_brightness", "owner_id", "type", "brightness"),
+        Index("ix_devices_owner_type_locked", "owner_id", "type", "locked"),
+    )
+
+    @property
+    def properties(self) -> DevicePropertiesView:
+        return DevicePropertiesView(self)
+
+    @properties.setter
+    def properties(self, value):
+        value = dict(value or {})
+        for key in PROPERTY_COLUMNS:
+            setattr(self, key, value.pop(key, None))
+        self.extra = value
+
+class TelemetryChunk(Base):
+    __tablename__ = "telemetry_chunks"
+
+    # Sealed, append-only block of samples for one device; each column is
+    # a packed array of float64 values (see telemetry.py)
+    id = Column(Integer, primary_key=True)
+    device_id = Column(String, nullable=False)
+    start_ts = Column(Float, nullable=False)
+    end_ts = Column(Float, nullable=False)
+    count = Column(Integer, nullable=False)
+    timestamps = Column(LargeBinary, nullable=False)
+    power = Column(LargeBinary, nullable=False)
+    runtime = Column(LargeBinary, nullable=False)
+
+    # Retention deletes by end_ts
+    __table_args__ = (
+        Index("ix_telemetry_chunks_device_start", "device_id", "start_ts"),
+        Index("ix_telemetry_chunks_end", "end_ts"),
+    )
+
+class TelemetryRollup(Base):
+    __tablename__ = "telemetry_rollups"
+
+    device_id = Column(String, primary_key=True)
+    resolution = Column(String, primary_key=True)  # "1m", "1h" or "1d"
+    bucket = Column(Integer, primary_key=True)  # bucket start, epoch seconds
+    count = Column(Integer, nullable=False)
+    power_sum = Column(Float, nullable=False)
+    power_min = Column(Float, nullable=False)
+    power_max = Column(Float, nullable=False)
+    runtime_sum = Column(Float, nullable=False)
+    energy_sum = Column(Float, nullable=False)
+    last_ts = Column(Float, nullable=False)
+
+    # Retention deletes by resolution and bucket
+    __table_args__ = (
+        Index("ix_telemetry_rollups_resolution_bucket", "resolution", "bucket"),
+    )
+
+class AutomationRule(Base):
+    __tablename__ = "automation_rules"
+
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    name = Column(String, nullable=False)
+    enabled = Column(Boolean, nullable=False, default=True)
+    # Trigger, conditions and actions, compiled by the rules engine (see rules.py)
+    definition = Column(JSON, nullable=False)
+
+class DeviceChange(Base):
+    __tablename__ = "device_changes"
+
+    # Append-only log of device state changes (see history.py); rows are
+    # only rewritten by compaction and removed by retention
+    id = Column(Integer, primary_key=True)
+    device_id = Column(String, nullable=False)
+    owner_id = Column(Integer, nullable=False)
+    ts = Column(Float, nullable=False)
+    source = Column(String, nullable=False)  # "api", "scheduler", "automation" or "system"
+    actor_id = Column(Integer)  # user who made the change, if any
+    changes = Column(JSON, nullable=False)
+    merged = Column(Integer, nullable=False, default=1)  # changes compacted into this row
+
+    # History is read per device or per owner over a time range; retention
+    # deletes by time alone
+    __table_args__ = (
+        Index("ix_device_changes_device_ts", "device_id", "ts"),
+        Index("ix_device_changes_owner_ts", "owner_id", "ts"),
+        Index("ix_device_changes_ts", "ts"),
+    )
+
+# Every flush that adds or changes devices takes the next collection version
+# of each affected owner and stamps it on those devices. The increment locks
+# the owner's row until commit, so versions become visible in order and
+# "changed since N" is simply version > N.
+@event.listens_for(Session, "before_flush")
+def _stamp_device_versions(session, flush_context, instances):
+    changed = {}
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Device) and (obj in session.new or session.is_modified(obj)):
+            changed.setdefault(obj.owner_id, []).append(obj)
+    if not changed:
+        return
+    users = User.__table__
+    connection = session.connection()
+    for owner_id, devices in changed.items():
+        version = connection.execute(
+            users.update()
+            .where(users.c.id == owner_id)
+            .values(device_version=users.c.device_version + 1)
+            .returning(users.c.device_version)
+        ).scalar()
+        for device in devices:
+            device.version = version or 0
+
+# Tables are created and upgraded by migrations.py at startup, not here
 
 # Dependency
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
@@ -0,0 +1,258 @@
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from typing import List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import and_, bindparam, insert, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import SessionLocal, DeviceChange, User
+
+logger = logging.getLogger(__name__)
+
+# How long changes are kept, and how old they are before compaction
+HISTORY_RETENTION = float(os.environ.get("HISTORY_RETENTION_DAYS", "90")) * 86400
+HISTORY_COMPACT_AFTER = float(os.environ.get("HISTORY_COMPACT_AFTER_DAYS", "7")) * 86400
+
+# Compaction merges runs of slider-style changes (same device and actor, at
+# most COMPACT_WINDOW seconds from the run's first change) into one row.
+# Changes touching anything else (status, lock, name, settings) are kept
+# exactly as they were made.
+COMPACT_WINDOW = 300
+COMPACTABLE_PROPERTIES = frozenset(("brightness", "temperature", "color"))
+
+# Changes held in memory between flushes; past this the oldest are dropped
+MAX_PENDING_CHANGES = 100000
+# Rows deleted per statement, so retention holds the write lock briefly
+DELETE_BATCH = 5000
+
+DAY = 86400
+
+
+class ChangeActor(NamedTuple):
+    source: str  # "api", "scheduler", "automation" or "system"
+    user_id: Optional[int] = None
+
+
+SYSTEM = ChangeActor("system")
+
+# Who is changing devices in the current context. Authentication sets it for
+# API requests and the background executors for their own writes; the write
+# queue and the control buffer carry it over to the task that commits.
+change_actor: ContextVar[ChangeActor] = ContextVar("change_actor", default=SYSTEM)
+
+# (timestamp, device_id, owner_id, source, actor_id, changes)
+Change = Tuple[float, str, int, str, Optional[int], dict]
+
+
+def _compactable(row) -> bool:
+    properties = row.changes.get("properties")
+    return (
+        row.merged == 1
+        and set(row.changes) == {"properties"}
+        and bool(properties)
+        and COMPACTABLE_PROPERTIES.issuperset(properties)
+    )
+
+
+class DeviceHistory:
+    """Append-only log of device state changes.
+
+    Committed changes are buffered in memory by ``record`` (see events.py)
+    and written in one multi-row insert per ``flush``, off the request path.
+    Rows are indexed by (device_id, ts), (owner_id, ts) and ts, so history
+    queries, retention and compaction are all index range scans. ``expire``
+    deletes rows older than ``HISTORY_RETENTION``; ``compact`` merges runs of
+    slider changes older than ``HISTORY_COMPACT_AFTER``, so the log grows
+    with discrete changes rather than with every drag of a slider.
+    """
+
+    def __init__(self, session_factory=SessionLocal, max_pending: int = MAX_PENDING_CHANGES):
+        self._session_factory = session_factory
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pending: List[Change] = []
+        # Compaction resumes from here rather than rescanning compacted days
+        self._compacted_until: Optional[float] = None
+        self.recorded = 0
+        self.dropped = 0
+        self.compacted = 0
+        self.expired = 0
+
+    def record(self, changes: List[Change]):
+        with self._lock:
+            self._pending.extend(changes)
+            self.recorded += len(changes)
+            self._trim()
+
+    def _trim(self):
+        excess = len(self._pending) - self.max_pending
+        if excess > 0:
+            del self._pending[:excess]
+            self.dropped += excess
+            logger.warning(f"Device history buffer full; dropped {excess} changes")
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        db = self._session_factory()
+        try:
+            db.execute(insert(DeviceChange), [
+                {"ts": ts, "device_id": device_id, "owner_id": owner_id,
+                 "source": source, "actor_id": actor_id, "changes": changes}
+                for ts, device_id, owner_id, source, actor_id, changes in pending
+            ])
+            db.commit()
+        except Exception:
+            db.rollback()
+            # Put the changes back so the next flush retries them
+            with self._lock:
+                self._pending[:0] = pending
+                self._trim()
+            raise
+        finally:
+            db.close()
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """Delete changes older than the retention period."""
+        cutoff = (time.time() if now is None else now) - HISTORY_RETENTION
+        table = DeviceChange.__table__
+        expired = 0
+        db = self._session_factory()
+        try:
+            while True:
+                batch = select(table.c.id).where(table.c.ts < cutoff).limit(DELETE_BATCH)
+                deleted = db.execute(table.delete().where(table.c.id.in_(batch.scalar_subquery()))).rowcount
+                db.commit()
+                expired += deleted
+                if deleted < DELETE_BATCH:
+                    break
+        finally:
+            db.close()
+        self.expired += expired
+        return expired
+
+    def compact(self, now: Optional[float] = None) -> int:
+        """Compact changes that became old enough since the last run, a day
+        (one transaction) at a time. Returns the number of rows removed."""
+        now = time.time() if now is None else now
+        cutoff = now - HISTORY_COMPACT_AFTER
+        start = self._compacted_until
+        if start is None:
+            start = now - HISTORY_RETENTION
+        removed = 0
+        while start < cutoff:
+            end = min(start + DAY, cutoff)
+            removed += self._compact_range(start, end)
+            start = self._compacted_until = end
+        self.compacted += removed
+        return removed
+
+    def _compact_range(self, start: float, end: float) -> int:
+        db = self._session_factory()
+        try:
+            rows = db.execute(
+                select(DeviceChange.id, DeviceChange.device_id, DeviceChange.ts, DeviceChange.source,
+                       DeviceChange.actor_id, DeviceChange.changes, DeviceChange.merged)
+                .where(DeviceChange.ts >= start, DeviceChange.ts < end)
+                .order_by(DeviceChange.device_id, DeviceChange.ts, DeviceChange.id)
+            ).all()
+            updates, deleted = [], []
+            run = []
+
+            def close_run():
+                if len(run) < 2:
+                    return
+                properties = {}
+                for row in run:
+                    properties.update(row.changes["properties"])
+                # The run's last row keeps its time and takes the final values
+                updates.append({"_id": run[-1].id, "_changes": {"properties": properties}, "_merged": len(run)})
+                deleted.extend(row.id for row in run[:-1])
+
+            for row in rows:
+                if run and not (
+                    _compactable(row)
+                    and (row.device_id, row.source, row.actor_id) == (run[0].device_id, run[0].source, run[0].actor_id)
+                    and row.ts - run[0].ts <= COMPACT_WINDOW
+                ):
+                    close_run()
+                    run = []
+                if _compactable(row):
+                    run.append(row)
+            close_run()
+
+            if updates:
+                table = DeviceChange.__table__
+                db.execute(
+                    table.update()
+                    .where(table.c.id == bindparam("_id"))
+                    .values(changes=bindparam("_changes"), merged=bindparam("_merged")),
+                    updates,
+                )
+                for i in range(0, len(deleted), DELETE_BATCH):
+                    db.execute(table.delete().where(table.c.id.in_(deleted[i:i + DELETE_BATCH])))
+            db.commit()
+            return len(deleted)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def query(self, db: AsyncSession, owner_id: int, device_id: Optional[str] = None,
+                    start: Optional[float] = None, end: Optional[float] = None, limit: int = 100,
+                    before: Optional[Tuple[float, int]] = None) -> List[dict]:
+        """Changes with ``start <= ts < end``, newest first.
+
+        ``before`` is the (ts, id) of the last change of the previous page.
+        Changes reach the log within one flush interval of their commit.
+        """
+        query = (
+            select(DeviceChange, User.username)
+            .outerjoin(User, User.id == DeviceChange.actor_id)
+            .order_by(DeviceChange.ts.desc(), DeviceChange.id.desc())
+            .limit(limit)
+        )
+        # The caller checks the device's owner; filtering on the device
+        # alone lets the (device_id, ts) index serve the query
+        if device_id is not None:
+            query = query.where(DeviceChange.device_id == device_id)
+        else:
+            query = query.where(DeviceChange.owner_id == owner_id)
+        if start is not None:
+            query = query.where(DeviceChange.ts >= start)
+        if end is not None:
+            query = query.where(DeviceChange.ts < end)
+        if before is not None:
+            ts, change_id = before
+            query = query.where(or_(
+                DeviceChange.ts < ts,
+                and_(DeviceChange.ts == ts, DeviceChange.id < change_id),
+            ))
+        return [
+            {
+                "id": change.id,
+                "device_id": change.device_id,
+                "ts": change.ts,
+                "timestamp": datetime.fromtimestamp(change.ts).isoformat(),
+                "source": change.source,
+                "actor_id": change.actor_id,
+                "actor": username,
+                "changes": change.changes,
+                "merged": change.merged,
+            }
+            for change, username in (await db.execute(query)).all()
+        ]
+
+
+device_history = DeviceHistory()
@@ -0,0 +1,233 @@
+import logging
+import time
+from typing import Callable, List, NamedTuple
+
+from sqlalchemy import (
+    bindparam, inspect, select, text, Boolean, Column, Float, ForeignKey, Index, Integer, JSON,
+    LargeBinary, MetaData, String, Table
+)
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateTable
+
+from database import engine
+
+logger = logging.getLogger(__name__)
+
+# Applied migrations, one row per version. Kept out of Base.metadata: it
+# has to exist before the first migration runs.
+schema_migrations = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", Float, nullable=False),
+)
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[Connection], None]
+
+
+# The schema as of migration 1, frozen: later changes to the models in
+# database.py must come with a migration of their own, never an edit here
+baseline = MetaData()
+
+_users = Table(
+    "users", baseline,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("email", String, unique=True, index=True),
+    Column("username", String, unique=True, index=True),
+    Column("hashed_password", String),
+    Column("device_version", Integer, nullable=False, server_default="0"),
+)
+
+_devices = Table(
+    "devices", baseline,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("device_id", String, unique=True, index=True),
+    Column("name", String),
+    Column("type", String),
+    Column("status", String),
+    Column("brightness", Integer),
+    Column("temperature", Float),
+    Column("locked", Boolean),
+    Column("color", String),
+    Column("mode", String),
+    Column("properties", JSON),
+    Column("owner_id", Integer, ForeignKey("users.id")),
+    Column("version", Integer, nullable=False, server_default="0"),
+    Index("ix_devices_owner_id_id", "owner_id", "id"),
+    Index("ix_devices_owner_type_id", "owner_id", "type", "id"),
+    Index("ix_devices_owner_status_id", "owner_id", "status", "id"),
+    Index("ix_devices_owner_version", "owner_id", "version"),
+    Index("ix_devices_owner_type_brightness", "owner_id", "type", "brightness"),
+    Index("ix_devices_owner_type_locked", "owner_id", "type", "locked"),
+)
+
+Table(
+    "telemetry_chunks", baseline,
+    Column("id", Integer, primary_key=True),
+    Column("device_id", String, nullable=False),
+    Column("start_ts", Float, nullable=False),
+    Column("end_ts", Float, nullable=False),
+    Column("count", Integer, nullable=False),
+    Column("timestamps", LargeBinary, nullable=False),
+    Column("power", LargeBinary, nullable=False),
+    Column("runtime", LargeBinary, nullable=False),
+    Index("ix_telemetry_chunks_device_start", "device_id", "start_ts"),
+)
+
+Table(
+    "telemetry_rollups", baseline,
+    Column("device_id", String, primary_key=True),
+    Column("resolution", String, primary_key=True),
+    Column("bucket", Integer, primary_key=True),
+    Column("count", Integer, nullable=False),
+    Column("power_sum", Float, nullable=False),
+    Column("power_min", Float, nullable=False),
+    Column("power_max", Float, nullable=False),
+    Column("runtime_sum", Float, nullable=False),
+    Column("energy_sum", Float, nullable=False),
+    Column("last_ts", Float, nullable=False),
+)
+
+Table(
+    "automation_rules", baseline,
+    Column("id", Integer, primary_key=True),
+    Column("owner_id", Integer, ForeignKey("users.id"), nullable=False, index=True),
+    Column("name", String, nullable=False),
+    Column("enabled", Boolean, nullable=False),
+    Column("definition", JSON, nullable=False),
+)
+
+Table(
+    "device_changes", baseline,
+    Column("id", Integer, primary_key=True),
+    Column("device_id", String, nullable=False),
+    Column("owner_id", Integer, nullable=False),
+    Column("ts", Float, nullable=False),
+    Column("source", String, nullable=False),
+    Column("actor_id", Integer),
+    Column("changes", JSON, nullable=False),
+    Column("merged", Integer, nullable=False),
+    Index("ix_device_changes_device_ts", "device_id", "ts"),
+    Index("ix_device_changes_owner_ts", "owner_id", "ts"),
+    Index("ix_device_changes_ts", "ts"),
+)
+
+
+def _create_baseline(connection: Connection):
+    # Tables of a database created before migrations were tracked already
+    # exist and are skipped; migration 2 brings them up to the baseline
+    baseline.create_all(bind=connection)
+
+
+# Columns added to the original users and devices tables before migrations
+# were tracked, as (table, column, DDL type)
+UNVERSIONED_COLUMNS = (
+    ("users", "device_version", "INTEGER NOT NULL DEFAULT 0"),
+    ("devices", "brightness", "INTEGER"),
+    ("devices", "temperature", "FLOAT"),
+    ("devices", "locked", "BOOLEAN"),
+    ("devices", "color", "VARCHAR"),
+    ("devices", "mode", "VARCHAR"),
+    ("devices", "version", "INTEGER NOT NULL DEFAULT 0"),
+)
+TYPED_PROPERTIES = ("brightness", "temperature", "locked", "color", "mode")
+
+
+def _move_properties_to_columns(connection: Connection):
+    """Move typed properties out of the JSON column of existing devices."""
+    updates = []
+    for row in connection.execute(select(_devices.c.id, _devices.c.properties)):
+        properties = dict(row.properties or {})
+        if not any(key in properties for key in TYPED_PROPERTIES):
+            continue
+        update = {key: properties.pop(key, None) for key in TYPED_PROPERTIES}
+        update.update(_id=row.id, _properties=properties)
+        updates.append(update)
+    if updates:
+        connection.execute(
+            _devices.update()
+            .where(_devices.c.id == bindparam("_id"))
+            .values(properties=bindparam("_properties"),
+                    **{key: bindparam(key) for key in TYPED_PROPERTIES}),
+            updates,
+        )
+
+
+def _upgrade_unversioned(connection: Connection):
+    # Databases created before migrations were tracked are at whichever
+    # schema their last start left them; add what they lack of the baseline
+    inspector = inspect(connection)
+    existing = {table: {column["name"] for column in inspector.get_columns(table)}
+                for table in ("users", "devices")}
+    added = set()
+    for table, column, ddl in UNVERSIONED_COLUMNS:
+        if column not in existing[table]:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+            added.add(column)
+    if added & set(TYPED_PROPERTIES):
+        _move_properties_to_columns(connection)
+    for index in _devices.indexes:
+        index.create(bind=connection, checkfirst=True)
+
+
+def _index_telemetry_retention(connection: Connection):
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_telemetry_rollups_resolution_bucket "
+        "ON telemetry_rollups (resolution, bucket)"
+    ))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_telemetry_chunks_end ON telemetry_chunks (end_ts)"
+    ))
+
+
+# In order; append new migrations (explicit DDL, not the current models),
+# never edit or reorder applied ones
+MIGRATIONS = (
+    Migration(1, "create tables", _create_baseline),
+    Migration(2, "upgrade unversioned schema", _upgrade_unversioned),
+    Migration(3, "index telemetry retention", _index_telemetry_retention),
+)
+
+
+def applied_versions(bind: Engine = engine) -> set:
+    with bind.begin() as connection:
+        connection.execute(CreateTable(schema_migrations, if_not_exists=True))
+        return set(connection.execute(select(schema_migrations.c.version)).scalars())
+
+
+def migrate(bind: Engine = engine) -> List[Migration]:
+    """Apply pending migrations; returns those this call applied.
+
+    Each runs in its own transaction, which first claims the migration by
+    inserting its version: a process starting alongside blocks on that
+    insert and then skips the migration, so each runs exactly once. With
+    nothing pending this is two cheap queries.
+    """
+    done = applied_versions(bind)
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version in done:
+            continue
+        started = time.perf_counter()
+        claimed = False
+        try:
+            with bind.begin() as connection:
+                connection.execute(schema_migrations.insert().values(
+                    version=migration.version, name=migration.name, applied_at=time.time()))
+                claimed = True
+                migration.apply(connection)
+        except IntegrityError:
+            if claimed:
+                raise
+            # Another process applied it first
+            continue
+        applied.append(migration)
+        logger.info(f"Applied migration {migration.version} ({migration.name}) "
+                    f"in {time.perf_counter() - started:.3f}s")
+    return applied
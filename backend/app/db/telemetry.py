@@ -0,0 +1,454 @@
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, func, or_
+from sqlalchemy.dialects import postgresql, sqlite
+
+from database import SessionLocal, TelemetryChunk, TelemetryRollup
+
+# Samples per sealed chunk, and the longest a partially filled chunk may
+# stay in memory before it is sealed anyway (for slow reporters)
+CHUNK_SIZE = 1024
+CHUNK_MAX_AGE = 3600
+
+# Rollup bucket widths and how long buckets of each width are retained (seconds)
+RESOLUTIONS = {"1m": 60, "1h": 3600, "1d": 86400}
+RETENTION = {"1m": 86400, "1h": 90 * 86400, "1d": 5 * 365 * 86400}
+# How long raw sample chunks are kept, by their last sample (seconds)
+RAW_RETENTION = float(os.environ.get("TELEMETRY_RAW_RETENTION_DAYS", "30")) * 86400
+
+# Rollups cached per device for stats, by resolution: the last hour of 1m
+# buckets and the last day of 1h buckets. At most CACHE_SIZE devices are
+# cached; entries are reloaded after CACHE_TTL, picking up samples other
+# workers stored meanwhile.
+CACHED_WINDOWS = {"1m": 3600, "1h": 86400}
+CACHE_SIZE = int(os.environ.get("TELEMETRY_CACHE_SIZE", "10000"))
+CACHE_TTL = 300
+
+# Dialects whose INSERT supports ON CONFLICT DO UPDATE
+UPSERT_INSERTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+# Two-argument min/max by dialect, for merging rollups in an upsert
+SCALAR_EXTREMES = {"sqlite": (func.min, func.max), "postgresql": (func.least, func.greatest)}
+
+ROLLUP_FIELDS = (
+    "count", "power_sum", "power_min", "power_max",
+    "runtime_sum", "energy_sum", "last_ts",
+)
+
+
+class _Chunk:
+    __slots__ = ("timestamps", "power", "runtime", "opened_at")
+
+    def __init__(self):
+        self.timestamps = array("d")
+        self.power = array("d")
+        self.runtime = array("d")
+        self.opened_at = time.time()
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append(self, ts: float, power: float, runtime: float):
+        self.timestamps.append(ts)
+        self.power.append(power)
+        self.runtime.append(runtime)
+
+
+class _Rollup:
+    __slots__ = ROLLUP_FIELDS
+
+    def __init__(self, count=0, power_sum=0.0, power_min=float("inf"),
+                 power_max=float("-inf"), runtime_sum=0.0, energy_sum=0.0,
+                 last_ts=0.0):
+        self.count = count
+        self.power_sum = power_sum
+        self.power_min = power_min
+        self.power_max = power_max
+        self.runtime_sum = runtime_sum
+        self.energy_sum = energy_sum
+        self.last_ts = last_ts
+
+    def add(self, ts: float, power: float, runtime: float, energy: float):
+        self.count += 1
+        self.power_sum += power
+        if power < self.power_min:
+            self.power_min = power
+        if power > self.power_max:
+            self.power_max = power
+        self.runtime_sum += runtime
+        self.energy_sum += energy
+        if ts > self.last_ts:
+            self.last_ts = ts
+
+    def merge(self, other: "_Rollup"):
+        self.count += other.count
+        self.power_sum += other.power_sum
+        self.power_min = min(self.power_min, other.power_min)
+        self.power_max = max(self.power_max, other.power_max)
+        self.runtime_sum += other.runtime_sum
+        self.energy_sum += other.energy_sum
+        self.last_ts = max(self.last_ts, other.last_ts)
+
+    def as_row(self) -> Dict[str, float]:
+        return {field: getattr(self, field) for field in ROLLUP_FIELDS}
+
+
+def _cache_span(resolution: str) -> float:
+    # One bucket more than the window, for the bucket it starts in
+    return CACHED_WINDOWS[resolution] + RESOLUTIONS[resolution]
+
+
+class TelemetryStore:
+    """Append-only power/runtime samples with 1m/1h/1d rollups.
+
+    Raw samples are buffered per device in columnar arrays and written as
+    packed chunks once full. Ingest adds each sample to per-bucket deltas,
+    which ``flush`` adds to the stored rollups, so several workers can
+    ingest for the same device without overwriting each other; ingest never
+    touches the database. Stats are served from a bounded LRU cache of the
+    recent rollups (``CACHED_WINDOWS``) of recently read devices, loaded
+    from the table plus the unflushed deltas. ``expire`` applies retention
+    to rollups and raw chunks.
+    """
+
+    def __init__(self, session_factory=SessionLocal, chunk_size: int = CHUNK_SIZE,
+                 cache_size: int = CACHE_SIZE):
+        self._session_factory = session_factory
+        self._chunk_size = chunk_size
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        # Held while a flush is in flight, so readers combining the table
+        # with the unflushed deltas see each sample exactly once
+        self._flush_lock = threading.Lock()
+        self._open: Dict[str, _Chunk] = {}
+        self._sealed: List[Tuple[str, _Chunk]] = []
+        # device_id -> (loaded_at, {resolution: {bucket: rollup}})
+        self._cache: "OrderedDict[str, Tuple[float, Dict[str, Dict[int, _Rollup]]]]" = OrderedDict()
+        # device_id -> {(resolution, bucket): samples not yet added to the database}
+        self._dirty: Dict[str, Dict[Tuple[str, int], _Rollup]] = {}
+        # Incremented by every ingest (see snapshot)
+        self.sequence = 0
+
+    def _cached(self, device_id: str, now: float) -> Optional[Dict[str, Dict[int, _Rollup]]]:
+        entry = self._cache.get(device_id)
+        if entry is None or now - entry[0] >= CACHE_TTL:
+            return None
+        self._cache.move_to_end(device_id)
+        return entry[1]
+
+    def _load(self, device_id: str) -> Dict[str, Dict[int, _Rollup]]:
+        """Recent rollups of a device, from the cache or else the database.
+
+        Blocks on a flush in flight; call it from a worker thread.
+        """
+        now = time.time()
+        with self._lock:
+            rollups = self._cached(device_id, now)
+        if rollups is not None:
+            return rollups
+        with self._flush_lock:
+            rollups = {resolution: {} for resolution in CACHED_WINDOWS}
+            for row in self._read_rollups(device_id, {r: _cache_span(r) for r in CACHED_WINDOWS}, now):
+                rollups[row.resolution][row.bucket] = _Rollup(
+                    **{field: getattr(row, field) for field in ROLLUP_FIELDS}
+                )
+            with self._lock:
+                # Samples ingested meanwhile are among the unflushed deltas
+                for (resolution, bucket), delta in self._dirty.get(device_id, {}).items():
+                    if resolution in rollups and bucket >= now - _cache_span(resolution):
+                        rollups[resolution].setdefault(bucket, _Rollup()).merge(delta)
+                self._cache[device_id] = (now, rollups)
+                self._cache.move_to_end(device_id)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return rollups
+
+    def _read_rollups(self, device_id: str, windows: Dict[str, float], now: float):
+        db = self._session_factory()
+        try:
+            return (
+                db.query(TelemetryRollup)
+                .filter(
+                    TelemetryRollup.device_id == device_id,
+                    or_(*(
+                        and_(TelemetryRollup.resolution == resolution,
+                             TelemetryRollup.bucket >= now - window)
+                        for resolution, window in windows.items()
+                    )),
+                )
+                .order_by(TelemetryRollup.bucket)
+                .all()
+            )
+        finally:
+            db.close()
+
+    def _seal(self, device_id: str):
+        chunk = self._open.pop(device_id, None)
+        if chunk is not None and len(chunk):
+            self._sealed.append((device_id, chunk))
+
+    def ingest(self, device_id: str, samples: Iterable[Tuple[float, float, float]],
+               persist: bool = True) -> int:
+        """Append ``(timestamp, power_watts, runtime_seconds)`` samples.
+
+        With ``persist=False`` (samples another worker ingested and will
+        store) only the device's cached rollups, if any, are updated.
+        """
+        count = 0
+        with self._lock:
+            self.sequence += 1
+            rollups = self._cached(device_id, time.time())
+            dirty = self._dirty.setdefault(device_id, {}) if persist else None
+            for ts, power, runtime in samples:
+                chunk = None
+                if persist:
+                    chunk = self._open.get(device_id)
+                    if chunk is None:
+                        chunk = self._open[device_id] = _Chunk()
+                    chunk.append(ts, power, runtime)
+                energy = power * runtime / 3600.0
+                for resolution, width in RESOLUTIONS.items():
+                    bucket = int(ts // width) * width
+                    if rollups is not None and resolution in rollups:
+                        buckets = rollups[resolution]
+                        rollup = buckets.get(bucket)
+                        if rollup is None:
+                            rollup = buckets[bucket] = _Rollup()
+                            self._prune(buckets, resolution)
+                        rollup.add(ts, power, runtime, energy)
+                    if dirty is not None:
+                        delta = dirty.get((resolution, bucket))
+                        if delta is None:
+                            delta = dirty[(resolution, bucket)] = _Rollup()
+                        delta.add(ts, power, runtime, energy)
+                if chunk is not None and len(chunk) >= self._chunk_size:
+                    self._seal(device_id)
+                count += 1
+            if dirty is not None and not dirty:
+                del self._dirty[device_id]
+        return count
+
+    @staticmethod
+    def _prune(buckets: Dict[int, _Rollup], resolution: str):
+        cutoff = time.time() - _cache_span(resolution)
+        for bucket in [b for b in buckets if b < cutoff]:
+            del buckets[bucket]
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._sealed) + sum(len(deltas) for deltas in self._dirty.values())
+
+    @contextmanager
+    def snapshot(self, device_ids: Iterable[str]):
+        """Yield ``(sequence, unflushed)`` with flushes held off.
+
+        ``unflushed`` maps each of ``device_ids`` with samples not yet in
+        the table to ``{(resolution, bucket): rollup}``. Queries run inside
+        the block see every sample ingested up to ``sequence`` exactly once,
+        in the table or in ``unflushed``.
+        """
+        with self._flush_lock:
+            with self._lock:
+                unflushed = {}
+                for device_id in device_ids:
+                    deltas = self._dirty.get(device_id)
+                    if deltas:
+                        unflushed[device_id] = {key: _Rollup(**delta.as_row()) for key, delta in deltas.items()}
+                sequence = self.sequence
+            yield sequence, unflushed
+
+    def flush(self, seal_all: bool = False):
+        """Persist sealed chunks and dirty rollups in one transaction.
+
+        Open chunks older than ``CHUNK_MAX_AGE`` are sealed first; with
+        ``seal_all`` every open chunk is (used on shutdown).
+        """
+        with self._flush_lock:
+            now = time.time()
+            with self._lock:
+                for device_id, chunk in list(self._open.items()):
+                    if seal_all or now - chunk.opened_at >= CHUNK_MAX_AGE:
+                        self._seal(device_id)
+                sealed, self._sealed = self._sealed, []
+                dirty, self._dirty = self._dirty, {}
+            rows = []
+            for device_id, deltas in dirty.items():
+                for (resolution, bucket), delta in deltas.items():
+                    row = delta.as_row()
+                    row.update(device_id=device_id, resolution=resolution, bucket=bucket)
+                    rows.append(row)
+
+            if not sealed and not rows:
+                return
+
+            db = self._session_factory()
+            try:
+                for device_id, chunk in sealed:
+                    db.add(TelemetryChunk(
+                        device_id=device_id,
+                        start_ts=min(chunk.timestamps),
+                        end_ts=max(chunk.timestamps),
+                        count=len(chunk),
+                        timestamps=chunk.timestamps.tobytes(),
+                        power=chunk.power.tobytes(),
+                        runtime=chunk.runtime.tobytes(),
+                    ))
+                if rows:
+                    dialect = db.bind.dialect.name
+                    least, greatest = SCALAR_EXTREMES[dialect]
+                    stmt = UPSERT_INSERTS[dialect](TelemetryRollup)
+                    merged = {
+                        field: getattr(TelemetryRollup, field) + stmt.excluded[field]
+                        for field in ("count", "power_sum", "runtime_sum", "energy_sum")
+                    }
+                    merged.update(
+                        power_min=least(TelemetryRollup.power_min, stmt.excluded.power_min),
+                        power_max=greatest(TelemetryRollup.power_max, stmt.excluded.power_max),
+                        last_ts=greatest(TelemetryRollup.last_ts, stmt.excluded.last_ts),
+                    )
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=["device_id", "resolution", "bucket"],
+                        set_=merged,
+                    )
+                    db.execute(stmt, rows)
+                db.commit()
+            except Exception:
+                db.rollback()
+                # Put the work back so the next flush retries it
+                with self._lock:
+                    self._sealed[:0] = sealed
+                    for device_id, deltas in dirty.items():
+                        current = self._dirty.setdefault(device_id, {})
+                        for key, delta in deltas.items():
+                            if key in current:
+                                delta.merge(current[key])
+                            current[key] = delta
+                raise
+            finally:
+                db.close()
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """Delete rollups and raw chunks past their retention; returns the
+        number of rows deleted. Both deletes are index range scans."""
+        now = time.time() if now is None else now
+        deleted = 0
+        db = self._session_factory()
+        try:
+            for resolution, keep in RETENTION.items():
+                deleted += db.query(TelemetryRollup).filter(
+                    TelemetryRollup.resolution == resolution,
+                    TelemetryRollup.bucket < now - keep,
+                ).delete(synchronize_session=False)
+            deleted += db.query(TelemetryChunk).filter(
+                TelemetryChunk.end_ts < now - RAW_RETENTION,
+            ).delete(synchronize_session=False)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        return deleted
+
+    def rollups(self, device_id: str, resolution: str,
+                start: Optional[float] = None, end: Optional[float] = None) -> List[dict]:
+        """Return rollup buckets for a device in ascending bucket order.
+
+        Reads the table; call it from a worker thread.
+        """
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f"Unknown resolution: {resolution}")
+        now = time.time()
+        with self.snapshot([device_id]) as (_, unflushed):
+            buckets = {
+                row.bucket: _Rollup(**{field: getattr(row, field) for field in ROLLUP_FIELDS})
+                for row in self._read_rollups(device_id, {resolution: RETENTION[resolution]}, now)
+            }
+        for (delta_resolution, bucket), delta in unflushed.get(device_id, {}).items():
+            if delta_resolution == resolution:
+                buckets.setdefault(bucket, _Rollup()).merge(delta)
+        result = []
+        for bucket in sorted(buckets):
+            if start is not None and bucket + RESOLUTIONS[resolution] <= start:
+                continue
+            if end is not None and bucket >= end:
+                continue
+            row = buckets[bucket].as_row()
+            row["bucket"] = bucket
+            result.append(row)
+        return result
+
+    def _recent(self, device_id: str, resolution: str, start: float, end: float) -> List[dict]:
+        rollups = self._load(device_id)
+        with self._lock:
+            return [
+                rollup.as_row()
+                for bucket, rollup in rollups[resolution].items()
+                if bucket + RESOLUTIONS[resolution] > start and bucket < end
+            ]
+
+    def samples(self, device_id: str, start: float, end: float) -> Dict[str, array]:
+        """Return raw samples with ``start <= timestamp < end`` as columns."""
+        columns = {"timestamps": array("d"), "power": array("d"), "runtime": array("d")}
+        chunks = []
+        db = self._session_factory()
+        try:
+            rows = (
+                db.query(TelemetryChunk)
+                .filter(
+                    TelemetryChunk.device_id == device_id,
+                    TelemetryChunk.start_ts < end,
+                    TelemetryChunk.end_ts >= start,
+                )
+                .order_by(TelemetryChunk.start_ts)
+                .all()
+            )
+            for row in rows:
+                chunk = _Chunk()
+                chunk.timestamps.frombytes(row.timestamps)
+                chunk.power.frombytes(row.power)
+                chunk.runtime.frombytes(row.runtime)
+                chunks.append(chunk)
+        finally:
+            db.close()
+        with self._lock:
+            chunks.extend(chunk for dev, chunk in self._sealed if dev == device_id)
+            if device_id in self._open:
+                chunks.append(self._open[device_id])
+            for chunk in chunks:
+                for i, ts in enumerate(chunk.timestamps):
+                    if start <= ts < end:
+                        columns["timestamps"].append(ts)
+                        columns["power"].append(chunk.power[i])
+                        columns["runtime"].append(chunk.runtime[i])
+        return columns
+
+    def stats(self, device_id: str, now: Optional[float] = None) -> dict:
+        """Summarize a device from its cached rollups (loading them may
+        query the database; call it from a worker thread).
+
+        ``powerUsage`` is the mean power (W) over the last hour, ``runtime``
+        the on-time (h) and ``energy`` the consumption (Wh) over the last 24h.
+        """
+        now = time.time() if now is None else now
+        recent = self._recent(device_id, "1m", now - 3600, now + 1)
+        day = self._recent(device_id, "1h", now - 86400, now + 1)
+
+        samples = sum(r["count"] for r in recent)
+        power = sum(r["power_sum"] for r in recent) / samples if samples else 0
+        last_ts = max((r["last_ts"] for r in day), default=None)
+        return {
+            "powerUsage": round(power, 1),
+            "runtime": round(sum(r["runtime_sum"] for r in day) / 3600.0, 1),
+            "energy": round(sum(r["energy_sum"] for r in day), 1),
+            "lastUpdated": datetime.fromtimestamp(last_ts).isoformat() if last_ts else None,
+        }
+
+
+telemetry_store = TelemetryStore()
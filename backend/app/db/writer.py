@@ -0,0 +1,132 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import AsyncSessionLocal
+from history import ChangeActor, change_actor
+
+logger = logging.getLogger(__name__)
+
+# Largest number of writes committed together, and how long the writer
+# waits for more writes to arrive once it has one (seconds)
+WRITE_BATCH_SIZE = 128
+WRITE_BATCH_DELAY = 0.002
+
+WriteFn = Callable[[AsyncSession], Awaitable[Any]]
+
+
+class WriteQueue:
+    """Single writer that group-commits small updates.
+
+    ``submit`` hands a coroutine function to the writer task, which applies
+    queued functions to one session, each inside its own SAVEPOINT, and
+    commits the whole batch once. SQLite allows one writer at a time, so
+    funnelling writes here replaces lock contention with one commit per
+    batch. Each function runs as the ``change_actor`` that submitted it.
+    Before ``start`` (e.g. in scripts) writes run and commit inline.
+    """
+
+    def __init__(self, session_factory=AsyncSessionLocal,
+                 batch_size: int = WRITE_BATCH_SIZE, batch_delay: float = WRITE_BATCH_DELAY):
+        self._session_factory = session_factory
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.writes = 0
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        # Let everything already queued commit before shutting down
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._queue = None
+
+    async def submit(self, fn: WriteFn) -> Any:
+        if self._task is None:
+            async with self._session_factory() as session:
+                result = await fn(session)
+                await session.commit()
+                return result
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((fn, change_actor.get(), future))
+        return await future
+
+    async def _collect(self) -> List[Tuple[WriteFn, ChangeActor, asyncio.Future]]:
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_delay
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            try:
+                await self._apply(batch)
+            except Exception as e:
+                logger.error(f"Write batch failed: {str(e)}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _apply(self, batch: List[Tuple[WriteFn, ChangeActor, asyncio.Future]]):
+        outcomes = []
+        async with self._session_factory() as session:
+            try:
+                for fn, actor, future in batch:
+                    # Each savepoint flushes its own changes, so they are
+                    # attributed to the submitter
+                    token = change_actor.set(actor)
+                    try:
+                        async with session.begin_nested():
+                            outcomes.append((future, await fn(session), None))
+                    except Exception as e:
+                        outcomes.append((future, None, e))
+                    finally:
+                        change_actor.reset(token)
+                await session.commit()
+            except Exception as e:
+                await session.rollback()
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                raise
+        self.batches += 1
+        self.writes += len(batch)
+        for future, result, error in outcomes:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+write_queue = WriteQueue()
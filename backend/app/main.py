@@ -3,10 +3,18 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
 from typing import Optional, List
-import jwt
-from datetime import datetime, timedelta
+from collections import OrderedDict
+import copy
 import sqlite3
 import json
+import logging
+import threading
+import time
+
+from core.coordination import coordinator, COORDINATION_BACKEND
+from core.tokens import verify_token, revocations, TokenError
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
@@ -19,17 +27,77 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# JWT Configuration
-SECRET_KEY = "your-secret-key"  # In production, use a secure secret key
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
-
 # Database setup
+DATABASE_PATH = 'smart_home.db'
+
+# One long-lived connection per worker thread. sqlite3 keeps a per-connection
+# cache of prepared statements, so the fixed SQL strings below are compiled
+# once per connection rather than on every request.
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+
+SELECT_SETTINGS = "SELECT settings_json FROM user_settings WHERE user_id = ?"
+INSERT_SETTINGS = "INSERT INTO user_settings (user_id, settings_json) VALUES (?, ?)"
+UPSERT_SETTINGS = "INSERT OR REPLACE INTO user_settings (user_id, settings_json) VALUES (?, ?)"
+
 def get_db():
-    conn = sqlite3.connect('smart_home.db')
-    conn.row_factory = sqlite3.Row
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False, cached_statements=64)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        _local.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
     return conn
 
+def close_connections():
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+    _local.__dict__.clear()
+
+# Read-through cache of user_settings rows; PUT writes through to it
+SETTINGS_CACHE_SIZE = 10000
+_settings_cache = OrderedDict()
+_settings_cache_lock = threading.Lock()
+
+def get_cached_settings(user_id: str) -> Optional[dict]:
+    with _settings_cache_lock:
+        settings = _settings_cache.get(user_id)
+        if settings is not None:
+            _settings_cache.move_to_end(user_id)
+        return settings
+
+def cache_settings(user_id: str, settings: dict):
+    with _settings_cache_lock:
+        _settings_cache[user_id] = settings
+        _settings_cache.move_to_end(user_id)
+        while len(_settings_cache) > SETTINGS_CACHE_SIZE:
+            _settings_cache.popitem(last=False)
+
+def invalidate_settings(user_id: str):
+    with _settings_cache_lock:
+        _settings_cache.pop(user_id, None)
+
+DEFAULT_SETTINGS = {
+    "notifications": True,
+    "emailAlerts": True,
+    "darkMode": False,
+    "temperature": "celsius",
+    "autoLock": True,
+    "energyReports": "weekly",
+    "quietHours": {
+        "enabled": False,
+        "start": "22:00",
+        "end": "07:00"
+    }
+}
+
 # Settings Models
 class UserSettings(BaseModel):
     notifications: bool
@@ -40,71 +108,95 @@ class UserSettings(BaseModel):
     energyReports: str
     quietHours: dict
 
-# Initialize database tables
-def init_db():
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    # Create settings table if it doesn't exist
-    cursor.execute('''
+# Schema migrations, applied in order, each once per database. Versions are
+# tracked in their own table: smart_home.db is shared with the main service,
+# which keeps its own in schema_migrations. Append, never edit.
+SETTINGS_MIGRATIONS = (
+    # 1: settings table
+    """
     CREATE TABLE IF NOT EXISTS user_settings (
         user_id TEXT PRIMARY KEY,
         settings_json TEXT NOT NULL
     )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    """,
+)
+
+def init_db():
+    conn = get_db()
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS settings_migrations "
+        "(version INTEGER PRIMARY KEY, applied_at REAL NOT NULL)"
+    )
+    applied = {row[0] for row in conn.execute("SELECT version FROM settings_migrations")}
+    for version, sql in enumerate(SETTINGS_MIGRATIONS, 1):
+        if version in applied:
+            continue
+        try:
+            # The insert claims the version; a worker starting alongside
+            # waits for this transaction and then skips it
+            with conn:
+                conn.execute("INSERT INTO settings_migrations (version, applied_at) VALUES (?, ?)",
+                             (version, time.time()))
+                conn.execute(sql)
+        except sqlite3.IntegrityError:
+            continue
+
+# Tokens the main service revokes (logout, deleted users) arrive over the
+# coordination backend, as they do for its own workers
+coordinator.subscribe("auth.revoke_token", lambda payload: revocations.revoke(*payload))
+coordinator.subscribe("auth.revoke_user", revocations.revoke_user)
+
+@app.on_event("startup")
+async def startup():
+    init_db()
+    if COORDINATION_BACKEND == "local":
+        logger.warning(
+            "COORDINATION_BACKEND is local: tokens revoked by the main service stay valid here "
+            "until they expire; run both services with COORDINATION_BACKEND=sqlite"
+        )
+    await coordinator.start()
 
-init_db()
+@app.on_event("shutdown")
+async def shutdown():
+    await coordinator.stop()
+    close_connections()
 
 # User authentication middleware
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Tokens are issued by the main service and verified with the same key ring
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication token")
-        return user_id
-    except jwt.JWTError:
+        claims = verify_token(token)
+    except TokenError:
         raise HTTPException(status_code=401, detail="Invalid authentication token")
+    if "settings" not in claims.scopes:
+        raise HTTPException(status_code=403, detail="Token lacks the settings scope")
+    # Settings are stored per username
+    return claims.username
 
 # Settings endpoints
 @app.get("/settings")
 async def get_settings(current_user: str = Depends(get_current_user)):
+    settings = get_cached_settings(current_user)
+    if settings is not None:
+        return settings
+
     conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute("SELECT settings_json FROM user_settings WHERE user_id = ?", (current_user,))
+    cursor.execute(SELECT_SETTINGS, (current_user,))
     result = cursor.fetchone()
     
     if result:
         settings = json.loads(result[0])
     else:
-        # Default settings
-        settings = {
-            "notifications": True,
-            "emailAlerts": True,
-            "darkMode": False,
-            "temperature": "celsius",
-            "autoLock": True,
-            "energyReports": "weekly",
-            "quietHours": {
-                "enabled": False,
-                "start": "22:00",
-                "end": "07:00"
-            }
-        }
+        settings = copy.deepcopy(DEFAULT_SETTINGS)
         # Save default settings
-        cursor.execute(
-            "INSERT INTO user_settings (user_id, settings_json) VALUES (?, ?)",
-            (current_user, json.dumps(settings))
-        )
+        cursor.execute(INSERT_SETTINGS, (current_user, json.dumps(settings)))
         conn.commit()
     
-    conn.close()
+    cache_settings(current_user, settings)
     return settings
 
 @app.put("/settings")
@@ -113,16 +205,14 @@ async def update_settings(settings: UserSettings, current_user: str = Depends(ge
     cursor = conn.cursor()
     
     try:
-        cursor.execute(
-            "INSERT OR REPLACE INTO user_settings (user_id, settings_json) VALUES (?, ?)",
-            (current_user, json.dumps(settings.dict()))
-        )
+        settings_dict = settings.dict()
+        cursor.execute(UPSERT_SETTINGS, (current_user, json.dumps(settings_dict)))
         conn.commit()
+        cache_settings(current_user, settings_dict)
         return {"message": "Settings updated successfully"}
     except Exception as e:
         conn.rollback()
+        invalidate_settings(current_user)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 # Existing routes and configurations...
@@ -0,0 +1,242 @@
+"""Load test for the hot API paths against an in-process app.
+
+Seeds a fresh SQLite database with ``--users`` x ``--devices`` devices, starts
+the app in this process and drives it over httpx's ASGI transport (no
+sockets), with ``--concurrency`` clients per scenario. Reports p50/p95/p99
+latency, throughput and errors per scenario, and the process's peak RSS.
+
+    python benchmarks/load.py --users 50 --devices 100 --requests 2000
+    python benchmarks/load.py --save-baseline benchmarks/baseline.json
+    python benchmarks/load.py --compare benchmarks/baseline.json --threshold 10
+
+With ``--compare`` the exit status is 1 if any scenario's p95 latency or
+throughput regressed by more than ``--threshold`` percent. Requires httpx
+(``pip install httpx``) in addition to the app's requirements.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "backend", "app", "core"), os.path.join(ROOT, "backend", "app", "db")]
+# Seed a throwaway database instead of smart_home.db
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/load.db")
+
+import logging  # noqa: E402
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+from auth import get_password_hash  # noqa: E402
+from database import Device, User, engine  # noqa: E402
+from migrations import migrate  # noqa: E402
+from tokens import issue_token  # noqa: E402
+
+PASSWORD = "load-test-password"
+DEVICE_TYPES = ("light", "thermostat", "lock")
+SCHEDULE = {"enabled": True, "time": "07:30", "days": ["mon", "wed", "fri"], "action": "on"}
+
+
+def seed(users: int, devices_per_user: int, seed_value: int = 1) -> list:
+    """Insert users and devices; returns ``[(username, token, devices)]``."""
+    rng = random.Random(seed_value)
+    # One hash for every user keeps seeding fast; bcrypt cost is measured by login
+    hashed = get_password_hash(PASSWORD)
+    # Seeding runs before the app's startup handlers, which would migrate
+    migrate()
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [
+            {"id": i + 1, "username": f"user{i}", "email": f"user{i}@example.com", "hashed_password": hashed}
+            for i in range(users)
+        ])
+        rows = []
+        for user in range(users):
+            for n in range(devices_per_user):
+                kind = DEVICE_TYPES[n % len(DEVICE_TYPES)]
+                rows.append({
+                    "device_id": f"u{user}-d{n}",
+                    "name": f"{kind.title()} {n}",
+                    "type": kind,
+                    "status": rng.choice(["on", "off"]),
+                    "brightness": rng.randint(0, 100) if kind == "light" else None,
+                    "temperature": round(rng.uniform(16, 26), 1) if kind == "thermostat" else None,
+                    "locked": rng.random() < 0.5 if kind == "lock" else None,
+                    "properties": {"location": rng.choice(["kitchen", "hall", "garage"])},
+                    "owner_id": user + 1,
+                })
+        connection.execute(Device.__table__.insert(), rows)
+    accounts = []
+    for user in range(users):
+        token = issue_token(f"user{user}", user + 1)
+        devices = [(f"u{user}-d{n}", DEVICE_TYPES[n % len(DEVICE_TYPES)]) for n in range(devices_per_user)]
+        accounts.append((f"user{user}", token, devices))
+    return accounts
+
+
+def pick(accounts, rng, kind=None):
+    username, token, devices = rng.choice(accounts)
+    candidates = [device_id for device_id, device_type in devices if kind is None or device_type == kind]
+    return username, {"Authorization": f"Bearer {token}"}, rng.choice(candidates)
+
+
+def scenarios(accounts):
+    """Each scenario builds one request: (method, url, kwargs)."""
+    def login(rng):
+        username, _, _ = rng.choice(accounts)
+        return "POST", "/auth/login", {"json": {"username": username, "password": PASSWORD}}
+
+    def list_devices(rng):
+        _, headers, _ = pick(accounts, rng)
+        return "GET", "/devices", {"headers": headers}
+
+    def control(rng):
+        _, headers, device_id = pick(accounts, rng, "light")
+        return "PUT", f"/devices/{device_id}/brightness", {"headers": headers, "json": rng.randint(0, 100)}
+
+    def schedule(rng):
+        _, headers, device_id = pick(accounts, rng)
+        return "PUT", f"/devices/{device_id}/schedule", {"headers": headers, "json": SCHEDULE}
+
+    def stats(rng):
+        _, headers, device_id = pick(accounts, rng)
+        return "GET", f"/devices/{device_id}/stats", {"headers": headers}
+
+    return {"login": login, "list": list_devices, "control": control, "schedule": schedule, "stats": stats}
+
+
+def percentile(ordered: list, pct: float) -> float:
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def run_scenario(client, build, requests: int, concurrency: int, seed_value: int) -> dict:
+    latencies, errors = [], 0
+    remaining = iter(range(requests))
+
+    async def worker(worker_id: int):
+        nonlocal errors
+        rng = random.Random(seed_value * 1000 + worker_id)
+        for _ in remaining:
+            method, url, kwargs = build(rng)
+            started = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+async def run_all(args) -> dict:
+    accounts = seed(args.users, args.devices)
+    selected = args.scenarios.split(",")
+    builders = scenarios(accounts)
+    results = {}
+    await main.app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://load") as client:
+            for name in selected:
+                requests = args.login_requests if name == "login" else args.requests
+                if args.warmup and name != "login":
+                    # Fill caches and connection pools; not measured
+                    await run_scenario(client, builders[name], args.warmup, args.concurrency, args.seed + 1)
+                results[name] = await run_scenario(client, builders[name], requests, args.concurrency, args.seed)
+                results[name]["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        await main.app.router.shutdown()
+    return {
+        "config": {
+            key: getattr(args, key)
+            for key in ("users", "devices", "requests", "login_requests", "concurrency", "warmup")
+        },
+        "results": results,
+    }
+
+
+def print_results(report: dict):
+    print(f"{'scenario':<10} {'reqs':>6} {'errors':>6} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'peak RSS MB':>12}")
+    for name, r in report["results"].items():
+        print(f"{name:<10} {r['requests']:>6} {r['errors']:>6} {r['throughput']:>9} "
+              f"{r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8} {r['peak_rss_mb']:>12}")
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> bool:
+    """Print changes against ``baseline``; returns True if anything regressed."""
+    if baseline.get("config") != report["config"]:
+        print(f"warning: baseline config {baseline.get('config')} differs from {report['config']}")
+    regressed = False
+    print(f"\n{'scenario':<10} {'p95 ms':>18} {'change':>8} {'req/s':>20} {'change':>8}")
+    for name, r in report["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:<10} (not in baseline)")
+            continue
+        p95_change = (r["p95_ms"] - base["p95_ms"]) / base["p95_ms"] * 100 if base["p95_ms"] else 0.0
+        rate_change = (r["throughput"] - base["throughput"]) / base["throughput"] * 100 if base["throughput"] else 0.0
+        flag = ""
+        if p95_change > threshold or rate_change < -threshold:
+            regressed = True
+            flag = "  REGRESSION"
+        print(f"{name:<10} {base['p95_ms']:>8} -> {r['p95_ms']:<7} {p95_change:>+7.1f}% "
+              f"{base['throughput']:>9} -> {r['throughput']:<8} {rate_change:>+7.1f}%{flag}")
+    return regressed
+
+
+def run(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--devices", type=int, default=50, help="devices per user")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario")
+    parser.add_argument("--login-requests", type=int, default=100, help="login is bcrypt-bound")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=100, help="unmeasured requests per scenario")
+    parser.add_argument("--scenarios", default="login,list,control,schedule,stats")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--compare", metavar="PATH")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed regression, percent")
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.INFO)
+    report = asyncio.run(run_all(args))
+    print_results(report)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline written to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
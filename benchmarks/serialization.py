@@ -0,0 +1,106 @@
+"""Per-device cost of encoding a GET /devices response.
+
+Compares FastAPI's generic path (ORM objects validated into the pydantic
+``Device`` model, then ``jsonable_encoder`` and ``json.dumps``) with the
+row encoder used by the device routes, uncached and with cached fragments.
+
+    python benchmarks/serialization.py --devices 1000 --repeat 20
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "backend", "app", "core"), os.path.join(ROOT, "backend", "app", "db")]
+# Keep the app's engines pointed away from smart_home.db
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+
+import json  # noqa: E402
+from typing import List  # noqa: E402
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+
+import main  # noqa: E402
+from database import Device as DBDevice, PROPERTY_COLUMNS  # noqa: E402
+from serialization import DeviceEncoder  # noqa: E402
+
+
+def make_devices(count: int, seed: int = 1) -> List[DBDevice]:
+    rng = random.Random(seed)
+    devices = []
+    for i in range(count):
+        kind = rng.choice(["light", "thermostat", "lock"])
+        properties = {"location": rng.choice(["kitchen", "hall", "garage"])}
+        if kind == "light":
+            properties.update(brightness=rng.randint(0, 100), color=f"#{rng.randrange(1 << 24):06x}")
+        elif kind == "thermostat":
+            properties.update(temperature=round(rng.uniform(16, 26), 1), mode="heat")
+        else:
+            properties.update(locked=rng.random() < 0.5)
+        if rng.random() < 0.3:
+            properties["schedule"] = {"enabled": True, "time": "07:30", "days": ["mon", "fri"], "action": "on"}
+        devices.append(DBDevice(
+            id=i + 1, device_id=f"device-{i}", name=f"Device {i}", type=kind,
+            status=rng.choice(["on", "off"]), properties=properties, version=1,
+        ))
+    return devices
+
+
+def as_row(device: DBDevice) -> dict:
+    row = {column: getattr(device, column) for column in PROPERTY_COLUMNS}
+    row.update(
+        id=device.id, device_id=device.device_id, name=device.name, type=device.type,
+        status=device.status, extra=device.extra, version=device.version,
+    )
+    return row
+
+
+def best_of(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    devices = make_devices(args.devices)
+    rows = [as_row(device) for device in devices]
+    adapter = TypeAdapter(List[main.Device])
+
+    def generic():
+        models = adapter.validate_python(devices, from_attributes=True)
+        content = jsonable_encoder(models)
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+    uncached = DeviceEncoder(main.DeviceProperties.model_fields, cache_size=0)
+    cached = DeviceEncoder(main.DeviceProperties.model_fields, cache_size=args.devices)
+    cached.encode_list(rows)
+
+    # Both paths must produce the same document
+    assert json.loads(generic()) == json.loads(uncached.encode_list(rows)) == json.loads(cached.encode_list(rows))
+
+    results = [
+        ("pydantic + jsonable_encoder", best_of(generic, args.repeat)),
+        ("row encoder", best_of(lambda: uncached.encode_list(rows), args.repeat)),
+        ("row encoder, cached", best_of(lambda: cached.encode_list(rows), args.repeat)),
+    ]
+    baseline = results[0][1]
+    print(f"{args.devices} devices, best of {args.repeat}")
+    for name, seconds in results:
+        per_device = seconds / args.devices * 1e6
+        print(f"  {name:<28} {per_device:8.2f} us/device  {baseline / seconds:6.1f}x")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,438 @@
+"""Virtual device fleet for load and soak tests against a running app.
+
+Provisions ``--accounts`` users with ``--devices`` virtual lights,
+thermostats and locks each (through the bulk import), then for
+``--duration`` seconds:
+
+- every device posts telemetry every ``--telemetry-interval`` seconds, one
+  sample per ``--sample-period``, its power draw following its state;
+- devices change state on their own (a light switched at the wall, a lock
+  turned by hand, a thermostat nudged) at ``--state-rate`` changes per
+  second across the fleet;
+- a controller sends ``--command-rate`` commands per second (status,
+  brightness, temperature, lock) to random devices.
+
+Each account's devices follow the app's live update stream (SSE) and apply
+the changes they receive, which is how they respond to commands. A
+command's end-to-end latency runs from sending it until its device sees
+the change. Every ``--report-interval`` seconds and at the end the
+simulator prints command latency (request and end-to-end), telemetry
+ingestion throughput and errors.
+
+    python main.py &    # or: WEB_CONCURRENCY=4 python main.py &
+    python benchmarks/simulator.py --accounts 10 --devices 300 --duration 600
+    python benchmarks/simulator.py --duration 3600 --output soak.json
+
+Arrivals are open-loop (Poisson), so a slow server shows up as latency
+rather than as a lower offered load. Requires httpx (``pip install httpx``).
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import defaultdict
+
+import httpx
+
+PASSWORD = "simulator-password"
+DEVICE_TYPES = ("light", "thermostat", "lock")
+# Tokens last 30 minutes; log in again well before that
+TOKEN_REFRESH = 20 * 60
+IMPORT_CHUNK = 5000
+# The server's limit on samples per telemetry post
+MAX_TELEMETRY_SAMPLES = 1000
+
+
+def percentile(ordered: list, pct: float) -> float:
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class VirtualDevice:
+    """State and power model of one simulated device."""
+
+    def __init__(self, device_id: str, kind: str, rng: random.Random):
+        self.device_id = device_id
+        self.kind = kind
+        self.status = rng.choice(["on", "off"]) if kind != "lock" else "locked"
+        self.brightness = rng.randint(10, 100) if kind == "light" else None
+        self.temperature = round(rng.uniform(18, 23), 1) if kind == "thermostat" else None
+        self.locked = True if kind == "lock" else None
+        self.ambient = rng.uniform(14, 20)
+
+    def record(self) -> dict:
+        properties = {"location": "simulated"}
+        for key in ("brightness", "temperature", "locked"):
+            if getattr(self, key) is not None:
+                properties[key] = getattr(self, key)
+        return {"device_id": self.device_id, "name": f"Sim {self.kind} {self.device_id}",
+                "type": self.kind, "status": self.status, "properties": properties}
+
+    def apply(self, delta: dict):
+        """Apply a live update from the app."""
+        if "status" in delta:
+            self.status = delta["status"]
+        properties = delta.get("properties") or {}
+        for key in ("brightness", "temperature", "locked"):
+            if properties.get(key) is not None:
+                setattr(self, key, properties[key])
+
+    def power(self) -> float:
+        """Current draw in watts."""
+        if self.kind == "light":
+            return 1.0 + 9.0 * self.brightness / 100 if self.status == "on" else 0.3
+        if self.kind == "thermostat":
+            if self.status != "on":
+                return 2.0
+            # Heating duty cycle grows with the gap to the target
+            duty = min(1.0, max(0.0, (self.temperature - self.ambient) / 5))
+            return 2.0 + 2000.0 * duty
+        return 0.5
+
+
+class Stats:
+    """Latencies and counters, per reporting interval and for the whole run."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.counts = defaultdict(int)
+        self.total_latencies = defaultdict(list)
+        self.total_counts = defaultdict(int)
+        self.started = self.interval_started = time.perf_counter()
+        self.cpu_started = self.interval_cpu_started = time.process_time()
+
+    def observe(self, name: str, seconds: float):
+        self.latencies[name].append(seconds)
+        self.total_latencies[name].append(seconds)
+
+    def count(self, name: str, n: int = 1):
+        self.counts[name] += n
+        self.total_counts[name] += n
+
+    @staticmethod
+    def _summary(latencies, counts, elapsed, cpu) -> dict:
+        summary = {
+            "elapsed_s": round(elapsed, 1),
+            # Near 100% means the simulator, not the app, is the bottleneck
+            "client_cpu_pct": round(100 * cpu / elapsed, 1) if elapsed else 0.0,
+            "counts": dict(counts),
+            "latency": {},
+        }
+        for name, values in latencies.items():
+            ordered = sorted(values)
+            summary["latency"][name] = {
+                "n": len(ordered),
+                "per_s": round(len(ordered) / elapsed, 1) if elapsed else 0.0,
+                "p50_ms": round(percentile(ordered, 50) * 1000, 2),
+                "p95_ms": round(percentile(ordered, 95) * 1000, 2),
+                "p99_ms": round(percentile(ordered, 99) * 1000, 2),
+                "max_ms": round(ordered[-1] * 1000, 2) if ordered else 0.0,
+            }
+        summary["samples_per_s"] = round(counts.get("samples", 0) / elapsed, 1) if elapsed else 0.0
+        return summary
+
+    def interval(self) -> dict:
+        now, cpu = time.perf_counter(), time.process_time()
+        summary = self._summary(self.latencies, self.counts, now - self.interval_started,
+                                cpu - self.interval_cpu_started)
+        self.latencies, self.counts = defaultdict(list), defaultdict(int)
+        self.interval_started, self.interval_cpu_started = now, cpu
+        return summary
+
+    def total(self) -> dict:
+        return self._summary(self.total_latencies, self.total_counts, time.perf_counter() - self.started,
+                             time.process_time() - self.cpu_started)
+
+
+def print_summary(title: str, summary: dict):
+    counts = summary["counts"]
+    print(f"\n{title} ({summary['elapsed_s']}s): {summary['samples_per_s']} samples/s ingested, "
+          f"{counts.get('errors', 0)} errors, {counts.get('resyncs', 0)} resyncs, "
+          f"{counts.get('lost', 0)} commands unconfirmed, simulator CPU {summary['client_cpu_pct']}%")
+    print(f"{'':<16} {'n':>7} {'per s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>9}")
+    for name, r in sorted(summary["latency"].items()):
+        print(f"{name:<16} {r['n']:>7} {r['per_s']:>8} {r['p50_ms']:>8} {r['p95_ms']:>8} "
+              f"{r['p99_ms']:>8} {r['max_ms']:>9}")
+
+
+class Account:
+    """A user of the app and its virtual devices."""
+
+    def __init__(self, username: str, devices: list):
+        self.username = username
+        self.devices = {device.device_id: device for device in devices}
+        self.token = None
+        # Commands awaiting confirmation over the live stream:
+        # device_id -> (sent_at, field, value)
+        self.pending = {}
+
+    @property
+    def headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.token}"}
+
+
+class Simulator:
+    def __init__(self, client: httpx.AsyncClient, streams: httpx.AsyncClient, args):
+        self.client = client
+        # Live streams hold a connection each, so they get their own pool
+        self.streams = streams
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.stats = Stats()
+        self.accounts = []
+        self._tasks = set()
+
+    async def request(self, name: str, method: str, url: str, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            self.stats.count("errors")
+            self.stats.count(f"errors.{name}")
+            if self.args.verbose:
+                print(f"{name} failed: {e!r}", file=sys.stderr)
+            return None
+        self.stats.observe(name, time.perf_counter() - started)
+        if response.status_code >= 400:
+            self.stats.count("errors")
+            self.stats.count(f"errors.{name}")
+            if self.args.verbose:
+                print(f"{name} {response.status_code}: {response.text[:200]}", file=sys.stderr)
+            return None
+        return response
+
+    async def login(self, account: Account):
+        response = await self.client.post("/auth/login", json={"username": account.username, "password": PASSWORD})
+        response.raise_for_status()
+        account.token = response.json()["access_token"]
+
+    async def provision(self):
+        """Create (or reuse) the accounts and import their devices."""
+        for a in range(self.args.accounts):
+            username = f"{self.args.prefix}{a}"
+            devices = [
+                VirtualDevice(f"{self.args.prefix}{a}-{n}", DEVICE_TYPES[n % len(DEVICE_TYPES)], self.rng)
+                for n in range(self.args.devices)
+            ]
+            account = Account(username, devices)
+            response = await self.client.post("/auth/signup", json={
+                "username": username, "email": f"{username}@example.com", "password": PASSWORD,
+            })
+            if response.status_code < 400:
+                account.token = response.json()["access_token"]
+            elif "already registered" in response.text:
+                # Left over from an earlier run; its devices are replaced by the import
+                await self.login(account)
+            else:
+                raise RuntimeError(f"Signup for {username} failed: {response.text}")
+            records = [device.record() for device in devices]
+            for i in range(0, len(records), IMPORT_CHUNK):
+                body = "".join(json.dumps(record) + "\n" for record in records[i:i + IMPORT_CHUNK])
+                response = await self.client.post("/devices:import", headers=account.headers, content=body,
+                                                  timeout=None)
+                response.raise_for_status()
+                report = response.json()
+                if report["failed"]:
+                    raise RuntimeError(f"Import for {username} failed: {report['errors'][:5]}")
+            self.accounts.append(account)
+        print(f"Provisioned {len(self.accounts)} accounts with {self.args.devices} devices each")
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def follow(self, account: Account):
+        """Apply live updates to the account's devices, confirming commands."""
+        while True:
+            try:
+                async with self.streams.stream("GET", "/devices/events", params={"token": account.token},
+                                              timeout=httpx.Timeout(None, connect=10)) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data: "):
+                            continue
+                        message = json.loads(line[6:])
+                        if message["type"] == "resync":
+                            self.stats.count("resyncs")
+                            continue
+                        received = time.perf_counter()
+                        for delta in message["deltas"]:
+                            device = account.devices.get(delta["device_id"])
+                            if device is None:
+                                continue
+                            device.apply(delta)
+                            self.confirm(account, delta, received)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats.count("errors")
+                self.stats.count("errors.stream")
+                if self.args.verbose:
+                    print(f"Live stream for {account.username} failed: {e!r}", file=sys.stderr)
+                await asyncio.sleep(1)
+
+    def confirm(self, account: Account, delta: dict, received: float):
+        pending = account.pending.get(delta["device_id"])
+        if pending is None:
+            return
+        sent_at, field, value = pending
+        observed = delta.get(field) if field == "status" else (delta.get("properties") or {}).get(field)
+        if observed == value:
+            del account.pending[delta["device_id"]]
+            self.stats.observe("command_e2e", received - sent_at)
+
+    async def command(self):
+        account = self.rng.choice(self.accounts)
+        device = self.rng.choice(list(account.devices.values()))
+        url = f"/devices/{device.device_id}"
+        if device.kind == "light" and self.rng.random() < 0.7:
+            field, value = "brightness", self.rng.randint(0, 100)
+            url, kwargs = f"{url}/brightness", {"json": value}
+        elif device.kind == "thermostat" and self.rng.random() < 0.7:
+            field, value = "temperature", round(self.rng.uniform(16, 26), 1)
+            url, kwargs = f"{url}/temperature", {"json": value}
+        elif device.kind == "lock":
+            field, value = "locked", not device.locked
+            url, kwargs = f"{url}/lock", {"json": value}
+        else:
+            field, value = "status", "off" if device.status == "on" else "on"
+            url, kwargs = f"{url}/status", {"params": {"status": value}}
+        if device.device_id in account.pending:
+            # The previous command was never seen (or is superseded)
+            self.stats.count("lost")
+        account.pending[device.device_id] = (time.perf_counter(), field, value)
+        if await self.request("command", "PUT", url, headers=account.headers, **kwargs) is None:
+            account.pending.pop(device.device_id, None)
+
+    async def state_change(self):
+        """A device changed by hand reports its new state."""
+        account = self.rng.choice(self.accounts)
+        device = self.rng.choice(list(account.devices.values()))
+        if device.kind == "lock":
+            await self.request("state_change", "PUT", f"/devices/{device.device_id}/lock",
+                               headers=account.headers, json=not device.locked)
+        elif device.kind == "thermostat":
+            target = round(min(32, max(10, device.temperature + self.rng.choice((-0.5, 0.5)))), 1)
+            await self.request("state_change", "PUT", f"/devices/{device.device_id}/temperature",
+                               headers=account.headers, json=target)
+        else:
+            await self.request("state_change", "PUT", f"/devices/{device.device_id}/status",
+                               headers=account.headers, params={"status": "off" if device.status == "on" else "on"})
+
+    async def telemetry(self, account: Account, device: VirtualDevice):
+        interval = self.args.telemetry_interval
+        period = min(self.args.sample_period, interval)
+        # Spread the fleet's posts over the interval
+        await asyncio.sleep(self.rng.uniform(0, interval))
+        last = time.time()
+        while True:
+            await asyncio.sleep(interval)
+            now = time.time()
+            samples, ts = [], last + period
+            while ts <= now:
+                power = device.power() * self.rng.uniform(0.95, 1.05)
+                runtime = period if device.status != "off" else 0
+                samples.append({"timestamp": ts, "power": round(power, 2), "runtime": runtime})
+                ts += period
+            last = ts - period
+            if not samples:
+                continue
+            response = await self.request("telemetry", "POST", f"/devices/{device.device_id}/telemetry",
+                                          headers=account.headers, json={"samples": samples})
+            if response is not None:
+                self.stats.count("samples", response.json()["accepted"])
+
+    async def poisson(self, rate: float, action):
+        """Start ``action()`` at exponentially distributed intervals."""
+        if rate <= 0:
+            return
+        while True:
+            await asyncio.sleep(self.rng.expovariate(rate))
+            self.spawn(action())
+
+    async def refresh_tokens(self):
+        while True:
+            await asyncio.sleep(TOKEN_REFRESH)
+            for account in self.accounts:
+                try:
+                    await self.login(account)
+                except httpx.HTTPError as e:
+                    self.stats.count("errors")
+                    print(f"Token refresh for {account.username} failed: {e!r}", file=sys.stderr)
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(self.args.report_interval)
+            print_summary("interval", self.stats.interval())
+
+    async def run(self) -> dict:
+        await self.provision()
+        loops = [self.follow(account) for account in self.accounts]
+        loops += [self.telemetry(account, device) for account in self.accounts for device in account.devices.values()]
+        loops += [
+            self.poisson(self.args.command_rate, self.command),
+            self.poisson(self.args.state_rate, self.state_change),
+            self.refresh_tokens(),
+            self.report(),
+        ]
+        tasks = [asyncio.create_task(loop) for loop in loops]
+        # Let the live streams connect before measuring
+        await asyncio.sleep(1)
+        self.stats = Stats()
+        print(f"Simulating {sum(len(a.devices) for a in self.accounts)} devices for {self.args.duration}s")
+        try:
+            await asyncio.sleep(self.args.duration)
+        finally:
+            for task in tasks + list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*tasks, *self._tasks, return_exceptions=True)
+        summary = self.stats.total()
+        summary["counts"]["lost"] = summary["counts"].get("lost", 0) + sum(len(a.pending) for a in self.accounts)
+        return summary
+
+
+async def run_simulation(args) -> dict:
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client, \
+            httpx.AsyncClient(base_url=args.url, limits=httpx.Limits(max_connections=None)) as streams:
+        return await Simulator(client, streams, args).run()
+
+
+def run(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--accounts", type=int, default=10)
+    parser.add_argument("--devices", type=int, default=300, help="devices per account")
+    parser.add_argument("--duration", type=float, default=60, help="seconds")
+    parser.add_argument("--telemetry-interval", type=float, default=10, help="seconds between posts per device")
+    parser.add_argument("--sample-period", type=float, default=1, help="seconds between samples")
+    parser.add_argument("--command-rate", type=float, default=20, help="commands per second")
+    parser.add_argument("--state-rate", type=float, default=5, help="device-initiated changes per second")
+    parser.add_argument("--connections", type=int, default=100, help="HTTP connection pool size")
+    parser.add_argument("--timeout", type=float, default=30, help="request timeout, seconds")
+    parser.add_argument("--report-interval", type=float, default=10, help="seconds")
+    parser.add_argument("--prefix", default="sim", help="username and device id prefix")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", metavar="PATH", help="write the final summary as JSON")
+    parser.add_argument("--verbose", action="store_true", help="print each failed request")
+    args = parser.parse_args(argv)
+    if args.telemetry_interval / min(args.sample_period, args.telemetry_interval) > MAX_TELEMETRY_SAMPLES:
+        parser.error(f"--telemetry-interval / --sample-period must be at most {MAX_TELEMETRY_SAMPLES} "
+                     "(samples per telemetry post)")
+
+    summary = asyncio.run(run_simulation(args))
+    print_summary("total", summary)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "summary": summary}, f, indent=2)
+        print(f"\nSummary written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -46,20 +46,20 @@ const Analytics = () => {
     try {
       setLoading(true);
       const token = localStorage.getItem('token');
-      
-      // Simulated data - replace with actual API calls
-      const mockEnergyData = generateMockEnergyData(timeRange);
-      const mockDeviceUsage = generateMockDeviceUsage();
-      const mockSummary = {
-        totalDevices: 12,
-        activeDevices: 8,
-        totalEnergy: 450,
-        averageUsage: 37.5,
+      const config = {
+        headers: { Authorization: `Bearer ${token}` },
+        params: { timeRange },
       };
 
-      setEnergyData(mockEnergyData);
-      setDeviceUsage(mockDeviceUsage);
-      setSummary(mockSummary);
+      const [energyResponse, summaryResponse] = await Promise.all([
+        axios.get('http://localhost:8000/analytics/energy', config),
+        axios.get('http://localhost:8000/analytics/summary', config),
+      ]);
+      const { deviceUsage: usageByType, ...summaryData } = summaryResponse.data;
+
+      setEnergyData(energyResponse.data);
+      setDeviceUsage(usageByType);
+      setSummary(summaryData);
     } catch (error) {
       console.error('Error fetching analytics data:', error);
     } finally {
@@ -67,30 +67,6 @@ const Analytics = () => {
     }
   };
 
-  const generateMockEnergyData = (range) => {
-    const data = [];
-    const days = range === 'week' ? 7 : range === 'month' ? 30 : 12;
-    
-    for (let i = 0; i < days; i++) {
-      data.push({
-        name: range === 'year' ? `Month ${i + 1}` : `Day ${i + 1}`,
-        energy: Math.floor(Math.random() * 50) + 20,
-        cost: Math.floor(Math.random() * 30) + 10,
-      });
-    }
-    return data;
-  };
-
-  const generateMockDeviceUsage = () => {
-    return [
-      { name: 'Smart Lights', usage: 35 },
-      { name: 'Thermostat', usage: 25 },
-      { name: 'Security Cameras', usage: 20 },
-      { name: 'Smart Plugs', usage: 15 },
-      { name: 'Other Devices', usage: 5 },
-    ];
-  };
-
   return (
     <Box sx={{ p: 3, height: '100%', overflow: 'auto' }}>
       <Typography variant="h4" sx={{ mb: 4 }}>
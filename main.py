@@ -1,24 +1,64 @@
+# Imported first: the startup report's clock starts with it
+from startup import startup_report
+
 from datetime import timedelta
-from typing import List, Optional
-from fastapi import FastAPI, HTTPException, Depends, status, Query, Body
-from fastapi.responses import JSONResponse
+from typing import Annotated, List, Literal, Optional, Union
+from fastapi import FastAPI, HTTPException, Depends, status, Query, Body, Header, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from pydantic import BaseModel, ConfigDict, EmailStr
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from pydantic import BaseModel, ConfigDict, EmailStr, Field, TypeAdapter, ValidationError, field_validator
 import uvicorn
+import asyncio
+import base64
+import json
+import orjson
 import logging
-import random
 from datetime import datetime
 
-from database import get_db, Device as DBDevice, User as DBUser
+from database import (
+    get_db, async_engine, AsyncSessionLocal, PROPERTY_COLUMNS,
+    AutomationRule as DBRule, Device as DBDevice, User as DBUser
+)
+from coordination import coordinator, Leadership
+from events import device_events
+from hashing import hashing_pool
+from migrations import migrate
+from history import device_history, change_actor, ChangeActor
+from metrics import (
+    metrics, monitor_loop_lag, startup_seconds, startup_phase_seconds, MetricsMiddleware,
+    CONTENT_TYPE as METRICS_CONTENT_TYPE
+)
+from profiler import profiler, ProfilerMiddleware, PROFILER_ENABLED
+from rules import rules_engine, compile_rule, RuleError, TRIGGER_OPS, CONDITION_OPS
+from scheduler import device_scheduler
+from telemetry import telemetry_store
+from writer import write_queue
+from workers import WorkerSupervisor, WORKERS
+from analytics import energy_summary, TIME_RANGES
+from controls import control_buffer, BUFFERED_COMMANDS
+from serialization import DeviceEncoder, DEVICE_FIELDS
+from bulk import (
+    iter_records, export_document, encode_csv, encode_ndjson, RecordError,
+    BULK_FORMATS, BULK_MEDIA_TYPES
+)
 from auth import (
     get_current_user,
+    get_admin_user,
+    get_token_claims,
+    require_scope,
+    claims_from_token,
+    revoke_token,
     create_access_token,
-    get_password_hash,
+    get_password_hash_async,
     authenticate_user,
     ACCESS_TOKEN_EXPIRE_MINUTES
 )
+from tokens import TokenClaims
+
+startup_report.mark("imports")
 
 # Configure logging
 logging.basicConfig(
@@ -36,7 +76,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Devices-Version", "X-Next-Cursor"],
 )
+if PROFILER_ENABLED:
+    app.add_middleware(ProfilerMiddleware)
+# Outermost, so its timings include every other middleware
+app.add_middleware(MetricsMiddleware)
 
 # Pydantic models
 class UserBase(BaseModel):
@@ -54,9 +99,7 @@ class UserResponse(BaseModel):
     id: int
     username: str
     email: str
-    
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 class Token(BaseModel):
     access_token: str
@@ -110,10 +153,288 @@ class DeviceSettings(BaseModel):
     motionSensor: Optional[bool] = None
     energySaving: Optional[bool] = None
 
+# Batch device commands; each value is validated like the matching single-device endpoint
+class StatusCommand(BaseModel):
+    device_id: str
+    command: Literal["status"]
+    value: str
+
+class BrightnessCommand(BaseModel):
+    device_id: str
+    command: Literal["brightness"]
+    value: int = Field(..., ge=0, le=100)
+
+class TemperatureCommand(BaseModel):
+    device_id: str
+    command: Literal["temperature"]
+    value: float = Field(..., ge=10, le=32)
+
+class ColorCommand(BaseModel):
+    device_id: str
+    command: Literal["color"]
+    value: str = Field(..., pattern="^#[0-9A-Fa-f]{6}$")
+
+class LockCommand(BaseModel):
+    device_id: str
+    command: Literal["lock"]
+    value: bool
+
+DeviceCommand = Annotated[
+    Union[StatusCommand, BrightnessCommand, TemperatureCommand, ColorCommand, LockCommand],
+    Field(discriminator="command"),
+]
+
+MAX_BATCH_COMMANDS = 1000
+
+DEVICE_COMMAND_NAMES = ("status", "brightness", "temperature", "color", "lock")
+device_command_adapter = TypeAdapter(DeviceCommand)
+
+class DeviceCommandBatch(BaseModel):
+    commands: List[DeviceCommand] = Field(..., min_length=1, max_length=MAX_BATCH_COMMANDS)
+
+# Bulk import rows carry the full device state; properties beyond the typed
+# ones (schedule, settings) are kept as given, so an export re-imports as is
+class ImportedDeviceProperties(DeviceProperties):
+    model_config = ConfigDict(extra="allow")
+
+class DeviceImport(BaseModel):
+    device_id: str = Field(..., min_length=1)
+    name: str
+    type: str
+    status: str
+    properties: ImportedDeviceProperties = Field(default_factory=ImportedDeviceProperties)
+
+# Automation rules: when the trigger property changes (or crosses a
+# threshold) and every condition holds, run the actions
+RuleValue = Union[bool, int, float, str, None]
+
+class RuleTrigger(BaseModel):
+    device_id: str
+    property: str
+    op: Literal[TRIGGER_OPS] = "changes"
+    value: RuleValue = None
+
+class RuleCondition(BaseModel):
+    device_id: str
+    property: str
+    op: Literal[CONDITION_OPS]
+    value: RuleValue = None
+
+class RuleAction(BaseModel):
+    device_id: str
+    command: Literal[tuple(DEVICE_COMMAND_NAMES)]
+    value: RuleValue
+    delay: float = Field(0, ge=0, le=86400)  # seconds; restarted if the rule fires again
+
+class RuleCreate(BaseModel):
+    name: str
+    enabled: bool = True
+    trigger: RuleTrigger
+    conditions: List[RuleCondition] = Field(default_factory=list, max_length=20)
+    actions: List[RuleAction] = Field(..., min_length=1, max_length=50)
+
+class RuleResponse(RuleCreate):
+    id: int
+
+# Most samples one telemetry request may carry, and how far ahead of this
+# server's clock a sample may be stamped (seconds): buckets in the future
+# would outlive retention
+MAX_TELEMETRY_SAMPLES = 1000
+MAX_TELEMETRY_CLOCK_SKEW = 300
+
+class TelemetrySample(BaseModel):
+    timestamp: Optional[datetime] = None  # defaults to time of receipt
+    power: float = Field(..., ge=0)  # watts
+    runtime: float = Field(0, ge=0)  # seconds on since the previous sample
+
+    @field_validator("timestamp")
+    @classmethod
+    def not_in_future(cls, timestamp: Optional[datetime]) -> Optional[datetime]:
+        if timestamp is not None and timestamp.timestamp() > datetime.now().timestamp() + MAX_TELEMETRY_CLOCK_SKEW:
+            raise ValueError("Timestamp is in the future")
+        return timestamp
+
+class TelemetryBatch(BaseModel):
+    samples: List[TelemetrySample] = Field(..., max_length=MAX_TELEMETRY_SAMPLES)
+
+# Schema migrations run once per database, before anything reads it (see
+# migrations.py); with nothing pending this is two quick queries
+@app.on_event("startup")
+@startup_report.timed("migrations")
+async def prepare_database():
+    await asyncio.to_thread(migrate)
+
+# Cross-worker coordination (see coordination.py). Started right after the
+# migrations, before any other component, and stopped after all of them
+# (only the database closes later), so every other component can publish
+# while it runs. Handlers are subscribed here rather than at import: worker
+# processes also import this module as __mp_main__, whose app never starts.
+@app.on_event("startup")
+@startup_report.timed("coordinator")
+async def start_coordinator():
+    coordinator.subscribe("telemetry", ingest_remote_telemetry)
+    coordinator.subscribe("analytics.invalidate", energy_summary.invalidate)
+    coordinator.subscribe("rules.changed", rules_engine.reload)
+    metrics.add_collector(component_metrics)
+    await coordinator.start()
+
+def ingest_remote_telemetry(payload):
+    user_id, device_id, device_type, samples = payload
+    # Stored by the worker that received it; this worker only updates its views
+    telemetry_store.ingest(device_id, samples, persist=False)
+    energy_summary.record(user_id, device_type, samples)
+
+# Telemetry is buffered in memory and flushed in the background
+TELEMETRY_FLUSH_INTERVAL = 5
+# How often the leader applies telemetry retention
+TELEMETRY_MAINTENANCE_INTERVAL = 3600
+
+async def flush_telemetry_periodically():
+    while True:
+        await asyncio.sleep(TELEMETRY_FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(telemetry_store.flush)
+        except Exception as e:
+            logger.error(f"Error flushing telemetry: {str(e)}")
+
+async def maintain_telemetry_periodically():
+    while True:
+        try:
+            expired = await asyncio.to_thread(telemetry_store.expire)
+            if expired:
+                logger.info(f"Telemetry: expired {expired} rollups and chunks")
+        except Exception as e:
+            logger.error(f"Error expiring telemetry: {str(e)}")
+        await asyncio.sleep(TELEMETRY_MAINTENANCE_INTERVAL)
+
+@app.on_event("startup")
+async def start_telemetry_flusher():
+    app.state.telemetry_flusher = asyncio.create_task(flush_telemetry_periodically())
+
+@app.on_event("shutdown")
+async def stop_telemetry_flusher():
+    app.state.telemetry_flusher.cancel()
+    telemetry_store.flush(seal_all=True)
+
+# Device history is buffered like telemetry, but flushed more often so it
+# can be queried soon after a change
+HISTORY_FLUSH_INTERVAL = 1
+# How often the leader applies history retention and compaction
+HISTORY_MAINTENANCE_INTERVAL = 3600
+
+async def flush_history_periodically():
+    while True:
+        await asyncio.sleep(HISTORY_FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(device_history.flush)
+        except Exception as e:
+            logger.error(f"Error flushing device history: {str(e)}")
+
+async def maintain_history_periodically():
+    while True:
+        try:
+            expired = await asyncio.to_thread(device_history.expire)
+            compacted = await asyncio.to_thread(device_history.compact)
+            if expired or compacted:
+                logger.info(f"Device history: expired {expired} changes, compacted {compacted}")
+        except Exception as e:
+            logger.error(f"Error maintaining device history: {str(e)}")
+        await asyncio.sleep(HISTORY_MAINTENANCE_INTERVAL)
+
+@app.on_event("startup")
+async def start_history_flusher():
+    app.state.history_flusher = asyncio.create_task(flush_history_periodically())
+
+@app.on_event("startup")
+async def start_loop_lag_monitor():
+    app.state.loop_lag_monitor = asyncio.create_task(monitor_loop_lag())
+
+@app.on_event("shutdown")
+async def stop_loop_lag_monitor():
+    app.state.loop_lag_monitor.cancel()
+
+@app.on_event("startup")
+async def start_write_queue():
+    write_queue.start()
+
+# Only one worker fires schedules and automation rules and maintains the
+# device history and telemetry; another takes over if it goes away. The executors are
+# defined with the device routes below.
+async def start_automation():
+    await device_scheduler.start(run_scheduled_actions)
+    await rules_engine.start(run_automation_actions)
+    app.state.history_maintenance = asyncio.create_task(maintain_history_periodically())
+    app.state.telemetry_maintenance = asyncio.create_task(maintain_telemetry_periodically())
+
+async def stop_automation():
+    app.state.telemetry_maintenance.cancel()
+    app.state.history_maintenance.cancel()
+    await rules_engine.stop()
+    await device_scheduler.stop()
+
+automation_leadership = Leadership("automation", on_elected=start_automation, on_revoked=stop_automation)
+
+@app.on_event("startup")
+@startup_report.timed("automation")
+async def start_scheduler():
+    await automation_leadership.start()
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    await automation_leadership.stop()
+
+@app.on_event("startup")
+@startup_report.timed("control_buffer")
+async def start_control_buffer():
+    # run_control_commands is defined with the device routes below
+    await control_buffer.start(run_control_commands)
+
+# Registered last, so it runs after every other startup handler
+@app.on_event("startup")
+async def report_startup():
+    startup_seconds.set(startup_report.finish())
+    for phase, seconds in startup_report.phases.items():
+        startup_phase_seconds.set(seconds, (phase,))
+    startup_report.log()
+
+@app.on_event("shutdown")
+async def stop_control_buffer():
+    # Before the write queue stops, so buffered values are persisted
+    await control_buffer.stop()
+
+@app.on_event("shutdown")
+async def stop_write_queue():
+    await write_queue.stop()
+
+@app.on_event("shutdown")
+async def stop_history_flusher():
+    # After the write queue, so its last commits are logged
+    app.state.history_flusher.cancel()
+    device_history.flush()
+
+@app.on_event("shutdown")
+async def stop_hashing_pool():
+    hashing_pool.shutdown()
+
+@app.on_event("shutdown")
+async def stop_profiler():
+    if profiler.active:
+        await asyncio.to_thread(profiler.stop)
+
+@app.on_event("shutdown")
+async def stop_coordinator():
+    await coordinator.stop()
+
+@app.on_event("shutdown")
+async def close_database():
+    # Pooled aiosqlite connections each own a thread; close them so the
+    # process can exit
+    await async_engine.dispose()
+
 @app.post("/auth/login", response_model=LoginResponse)
 async def login_for_access_token(
     form_data: dict,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     try:
         username = form_data.get("username")
@@ -128,7 +449,7 @@ async def login_for_access_token(
                 detail="Username and password are required"
             )
             
-        user = authenticate_user(db, username, password)
+        user = await authenticate_user(db, username, password)
         if not user:
             logger.warning(f"Failed login attempt for username: {username}")
             raise HTTPException(
@@ -138,9 +459,7 @@ async def login_for_access_token(
             )
             
         access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(
-            data={"sub": user.username}, expires_delta=access_token_expires
-        )
+        access_token = create_access_token(user, expires_delta=access_token_expires)
         
         # Create a response that matches the LoginResponse model
         response_data = {
@@ -167,7 +486,7 @@ async def login_for_access_token(
         )
 
 @app.post("/auth/signup", response_model=SignupResponse)
-async def create_user(user: UserCreate, db: Session = Depends(get_db)):
+async def create_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
     try:
         logger.info(f"Attempting to create user with username: {user.username}")
         
@@ -196,7 +515,7 @@ async def create_user(user: UserCreate, db: Session = Depends(get_db)):
             )
         
         # Check if username exists
-        db_user = db.query(DBUser).filter(DBUser.username == user.username).first()
+        db_user = await db.scalar(select(DBUser).where(DBUser.username == user.username))
         if db_user:
             logger.warning(f"Username already exists: {user.username}")
             raise HTTPException(
@@ -205,7 +524,7 @@ async def create_user(user: UserCreate, db: Session = Depends(get_db)):
             )
         
         # Check if email exists
-        db_user = db.query(DBUser).filter(DBUser.email == user.email).first()
+        db_user = await db.scalar(select(DBUser).where(DBUser.email == user.email))
         if db_user:
             logger.warning(f"Email already exists: {user.email}")
             raise HTTPException(
@@ -214,7 +533,7 @@ async def create_user(user: UserCreate, db: Session = Depends(get_db)):
             )
         
         # Create new user
-        hashed_password = get_password_hash(user.password)
+        hashed_password = await get_password_hash_async(user.password)
         db_user = DBUser(
             username=user.username,
             email=user.email,
@@ -222,14 +541,12 @@ async def create_user(user: UserCreate, db: Session = Depends(get_db)):
         )
         
         db.add(db_user)
-        db.commit()
-        db.refresh(db_user)
+        await db.commit()
+        await db.refresh(db_user)
         
         # Create access token
         access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        access_token = create_access_token(
-            data={"sub": user.username}, expires_delta=access_token_expires
-        )
+        access_token = create_access_token(db_user, expires_delta=access_token_expires)
         
         logger.info(f"Successfully created user: {user.username}")
         return {
@@ -242,97 +559,659 @@ async def create_user(user: UserCreate, db: Session = Depends(get_db)):
         raise he
     except Exception as e:
         logger.error(f"Error creating user: {str(e)}")
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An error occurred while creating the user: {str(e)}"
         )
 
+@app.post("/auth/logout", status_code=status.HTTP_204_NO_CONTENT)
+async def logout(claims: TokenClaims = Depends(get_token_claims)):
+    revoke_token(claims)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
 @app.get("/users/me", response_model=User)
 async def read_users_me(current_user: DBUser = Depends(get_current_user)):
     return current_user
 
+# Read-only routes authorize from the token's claims and never load the user
+read_devices = require_scope("devices:read")
+
+# Device listing: keyset pagination on the primary key, optional field
+# projection and NDJSON streaming for large fleets
+MAX_PAGE_SIZE = 1000
+
+# Device responses are encoded straight from rows (see serialization.py);
+# the routes return the bytes, so response_model only documents the shape
+device_encoder = DeviceEncoder(DeviceProperties.model_fields)
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode())
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+def parse_fields(fields: Optional[str]) -> tuple:
+    if not fields:
+        return DEVICE_FIELDS
+    selected = tuple(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+    unknown = [f for f in selected if f not in DEVICE_FIELDS]
+    if unknown or not selected:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown fields: {', '.join(unknown)}" if unknown else "No fields selected"
+        )
+    return selected
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+async def device_collection_version(db: AsyncSession, user_id: int) -> int:
+    return await db.scalar(select(DBUser.device_version).where(DBUser.id == user_id)) or 0
+
+def field_columns(field: str) -> list:
+    if field == "properties":
+        return [getattr(DBDevice, column) for column in PROPERTY_COLUMNS] + [DBDevice.extra]
+    return [getattr(DBDevice, field)]
+
+def device_etag(version: int, user_id: int) -> str:
+    # Buffered control values aren't versioned until flushed, so their
+    # write sequence is part of the tag
+    return f'"{version}.{control_buffer.sequence(user_id)}"'
+
+def device_query(fields: tuple = DEVICE_FIELDS):
+    return select(
+        DBDevice.id, DBDevice.device_id, DBDevice.version,
+        *(column for field in fields if field != "device_id" for column in field_columns(field))
+    )
+
 @app.get("/devices", response_model=List[Device])
 async def get_devices(
-    current_user: DBUser = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    device_type: Optional[str] = Query(None, alias="type"),
+    device_status: Optional[str] = Query(None, alias="status"),
+    format: Literal["json", "ndjson"] = "json",
+    since: Optional[int] = Query(None, ge=0),
+    locked: Optional[bool] = None,
+    min_brightness: Optional[int] = Query(None, ge=0, le=100),
+    max_brightness: Optional[int] = Query(None, ge=0, le=100),
+    if_none_match: Optional[str] = Header(None),
+    claims: TokenClaims = Depends(read_devices),
+    db: AsyncSession = Depends(get_db)
+):
+    """List the user's devices in id order.
+
+    With ``limit`` the next page's cursor is returned in ``X-Next-Cursor``
+    (or, for NDJSON, as a final ``{"next_cursor": ...}`` line). ``fields``
+    selects a comma-separated subset of columns; only those are loaded.
+    ``since`` returns only devices changed after that collection version,
+    which is sent in ``X-Devices-Version``.
+    """
+    # Read the version before the rows so a concurrent change is, at worst,
+    # returned again by the next ?since= request rather than missed
+    version = await device_collection_version(db, claims.user_id)
+    etag = f'"{claims.user_id}.{version}.{control_buffer.sequence(claims.user_id)}"'
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    selected = parse_fields(fields)
+    query = (
+        device_query(selected)
+        .where(DBDevice.owner_id == claims.user_id)
+        .order_by(DBDevice.id)
+    )
+    if device_type is not None:
+        query = query.where(DBDevice.type == device_type)
+    if device_status is not None:
+        query = query.where(DBDevice.status == device_status)
+    if locked is not None:
+        query = query.where(DBDevice.locked == locked)
+    if min_brightness is not None:
+        query = query.where(DBDevice.brightness >= min_brightness)
+    if max_brightness is not None:
+        query = query.where(DBDevice.brightness <= max_brightness)
+    if since is not None:
+        query = query.where(DBDevice.version > since)
+    if cursor:
+        query = query.where(DBDevice.id > decode_cursor(cursor))
+    if limit:
+        # One extra row tells us whether there is a next page
+        query = query.limit(limit + 1)
+
+    headers = {"ETag": etag, "X-Devices-Version": str(version)}
+    if format == "ndjson":
+        async def stream_devices():
+            # Own session: the response body outlives the request dependencies
+            async with AsyncSessionLocal() as session:
+                rows = await session.stream(query)
+                count, last_id = 0, None
+                async for row in rows.mappings():
+                    if limit and count == limit:
+                        yield orjson.dumps({"next_cursor": encode_cursor(last_id)}) + b"\n"
+                        break
+                    yield device_encoder.encode(row, selected, control_buffer.pending(row["device_id"])) + b"\n"
+                    count, last_id = count + 1, row["id"]
+
+        return StreamingResponse(stream_devices(), media_type="application/x-ndjson", headers=headers)
+
+    rows = (await db.execute(query)).mappings().all()
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        headers["X-Next-Cursor"] = encode_cursor(rows[-1]["id"])
+    return Response(
+        device_encoder.encode_list(rows, selected, control_buffer.pending),
+        media_type="application/json",
+        headers=headers,
+    )
+
+@app.get("/devices/summary")
+async def get_device_summary(
+    claims: TokenClaims = Depends(read_devices),
+    db: AsyncSession = Depends(get_db)
+):
+    """Per-type device counts and averages, aggregated in SQL."""
+    rows = await db.execute(
+        select(
+            DBDevice.type,
+            func.count().label("count"),
+            func.count().filter(DBDevice.status == "on").label("on"),
+            func.count().filter(DBDevice.locked == True).label("locked"),  # noqa: E712
+            func.avg(DBDevice.brightness).label("avg_brightness"),
+            func.avg(DBDevice.temperature).label("avg_temperature"),
+        )
+        .where(DBDevice.owner_id == claims.user_id)
+        .group_by(DBDevice.type)
+        .order_by(DBDevice.type)
+    )
+    return [
+        {
+            "type": row.type,
+            "count": row.count,
+            "on": row.on,
+            "locked": row.locked,
+            "avgBrightness": round(row.avg_brightness, 1) if row.avg_brightness is not None else None,
+            "avgTemperature": round(row.avg_temperature, 1) if row.avg_temperature is not None else None,
+        }
+        for row in rows
+    ]
+
+# Device history (see history.py): newest first, keyset-paginated on
+# (time, id) with the next page's cursor in X-Next-Cursor
+def encode_history_cursor(change: dict) -> str:
+    return base64.urlsafe_b64encode(f"{change['ts']!r}:{change['id']}".encode()).decode().rstrip("=")
+
+def decode_history_cursor(cursor: str) -> tuple:
+    try:
+        ts, change_id = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split(":")
+        return float(ts), int(change_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+async def history_page(db: AsyncSession, user_id: int, device_id: Optional[str],
+                       start: Optional[datetime], end: Optional[datetime],
+                       limit: int, cursor: Optional[str]) -> Response:
+    changes = await device_history.query(
+        db, user_id, device_id,
+        start=start.timestamp() if start else None,
+        end=end.timestamp() if end else None,
+        limit=limit + 1,
+        before=decode_history_cursor(cursor) if cursor else None,
+    )
+    headers = {}
+    if len(changes) > limit:
+        changes = changes[:limit]
+        headers["X-Next-Cursor"] = encode_history_cursor(changes[-1])
+    return JSONResponse(changes, headers=headers)
+
+@app.get("/devices/history")
+async def get_history(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    claims: TokenClaims = Depends(read_devices),
+    db: AsyncSession = Depends(get_db)
 ):
-    return db.query(DBDevice).filter(DBDevice.owner_id == current_user.id).all()
+    """Changes to all of the user's devices with ``start <= time < end``."""
+    return await history_page(db, claims.user_id, None, start, end, limit, cursor)
+
+# Live device updates. Both channels authenticate with ?token= (browsers
+# can't set headers on WebSocket/EventSource); the claims are enough, so no
+# database session is needed for the stream.
+DEVICE_EVENTS_KEEPALIVE = 15
+
+def authenticate_stream(token: Optional[str]) -> Optional[TokenClaims]:
+    if not token:
+        return None
+    claims = claims_from_token(token)
+    if claims is None or "devices:read" not in claims.scopes:
+        return None
+    return claims
+
+@app.websocket("/ws/devices")
+async def device_updates_ws(websocket: WebSocket, token: Optional[str] = Query(None)):
+    claims = authenticate_stream(token)
+    if claims is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    subscription = device_events.subscribe(claims.user_id)
+    # Watch for the client going away while we wait for device changes
+    receiver = asyncio.create_task(websocket.receive())
+    try:
+        while True:
+            sender = asyncio.create_task(subscription.get())
+            done, _ = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver in done:
+                sender.cancel()
+                if receiver.result()["type"] == "websocket.disconnect":
+                    break
+                receiver = asyncio.create_task(websocket.receive())
+                continue
+            await websocket.send_json(sender.result())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        device_events.unsubscribe(subscription)
+
+@app.get("/devices/events")
+async def device_updates_sse(token: Optional[str] = Query(None)):
+    claims = authenticate_stream(token)
+    if claims is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+        )
+
+    async def stream():
+        subscription = device_events.subscribe(claims.user_id)
+        try:
+            yield ": connected\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscription.get(), DEVICE_EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {message['type']}\ndata: {json.dumps(message)}\n\n"
+        finally:
+            device_events.unsubscribe(subscription)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.get("/devices/{device_id}", response_model=Device)
 async def get_device(
     device_id: str,
-    current_user: DBUser = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    if_none_match: Optional[str] = Header(None),
+    claims: TokenClaims = Depends(read_devices),
+    db: AsyncSession = Depends(get_db)
 ):
-    device = db.query(DBDevice).filter(
-        DBDevice.device_id == device_id,
-        DBDevice.owner_id == current_user.id
-    ).first()
-    if not device:
+    owned = (DBDevice.device_id == device_id, DBDevice.owner_id == claims.user_id)
+    if if_none_match:
+        # Revalidation only needs the version, not the row
+        version = await db.scalar(select(DBDevice.version).where(*owned))
+        if version is not None and etag_matches(if_none_match, device_etag(version, claims.user_id)):
+            return Response(
+                status_code=status.HTTP_304_NOT_MODIFIED,
+                headers={"ETag": device_etag(version, claims.user_id)}
+            )
+    row = (await db.execute(device_query().where(*owned))).mappings().first()
+    if not row:
         raise HTTPException(status_code=404, detail="Device not found")
-    return device
+    return Response(
+        device_encoder.encode(row, overlay=control_buffer.pending(device_id)),
+        media_type="application/json",
+        headers={"ETag": device_etag(row["version"], claims.user_id)},
+    )
 
 @app.post("/devices", response_model=Device)
 async def add_device(
     device: Device,
     current_user: DBUser = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     db_device = DBDevice(
         device_id=device.device_id,
         name=device.name,
         type=device.type,
         status=device.status,
-        properties=device.properties,
+        properties=device.properties.dict(),
         owner_id=current_user.id
     )
     db.add(db_device)
-    db.commit()
-    db.refresh(db_device)
+    await db.commit()
+    await db.refresh(db_device)
     return db_device
 
-@app.put("/devices/{device_id}/status")
-async def update_device_status(
-    device_id: str,
-    status: str = Query(...),
-    current_user: DBUser = Depends(get_current_user),
-    db: Session = Depends(get_db)
+# Device commands shared by the single-device endpoints and the batch endpoint.
+# Each checks the device type and applies the change to a loaded device.
+def apply_status(device: DBDevice, value: str):
+    device.status = value
+
+def apply_brightness(device: DBDevice, brightness: int):
+    if device.type != "light":
+        raise HTTPException(status_code=400, detail="Device is not a light")
+    device.properties["brightness"] = brightness
+
+def apply_temperature(device: DBDevice, temperature: float):
+    if device.type != "thermostat":
+        raise HTTPException(status_code=400, detail="Device is not a thermostat")
+    device.properties["temperature"] = temperature
+
+def apply_color(device: DBDevice, color: str):
+    if device.type != "light":
+        raise HTTPException(status_code=400, detail="Device is not a light")
+    device.properties["color"] = color
+
+def apply_lock(device: DBDevice, locked: bool):
+    if device.type != "lock":
+        raise HTTPException(status_code=400, detail="Device is not a lock")
+    device.properties["locked"] = locked
+    device.status = "locked" if locked else "unlocked"
+
+DEVICE_COMMANDS = {
+    "status": apply_status,
+    "brightness": apply_brightness,
+    "temperature": apply_temperature,
+    "color": apply_color,
+    "lock": apply_lock,
+}
+
+async def apply_device_commands(db: AsyncSession, commands, owner_id: Optional[int] = None):
+    """Apply ``(device_id, command, value)`` tuples with a single IN query.
+
+    Returns a result per command; failures don't stop the other commands.
+    """
+    device_ids = {device_id for device_id, _, _ in commands}
+    query = select(DBDevice).where(DBDevice.device_id.in_(device_ids))
+    if owner_id is not None:
+        query = query.where(DBDevice.owner_id == owner_id)
+    devices = {device.device_id: device for device in (await db.scalars(query)).all()}
+
+    results = []
+    for device_id, command, value in commands:
+        result = {"device_id": device_id, "command": command, "ok": True}
+        device = devices.get(device_id)
+        try:
+            if device is None:
+                raise HTTPException(status_code=404, detail="Device not found")
+            DEVICE_COMMANDS[command](device, value)
+        except HTTPException as he:
+            result.update(ok=False, status_code=he.status_code, detail=he.detail)
+        results.append(result)
+    return results
+
+@app.post("/devices/commands:batch")
+async def run_device_commands(
+    batch: DeviceCommandBatch,
+    current_user: DBUser = Depends(get_current_user)
 ):
-    device = db.query(DBDevice).filter(
+    commands = [(command.device_id, command.command, command.value) for command in batch.commands]
+
+    async def apply(db: AsyncSession):
+        results = await apply_device_commands(db, commands, owner_id=current_user.id)
+        # Applied commands replace the user's buffered values; failed ones
+        # (someone else's device, wrong type) leave them be
+        for result in results:
+            if result["ok"] and result["command"] in BUFFERED_COMMANDS:
+                control_buffer.discard(result["device_id"], (result["command"],))
+        return results
+
+    try:
+        # One IN query and one transaction for the whole batch
+        results = await write_queue.submit(apply)
+    except Exception as e:
+        logger.error(f"Error running device commands: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to run device commands")
+
+    applied = sum(1 for result in results if result["ok"])
+    logger.info(f"Applied {applied}/{len(results)} batched device commands")
+    return {"applied": applied, "failed": len(results) - applied, "results": results}
+
+# Bulk import/export (see bulk.py). Imports are validated line by line as
+# the body streams in and upserted in chunks, one write per chunk; exports
+# stream from a cursor in batches.
+IMPORT_CHUNK_SIZE = 500
+MAX_IMPORT_ERRORS = 1000
+EXPORT_BATCH_SIZE = 1000
+
+async def upsert_devices(db: AsyncSession, rows, owner_id: int) -> tuple:
+    """Create or replace ``(line, DeviceImport)`` rows with a single IN query.
+
+    Returns ``(line, device_id, error)`` per row, ``error`` being None for
+    rows stored, and the ids of the devices created. Devices belonging to
+    another user are not touched, nor are their buffered control values.
+    """
+    device_ids = {row.device_id for _, row in rows}
+    devices = {
+        device.device_id: device
+        for device in (await db.scalars(select(DBDevice).where(DBDevice.device_id.in_(device_ids)))).all()
+    }
+    created = set()
+    results = []
+    for line, row in rows:
+        device = devices.get(row.device_id)
+        if device is None:
+            device = devices[row.device_id] = DBDevice(device_id=row.device_id, owner_id=owner_id)
+            db.add(device)
+            created.add(row.device_id)
+        elif device.owner_id != owner_id:
+            results.append((line, row.device_id, "Device ID already registered"))
+            continue
+        elif device.type != row.type:
+            energy_summary.invalidate(owner_id)
+            coordinator.publish("analytics.invalidate", owner_id)
+        device.name = row.name
+        device.type = row.type
+        device.status = row.status
+        device.properties = row.properties.model_dump(exclude_none=True)
+        # The imported state replaces any buffered control values
+        control_buffer.discard(row.device_id)
+        results.append((line, row.device_id, None))
+    return results, created
+
+@app.post("/devices:import")
+async def import_devices(
+    request: Request,
+    format: Literal[BULK_FORMATS] = "ndjson",
+    current_user: DBUser = Depends(get_current_user)
+):
+    """Create or replace devices from an NDJSON or CSV body (as exported).
+
+    Rows that fail to parse, validate or store are listed in ``errors`` by
+    line number (up to ``MAX_IMPORT_ERRORS``); the other rows are stored.
+    """
+    report = {"created": 0, "updated": 0, "failed": 0, "errors": []}
+
+    def fail(line: int, device_id, detail: str):
+        report["failed"] += 1
+        if len(report["errors"]) < MAX_IMPORT_ERRORS:
+            report["errors"].append({"line": line, "device_id": device_id, "detail": detail})
+        else:
+            report["errors_truncated"] = True
+
+    async def store(rows):
+        async def apply(db: AsyncSession):
+            return await upsert_devices(db, rows, current_user.id)
+
+        try:
+            results, created = await write_queue.submit(apply)
+        except Exception as e:
+            logger.error(f"Error importing devices: {str(e)}")
+            for line, row in rows:
+                fail(line, row.device_id, "Failed to store device")
+            return
+        for line, device_id, error in results:
+            if error is not None:
+                fail(line, device_id, error)
+        report["created"] += len(created)
+        report["updated"] += sum(1 for _, _, error in results if error is None) - len(created)
+
+    chunk = []
+    async for line, record in iter_records(request.stream(), format):
+        if isinstance(record, RecordError):
+            fail(line, None, str(record))
+            continue
+        try:
+            chunk.append((line, DeviceImport.model_validate(record)))
+        except ValidationError as e:
+            fail(line, record.get("device_id"), "; ".join(
+                f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors()
+            ))
+            continue
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            await store(chunk)
+            chunk = []
+    if chunk:
+        await store(chunk)
+
+    logger.info(
+        f"Imported devices for user {current_user.id}: {report['created']} created, "
+        f"{report['updated']} updated, {report['failed']} failed"
+    )
+    return report
+
+@app.get("/devices:export")
+async def export_devices(
+    format: Literal[BULK_FORMATS] = "ndjson",
+    claims: TokenClaims = Depends(read_devices)
+):
+    """Stream all of the user's devices, with every property, in id order."""
+    query = (
+        device_query()
+        .where(DBDevice.owner_id == claims.user_id)
+        .order_by(DBDevice.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    encode = encode_csv if format == "csv" else encode_ndjson
+
+    async def stream_export():
+        # Own session: the response body outlives the request dependencies
+        async with AsyncSessionLocal() as session:
+            if format == "csv":
+                yield encode_csv((), header=True)
+            result = await session.stream(query)
+            async for rows in result.mappings().partitions():
+                yield encode([export_document(row, control_buffer.pending(row["device_id"])) for row in rows])
+
+    return StreamingResponse(
+        stream_export(),
+        media_type=BULK_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="devices.{format}"'},
+    )
+
+async def run_background_commands(commands, source: str, actor: Optional[ChangeActor] = None):
+    async def apply(db: AsyncSession):
+        return await apply_device_commands(db, commands)
+
+    # Buffered values keep the actor the control buffer set
+    token = change_actor.set(actor) if actor else None
+    try:
+        results = await write_queue.submit(apply)
+    finally:
+        if token:
+            change_actor.reset(token)
+    for result in results:
+        if not result["ok"]:
+            logger.warning(f"{source} {result['command']} failed for device {result['device_id']}: {result['detail']}")
+
+async def run_scheduled_actions(actions):
+    await run_background_commands(actions, "Scheduled", ChangeActor("scheduler"))
+
+async def run_control_commands(commands):
+    await run_background_commands(commands, "Buffered")
+
+async def run_automation_actions(actions):
+    await run_background_commands(actions, "Automation", ChangeActor("automation"))
+
+async def buffer_device_command(device_id: str, command: str, value, owner_id: int, db: AsyncSession):
+    """Validate a slider-style command and hand it to the write-behind buffer."""
+    device = await db.scalar(select(DBDevice).where(
         DBDevice.device_id == device_id,
-        DBDevice.owner_id == current_user.id
-    ).first()
+        DBDevice.owner_id == owner_id
+    ))
     if not device:
         raise HTTPException(status_code=404, detail="Device not found")
-    device.status = status
-    db.commit()
-    return device
+    # Applying to the loaded device runs the command's checks; the session
+    # is never committed, the buffer persists the value
+    DEVICE_COMMANDS[command](device, value)
+    await control_buffer.write(owner_id, device_id, command, value)
+
+def device_document(device: DBDevice) -> dict:
+    """A loaded device in the Device response shape, with its buffered values."""
+    return {
+        "device_id": device.device_id,
+        "name": device.name,
+        "type": device.type,
+        "status": device.status,
+        "properties": {**device.properties, **control_buffer.pending(device.device_id)},
+    }
+
+@app.put("/devices/{device_id}/status", response_model=Device)
+async def update_device_status(
+    device_id: str,
+    status: str = Query(...),
+    current_user: DBUser = Depends(get_current_user)
+):
+    async def apply(db: AsyncSession):
+        device = await db.scalar(select(DBDevice).where(
+            DBDevice.device_id == device_id,
+            DBDevice.owner_id == current_user.id
+        ))
+        if not device:
+            raise HTTPException(status_code=404, detail="Device not found")
+        apply_status(device, status)
+        return device_document(device)
+
+    return await write_queue.submit(apply)
 
 @app.put("/devices/{device_id}", response_model=Device)
 async def update_device(
     device_id: str,
     device_update: DeviceUpdate,
-    current_user: DBUser = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: DBUser = Depends(get_current_user)
 ):
-    try:
-        device = db.query(DBDevice).filter(DBDevice.device_id == device_id).first()
+    async def apply(db: AsyncSession):
+        device = await db.scalar(select(DBDevice).where(
+            DBDevice.device_id == device_id,
+            DBDevice.owner_id == current_user.id
+        ))
         if not device:
             raise HTTPException(status_code=404, detail="Device not found")
-            
+
         if device_update.name is not None:
             device.name = device_update.name
         if device_update.type is not None:
+            if device_update.type != device.type:
+                energy_summary.invalidate(device.owner_id)
+                coordinator.publish("analytics.invalidate", device.owner_id)
             device.type = device_update.type
         if device_update.status is not None:
             device.status = device_update.status
         if device_update.properties is not None:
-            device.properties.update(device_update.properties.dict(exclude_unset=True))
-            
-        db.commit()
-        db.refresh(device)
-        return device
+            properties = device_update.properties.dict(exclude_unset=True)
+            control_buffer.discard(device_id, [key for key in properties if key in BUFFERED_COMMANDS])
+            device.properties.update(properties)
+        # Values still buffered are newer than the stored ones
+        return device_document(device)
+
+    try:
+        return await write_queue.submit(apply)
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error updating device: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to update device")
@@ -342,18 +1221,13 @@ async def set_brightness(
     device_id: str,
     brightness: int = Body(..., ge=0, le=100),
     current_user: DBUser = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     try:
-        device = db.query(DBDevice).filter(DBDevice.device_id == device_id).first()
-        if not device:
-            raise HTTPException(status_code=404, detail="Device not found")
-        if device.type != "light":
-            raise HTTPException(status_code=400, detail="Device is not a light")
-            
-        device.properties["brightness"] = brightness
-        db.commit()
+        await buffer_device_command(device_id, "brightness", brightness, current_user.id, db)
         return {"message": "Brightness updated successfully"}
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error setting brightness: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to set brightness")
@@ -363,18 +1237,13 @@ async def set_temperature(
     device_id: str,
     temperature: float = Body(..., ge=10, le=32),
     current_user: DBUser = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     try:
-        device = db.query(DBDevice).filter(DBDevice.device_id == device_id).first()
-        if not device:
-            raise HTTPException(status_code=404, detail="Device not found")
-        if device.type != "thermostat":
-            raise HTTPException(status_code=400, detail="Device is not a thermostat")
-            
-        device.properties["temperature"] = temperature
-        db.commit()
+        await buffer_device_command(device_id, "temperature", temperature, current_user.id, db)
         return {"message": "Temperature updated successfully"}
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error setting temperature: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to set temperature")
@@ -384,18 +1253,13 @@ async def set_color(
     device_id: str,
     color: str = Body(..., regex="^#[0-9A-Fa-f]{6}$"),
     current_user: DBUser = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     try:
-        device = db.query(DBDevice).filter(DBDevice.device_id == device_id).first()
-        if not device:
-            raise HTTPException(status_code=404, detail="Device not found")
-        if device.type != "light":
-            raise HTTPException(status_code=400, detail="Device is not a light")
-            
-        device.properties["color"] = color
-        db.commit()
+        await buffer_device_command(device_id, "color", color, current_user.id, db)
         return {"message": "Color updated successfully"}
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error setting color: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to set color")
@@ -404,20 +1268,22 @@ async def set_color(
 async def toggle_lock(
     device_id: str,
     locked: bool = Body(...),
-    current_user: DBUser = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: DBUser = Depends(get_current_user)
 ):
-    try:
-        device = db.query(DBDevice).filter(DBDevice.device_id == device_id).first()
+    async def apply(db: AsyncSession):
+        device = await db.scalar(select(DBDevice).where(
+            DBDevice.device_id == device_id,
+            DBDevice.owner_id == current_user.id
+        ))
         if not device:
             raise HTTPException(status_code=404, detail="Device not found")
-        if device.type != "lock":
-            raise HTTPException(status_code=400, detail="Device is not a lock")
-            
-        device.properties["locked"] = locked
-        device.status = "locked" if locked else "unlocked"
-        db.commit()
+        apply_lock(device, locked)
+
+    try:
+        await write_queue.submit(apply)
         return {"message": f"Lock {'locked' if locked else 'unlocked'} successfully"}
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error toggling lock: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to toggle lock")
@@ -426,22 +1292,25 @@ async def toggle_lock(
 async def update_device_schedule(
     device_id: str,
     schedule: Schedule,
-    current_user: DBUser = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: DBUser = Depends(get_current_user)
 ):
-    try:
-        device = db.query(DBDevice).filter(DBDevice.device_id == device_id).first()
+    async def apply(db: AsyncSession):
+        device = await db.scalar(select(DBDevice).where(
+            DBDevice.device_id == device_id,
+            DBDevice.owner_id == current_user.id
+        ))
         if not device:
             raise HTTPException(status_code=404, detail="Device not found")
-            
-        if "schedule" not in device.properties:
-            device.properties["schedule"] = {}
-            
-        device.properties["schedule"].update(schedule.dict())
-        db.commit()
-        
+
+        # Reassign rather than mutate the nested dict so the change is tracked
+        device.properties["schedule"] = {**(device.properties.get("schedule") or {}), **schedule.dict()}
+
+    try:
+        await write_queue.submit(apply)
         logger.info(f"Updated schedule for device {device_id}")
         return {"message": "Schedule updated successfully"}
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error updating device schedule: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to update device schedule")
@@ -450,62 +1319,296 @@ async def update_device_schedule(
 async def update_device_settings(
     device_id: str,
     settings: DeviceSettings,
-    current_user: DBUser = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: DBUser = Depends(get_current_user)
 ):
-    try:
-        device = db.query(DBDevice).filter(DBDevice.device_id == device_id).first()
+    async def apply(db: AsyncSession):
+        device = await db.scalar(select(DBDevice).where(
+            DBDevice.device_id == device_id,
+            DBDevice.owner_id == current_user.id
+        ))
         if not device:
             raise HTTPException(status_code=404, detail="Device not found")
-            
+
         if settings.name is not None:
             device.name = settings.name
-            
+
         settings_dict = settings.dict(exclude_unset=True)
         device.properties.update(settings_dict)
-        
-        db.commit()
+
+    try:
+        await write_queue.submit(apply)
         logger.info(f"Updated settings for device {device_id}")
         return {"message": "Settings updated successfully"}
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error updating device settings: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to update device settings")
 
+def rule_response(rule: DBRule) -> dict:
+    return {"id": rule.id, "name": rule.name, "enabled": rule.enabled, **rule.definition}
+
+async def validate_rule(rule: RuleCreate, owner_id: int, db: AsyncSession) -> dict:
+    """Check a rule against the owner's devices; returns its stored definition."""
+    definition = rule.dict(include={"trigger", "conditions", "actions"})
+    try:
+        compile_rule(0, owner_id, definition)
+        for action in rule.actions:
+            device_command_adapter.validate_python(action.dict(exclude={"delay"}))
+    except RuleError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid rule: {str(e)}")
+    except ValidationError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid rule action: {'; '.join(error['msg'] for error in e.errors())}"
+        )
+    device_ids = {rule.trigger.device_id}
+    device_ids.update(condition.device_id for condition in rule.conditions)
+    device_ids.update(action.device_id for action in rule.actions)
+    owned = set((await db.scalars(select(DBDevice.device_id).where(
+        DBDevice.device_id.in_(device_ids),
+        DBDevice.owner_id == owner_id
+    ))).all())
+    unknown = sorted(device_ids - owned)
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown devices: {', '.join(unknown)}"
+        )
+    return definition
+
+def rules_changed(rule_id: int):
+    rules_engine.reload(rule_id)
+    coordinator.publish("rules.changed", rule_id)
+
+@app.get("/rules", response_model=List[RuleResponse])
+async def get_rules(
+    claims: TokenClaims = Depends(read_devices),
+    db: AsyncSession = Depends(get_db)
+):
+    rules = await db.scalars(select(DBRule).where(DBRule.owner_id == claims.user_id).order_by(DBRule.id))
+    return [rule_response(rule) for rule in rules]
+
+@app.post("/rules", response_model=RuleResponse)
+async def create_rule(
+    rule: RuleCreate,
+    current_user: DBUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    definition = await validate_rule(rule, current_user.id, db)
+    db_rule = DBRule(owner_id=current_user.id, name=rule.name, enabled=rule.enabled, definition=definition)
+    db.add(db_rule)
+    await db.commit()
+    rules_changed(db_rule.id)
+    logger.info(f"Created automation rule {db_rule.id} for user {current_user.id}")
+    return rule_response(db_rule)
+
+@app.put("/rules/{rule_id}", response_model=RuleResponse)
+async def update_rule(
+    rule_id: int,
+    rule: RuleCreate,
+    current_user: DBUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    db_rule = await db.scalar(select(DBRule).where(DBRule.id == rule_id, DBRule.owner_id == current_user.id))
+    if not db_rule:
+        raise HTTPException(status_code=404, detail="Rule not found")
+    db_rule.definition = await validate_rule(rule, current_user.id, db)
+    db_rule.name = rule.name
+    db_rule.enabled = rule.enabled
+    await db.commit()
+    rules_changed(rule_id)
+    return rule_response(db_rule)
+
+@app.delete("/rules/{rule_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_rule(
+    rule_id: int,
+    current_user: DBUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    db_rule = await db.scalar(select(DBRule).where(DBRule.id == rule_id, DBRule.owner_id == current_user.id))
+    if not db_rule:
+        raise HTTPException(status_code=404, detail="Rule not found")
+    await db.delete(db_rule)
+    await db.commit()
+    rules_changed(rule_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+@app.post("/devices/{device_id}/telemetry")
+async def ingest_telemetry(
+    device_id: str,
+    batch: TelemetryBatch,
+    current_user: DBUser = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    device = await db.scalar(select(DBDevice).where(
+        DBDevice.device_id == device_id,
+        DBDevice.owner_id == current_user.id
+    ))
+    if not device:
+        raise HTTPException(status_code=404, detail="Device not found")
+
+    now = datetime.now().timestamp()
+    samples = [
+        (sample.timestamp.timestamp() if sample.timestamp else now, sample.power, sample.runtime)
+        for sample in batch.samples
+    ]
+    accepted = telemetry_store.ingest(device_id, samples)
+    energy_summary.record(current_user.id, device.type, samples)
+    coordinator.publish("telemetry", [current_user.id, device_id, device.type, samples])
+    return {"accepted": accepted}
+
 @app.get("/devices/{device_id}/stats")
 async def get_device_stats(
     device_id: str,
-    current_user: DBUser = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    claims: TokenClaims = Depends(read_devices),
+    db: AsyncSession = Depends(get_db)
 ):
     try:
-        device = db.query(DBDevice).filter(DBDevice.device_id == device_id).first()
+        device = await db.scalar(select(DBDevice.id).where(
+            DBDevice.device_id == device_id,
+            DBDevice.owner_id == claims.user_id
+        ))
         if not device:
             raise HTTPException(status_code=404, detail="Device not found")
-            
-        # Simulate power usage and runtime calculations
-        power_usage = random.randint(5, 100) if device.status == "on" else 0
-        runtime = random.randint(1, 24) if device.status == "on" else 0
-        
-        stats = {
-            "powerUsage": power_usage,
-            "runtime": runtime,
-            "lastUpdated": datetime.now().isoformat()
-        }
-        
-        device.properties["stats"] = stats
-        db.commit()
-        
-        return stats
+
+        # Served from precomputed rollups; the device row is not touched.
+        # Loading a device's rollups into the cache reads the table.
+        return await asyncio.to_thread(telemetry_store.stats, device_id)
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error fetching device stats: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to fetch device stats")
 
+@app.get("/devices/{device_id}/history")
+async def get_device_history(
+    device_id: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    claims: TokenClaims = Depends(read_devices),
+    db: AsyncSession = Depends(get_db)
+):
+    """Who changed the device, when and how, with ``start <= time < end``."""
+    device = await db.scalar(select(DBDevice.id).where(
+        DBDevice.device_id == device_id,
+        DBDevice.owner_id == claims.user_id
+    ))
+    if not device:
+        raise HTTPException(status_code=404, detail="Device not found")
+    return await history_page(db, claims.user_id, device_id, start, end, limit, cursor)
+
+def validate_time_range(time_range: str) -> str:
+    if time_range not in TIME_RANGES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"timeRange must be one of: {', '.join(TIME_RANGES)}"
+        )
+    return time_range
+
+@app.get("/analytics/energy")
+async def get_energy_analytics(
+    time_range: str = Query("week", alias="timeRange"),
+    claims: TokenClaims = Depends(read_devices)
+):
+    # Building a user's view (first query, or after invalidation) reads the database
+    return await asyncio.to_thread(energy_summary.energy, claims.user_id, validate_time_range(time_range))
+
+@app.get("/analytics/summary")
+async def get_analytics_summary(
+    time_range: str = Query("week", alias="timeRange"),
+    claims: TokenClaims = Depends(read_devices),
+    db: AsyncSession = Depends(get_db)
+):
+    by_type = await asyncio.to_thread(energy_summary.by_type, claims.user_id, validate_time_range(time_range))
+    counts = dict((await db.execute(
+        select(DBDevice.status, func.count(DBDevice.id))
+        .where(DBDevice.owner_id == claims.user_id)
+        .group_by(DBDevice.status)
+    )).all())
+    total_devices = sum(counts.values())
+    total_energy = sum(by_type.values())
+
+    return {
+        "totalDevices": total_devices,
+        "activeDevices": counts.get("on", 0),
+        "totalEnergy": round(total_energy, 2),
+        "averageUsage": round(total_energy / total_devices, 2) if total_devices else 0,
+        "deviceUsage": [
+            {
+                "name": device_type,
+                "usage": round(100 * energy / total_energy, 1) if total_energy else 0,
+            }
+            for device_type, energy in sorted(by_type.items(), key=lambda item: -item[1])
+        ],
+    }
+
+# Prometheus metrics. Component counters are read at scrape time so the
+# hot paths only pay for their own bookkeeping.
+def component_metrics():
+    pool = hashing_pool.stats()
+    yield "password_hash_total", "counter", "Password hashes and verifications completed", pool["completed"]
+    yield "password_hash_rejected_total", "counter", "Password hashes rejected by a full queue", pool["rejected"]
+    yield "password_hash_seconds_total", "counter", "Time spent in bcrypt", pool["busy_seconds"]
+    yield "password_hash_in_flight", "gauge", "Password hashes running or queued", pool["in_flight"]
+    yield "write_queue_batches_total", "counter", "Group commits by the write queue", write_queue.batches
+    yield "write_queue_writes_total", "counter", "Writes committed by the write queue", write_queue.writes
+    yield "control_buffer_writes_total", "counter", "Control values buffered", control_buffer.writes
+    yield "control_buffer_flushed_total", "counter", "Coalesced control values persisted", control_buffer.flushed
+    yield "device_event_subscribers", "gauge", "Open live-update connections", device_events.subscriber_count()
+    yield "device_schedules", "gauge", "Device schedules indexed", len(device_scheduler)
+    yield "automation_rules", "gauge", "Automation rules compiled on this worker", rules_engine.rules
+    yield "automation_rules_fired_total", "counter", "Automation rules fired", rules_engine.fired
+    yield "device_history_recorded_total", "counter", "Device changes logged", device_history.recorded
+    yield "device_history_dropped_total", "counter", "Device changes dropped by a full history buffer", device_history.dropped
+    yield "device_history_pending", "gauge", "Device changes awaiting flush", device_history.pending()
+    yield "device_history_compacted_total", "counter", "Device history rows removed by compaction", device_history.compacted
+    yield "device_history_expired_total", "counter", "Device history rows removed by retention", device_history.expired
+    yield "telemetry_pending", "gauge", "Telemetry chunks and rollups awaiting flush", telemetry_store.pending()
+    yield "device_fragment_cache_hits_total", "counter", "Encoded device fragments reused", device_encoder.hits
+    yield "device_fragment_cache_misses_total", "counter", "Device fragments encoded", device_encoder.misses
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+# Sampling profiler (admin only, and only with PROFILER_ENABLED set)
+class ProfilerSession(BaseModel):
+    sample_rate: float = Field(1.0, gt=0, le=1)  # fraction of requests profiled
+    duration: float = Field(30, ge=1, le=600)  # seconds
+
+def require_profiler(admin: DBUser = Depends(get_admin_user)):
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiler is disabled")
+    return admin
+
+@app.get("/admin/profiler", dependencies=[Depends(require_profiler)])
+async def get_profiler_status():
+    return profiler.status()
+
+@app.post("/admin/profiler/start", dependencies=[Depends(require_profiler)])
+async def start_profiler(session: ProfilerSession):
+    try:
+        profiler.start(session.sample_rate, session.duration)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    logger.info(f"Profiling {session.sample_rate:.0%} of requests for {session.duration}s")
+    return profiler.status()
+
+@app.post("/admin/profiler/stop", dependencies=[Depends(require_profiler)])
+async def stop_profiler_session():
+    files = await asyncio.to_thread(profiler.stop)
+    return {"files": files}
+
 # Error handler
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
     return JSONResponse(
         status_code=exc.status_code,
         content={"detail": str(exc.detail)},
+        headers=getattr(exc, "headers", None),
     )
 
 @app.exception_handler(Exception)
@@ -516,5 +1619,13 @@ async def general_exception_handler(request, exc):
         content={"detail": "An unexpected error occurred"},
     )
 
+startup_report.mark("routes")
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # WEB_CONCURRENCY > 1 serves from several workers; SIGHUP reloads them
+    if WORKERS > 1:
+        # Migrate before the workers start, so none of them waits on another
+        migrate()
+        WorkerSupervisor("main:app", host="0.0.0.0", port=8000, workers=WORKERS).run()
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
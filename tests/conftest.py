@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "backend", "app", "core"), os.path.join(ROOT, "backend", "app", "db")]
+# Run against a throwaway database instead of smart_home.db
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/test.db")
@@ -0,0 +1,60 @@
+import asyncio
+
+from sqlalchemy import select
+
+from database import Device, User, async_engine, engine
+from events import device_events
+from history import device_history
+from migrations import migrate
+from writer import WriteQueue
+
+
+def test_batch_publishes_its_committed_writes_once_it_commits():
+    migrate()
+    with engine.begin() as connection:
+        owner_id = connection.execute(User.__table__.insert().values(
+            username="owner", email="owner@example.com", hashed_password="x")).inserted_primary_key[0]
+        connection.execute(Device.__table__.insert(), [
+            {"device_id": f"event{i}", "name": f"event{i}", "type": "light", "status": "off",
+             "properties": {}, "owner_id": owner_id}
+            for i in range(3)
+        ])
+    published = []
+    seen = []
+    recorded = device_history.recorded
+
+    def rename(device_id, fail=False):
+        async def apply(session):
+            device = (await session.execute(select(Device).where(Device.device_id == device_id))).scalar_one()
+            device.name = "renamed"
+            await session.flush()
+            # Earlier writes of the batch have released their savepoints
+            seen.append(list(published))
+            if fail:
+                raise ValueError("rejected")
+        return apply
+
+    async def run():
+        device_events.add_listener(lambda user_id, device_id, changes: published.append(device_id))
+        queue = WriteQueue()
+        queue.start()
+        results = await asyncio.gather(
+            queue.submit(rename("event0")),
+            queue.submit(rename("event1", fail=True)),
+            queue.submit(rename("event2")),
+            return_exceptions=True,
+        )
+        await queue.stop()
+        await async_engine.dispose()
+        return queue, results
+
+    queue, results = asyncio.run(run())
+    assert queue.batches == 1
+    assert isinstance(results[1], ValueError)
+    assert seen == [[], [], []]
+    assert published == ["event0", "event2"]
+    assert device_history.recorded - recorded == 2
+    with engine.connect() as connection:
+        names = dict(connection.execute(
+            select(Device.device_id, Device.name).where(Device.device_id.like("event%"))).all())
+    assert names == {"event0": "renamed", "event1": "event1", "event2": "renamed"}
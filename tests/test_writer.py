@@ -0,0 +1,56 @@
+import asyncio
+import sqlite3
+
+from sqlalchemy import select
+
+from database import User, async_engine, engine
+from migrations import migrate
+from writer import WriteQueue
+
+
+def test_batch_is_invisible_until_its_single_commit():
+    migrate()
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [
+            {"username": f"user{i}", "email": f"user{i}@example.com", "hashed_password": "x"}
+            for i in range(3)
+        ])
+    other = sqlite3.connect(engine.url.database)
+    seen = []
+
+    def rename(username):
+        async def apply(session):
+            user = (await session.execute(select(User).where(User.username == username))).scalar_one()
+            user.email = f"{username}@renamed.example.com"
+            await session.flush()
+            # Earlier writes of the batch have released their savepoints
+            seen.append(other.execute(
+                "SELECT count(*) FROM users WHERE email LIKE '%@renamed.example.com'"
+            ).fetchone()[0])
+        return apply
+
+    def fail(session):
+        raise ValueError("rejected")
+
+    async def run():
+        queue = WriteQueue()
+        queue.start()
+        results = await asyncio.gather(
+            queue.submit(rename("user0")),
+            queue.submit(rename("user1")),
+            queue.submit(fail),
+            queue.submit(rename("user2")),
+            return_exceptions=True,
+        )
+        await queue.stop()
+        await async_engine.dispose()
+        return queue, results
+
+    queue, results = asyncio.run(run())
+    assert queue.batches == 1
+    assert isinstance(results[2], ValueError)
+    assert seen == [0, 0, 0]
+    assert other.execute(
+        "SELECT count(*) FROM users WHERE email LIKE '%@renamed.example.com'"
+    ).fetchone()[0] == 3
+    other.close()